@@ -0,0 +1,93 @@
+import os, re, struct, subprocess
+from argparse import ArgumentParser
+from SamCoverage import SamCoverage
+
+class BamPrescreen():
+    #Calls that don't need GATK, from the number of reads aligned to each reference: the BAM index
+    #keeps the mapped and unmapped read counts of every reference in its pseudo-bin, and samtools
+    #flagstat the totals of the pool
+    # - make_calls_gatk.py calls a reference Incomplete unless every base has a depth of at least
+    #   5, so a reference with fewer than 5 x length / maxReadLength mapped reads can only be
+    #   Incomplete whatever GATK finds (a depth of 5 everywhere also means a mean of 5, so such a
+    #   reference can't be Low coverage either)
+    # - without a read length, only references without a single mapped read are screened out
+    pseudoBin = 37450
+    minDepth = 5
+    mappedLine = re.compile(r'^(\d+) \+ (\d+) mapped \(')
+
+    def readIndex(baiPath):
+        #[(mapped, unmapped)] of every reference of a .bai, in the BAM header's order
+        with open(baiPath, 'rb') as f:
+            data = f.read()
+        if data[:4] != b'BAI\x01':
+            raise IOError(baiPath+" is not a BAM index")
+        offset = 4
+        (references,) = struct.unpack_from('<i', data, offset)
+        offset += 4
+        counts = []
+        for reference in range(references):
+            (bins,) = struct.unpack_from('<i', data, offset)
+            offset += 4
+            mapped = unmapped = 0
+            for index in range(bins):
+                binNumber, chunks = struct.unpack_from('<Ii', data, offset)
+                offset += 8
+                if binNumber == BamPrescreen.pseudoBin:
+                    #(unmapped start, unmapped end), (mapped, unmapped)
+                    mapped, unmapped = struct.unpack_from('<QQ', data, offset+16)
+                offset += 16*chunks
+            (intervals,) = struct.unpack_from('<i', data, offset)
+            offset += 4+8*intervals
+            counts.append((mapped, unmapped))
+        return counts
+
+    def flagstatMapped(flagstatPath):
+        #Mapped reads (QC passed + QC failed) of samtools flagstat output
+        with open(flagstatPath) as f:
+            for line in f:
+                match = BamPrescreen.mappedLine.match(line)
+                if match:
+                    return int(match.group(1))+int(match.group(2))
+        raise IOError("No mapped read count in "+flagstatPath)
+
+    def __init__(self, referenceLengths, maxReadLength=0):
+        #referenceLengths: [(name, length)] in reference order
+        self.referenceLengths = list(referenceLengths)
+        self.maxReadLength = maxReadLength
+
+    def incomplete(self, baiPath, flagstatPath=None):
+        #{name: mapped reads} of the references that can only be called Incomplete
+        if flagstatPath and os.path.isfile(flagstatPath) and BamPrescreen.flagstatMapped(flagstatPath) == 0:
+            return dict((name, 0) for name, length in self.referenceLengths)
+        incomplete = {}
+        for (name, length), (mapped, unmapped) in zip(self.referenceLengths, BamPrescreen.readIndex(baiPath)):
+            if mapped*self.maxReadLength < BamPrescreen.minDepth*length or mapped == 0:
+                incomplete[name] = mapped
+        return incomplete
+
+    def depth(self, bamPath, samtools, outputPath):
+        #depth.txt (samtools depth format) of a BAM with few mapped reads, e.g. of a pool that only has
+        #Incomplete references, without GATK DepthOfCoverage
+        coverage = SamCoverage(self.referenceLengths)
+        p = subprocess.Popen([samtools, "view", "-F", "0x4", bamPath], stdout=subprocess.PIPE, universal_newlines=True)
+        for line in p.stdout:
+            coverage.add(line)
+        if p.wait() != 0:
+            raise IOError("samtools view of "+bamPath+" exited with code "+str(p.returncode))
+        coverage.write(outputPath+".tmp")
+        os.replace(outputPath+".tmp", outputPath)
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("bam",
+            help="Indexed BAM of a pool, e.g. bwa_dir/aligned_reads.bam")
+    parser.add_argument("--fai", dest="fai", required=True,
+            help="references.fasta.fai the BAM was aligned to")
+    parser.add_argument("--flagstat", dest="flagstat",
+            help="samtools flagstat output of the BAM")
+    parser.add_argument("--maxReadLength", dest="maxReadLength", type=int, default=0,
+            help="Longest read (0 only screens out references without reads)")
+    args = parser.parse_args()
+    incomplete = BamPrescreen(SamCoverage.referenceLengths(args.fai), args.maxReadLength).incomplete(args.bam+".bai", args.flagstat)
+    for name in sorted(incomplete):
+        print("%s\t%d\tIncomplete" % (name, incomplete[name]))
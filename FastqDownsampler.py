@@ -0,0 +1,150 @@
+import os, sys, gzip, math, random, itertools
+from argparse import ArgumentParser
+import numpy
+from FastqSlices import FastqSlices
+from KmerPrefilter import KmerPrefilter
+from SamCoverage import SamCoverage
+
+class FastqDownsampler():
+    #Downsamples the slices beta_slice_fq.pl wrote into a pool's bwa_dir/fastq_dir to about
+    #targetDepth-fold coverage of its references, before beta_run_alignments.pl aligns them
+    # - slices are read once, streamed through gzip; only the kept reads are held in memory
+    # - mates stay together and are sampled as one unit (see FastqSlices)
+    # - every pool is aligned to all references of the run, but only holds some of them: the pool's
+    #   references are the ones the first estimateUnits units come from, told apart by the k-mers
+    #   found in a single reference (the plasmids of a run share their backbone). A reference is in
+    #   the pool if at least presenceShare as many units come from it as from the most frequent one;
+    #   if no unit can be placed, all references count
+    # - the number of units to keep is targetDepth*length of the pool's references/bases per unit,
+    #   with the bases per unit measured on the same first units; a reservoir sample of that size is
+    #   taken over all slices of the pool, then written back to their slices in the original read order
+    # - a pool already under targetDepth is left as it is
+    estimateUnits = 10000
+    presenceShare = 0.05
+    k = 21
+    minKmers = 3
+
+    def __init__(self, fastqDir, referenceKmers, referenceLengths, targetDepth, seed=1):
+        self.fastqDir = fastqDir
+        self.kmers, self.owners = referenceKmers
+        self.referenceLengths = referenceLengths
+        self.targetDepth = targetDepth
+        self.random = random.Random(seed)
+
+    def referenceKmers(fastaPath):
+        #(sorted k-mers found in only one reference, index of that reference) of references.fasta
+        kmers, owners = KmerPrefilter.canonicalKmers(KmerPrefilter.fastaSequences(fastaPath), FastqDownsampler.k)
+        order = numpy.lexsort((owners, kmers))
+        kmers, owners = kmers[order], owners[order]
+        distinct = numpy.ones(len(kmers), dtype=bool)
+        distinct[1:] = (kmers[1:] != kmers[:-1]) | (owners[1:] != owners[:-1])
+        kmers, owners = kmers[distinct], owners[distinct]
+        values, firsts, counts = numpy.unique(kmers, return_index=True, return_counts=True)
+        return values[counts == 1], owners[firsts[counts == 1]]
+
+    def poolReferences(self, head):
+        #Indexes of the references the units of head come from
+        references = len(self.referenceLengths)
+        sequences = []
+        unitOf = []
+        for unit, (group, index, records) in enumerate(head):
+            for record in records:
+                sequences.append(FastqSlices.sequence(record))
+                unitOf.append(unit)
+        kmers, owners = KmerPrefilter.canonicalKmers(sequences, FastqDownsampler.k)
+        if len(self.kmers) and len(kmers):
+            slots = numpy.minimum(numpy.searchsorted(self.kmers, kmers), len(self.kmers)-1)
+            found = self.kmers[slots] == kmers
+            #k-mers of each (read, reference), then the units with a read placed on each reference
+            hits = owners[found]*references+self.owners[slots[found]]
+            pairs, counts = numpy.unique(hits, return_counts=True)
+            pairs = pairs[counts >= FastqDownsampler.minKmers]
+            placed = numpy.unique(numpy.array(unitOf, dtype=numpy.int64)[pairs//references]*references+pairs%references)
+            units = numpy.bincount(placed%references, minlength=references)
+            if units.max() > 0:
+                return [reference for reference in range(references) if units[reference] >= FastqDownsampler.presenceShare*units.max()]
+        return list(range(references))
+
+    def units(self, groups):
+        #(group, index in group, [record of each mate]) over all slices of the pool
+        for group in sorted(groups):
+            for index, records in enumerate(FastqSlices.units(groups[group])):
+                yield group, index, records
+
+    def bases(records):
+        return sum(len(FastqSlices.sequence(record)) for record in records)
+
+    def run(self):
+        #Returns (reads, bases, estimated depth, reads kept, names of the pool's references), reads counting every mate
+        groups = FastqSlices.groups(self.fastqDir)
+        if not groups:
+            raise IOError("No slices in "+self.fastqDir)
+        units = self.units(groups)
+        head = list(itertools.islice(units, FastqDownsampler.estimateUnits))
+        if not head:
+            return 0, 0, 0.0, 0, []
+        pool = self.poolReferences(head)
+        names = [self.referenceLengths[reference][0] for reference in pool]
+        referenceLength = sum(self.referenceLengths[reference][1] for reference in pool)
+        basesPerUnit = float(sum(FastqDownsampler.bases(records) for group, index, records in head))/len(head)
+        keep = int(math.ceil(self.targetDepth*referenceLength/basesPerUnit))
+        #Reservoir sampling (Algorithm R)
+        reservoir = []
+        seen = 0
+        bases = 0
+        for unit in itertools.chain(head, units):
+            bases += FastqDownsampler.bases(unit[2])
+            if seen < keep:
+                reservoir.append(unit)
+            else:
+                slot = self.random.randint(0, seen)
+                if slot < keep:
+                    reservoir[slot] = unit
+            seen += 1
+        matesPerUnit = float(sum(len(records) for group, index, records in head))/len(head)
+        depth = float(bases)/referenceLength
+        if seen <= keep:
+            return int(seen*matesPerUnit), bases, depth, int(seen*matesPerUnit), names
+        self.write(groups, reservoir)
+        return int(seen*matesPerUnit), bases, depth, sum(len(records) for group, index, records in reservoir), names
+
+    def write(self, groups, reservoir):
+        #Kept reads are written back to the slice they were read from, so the slices still spread the
+        #alignment over the workers; a slice none of whose reads were kept is removed
+        #Everything is written to .tmp files first and moved over the slices before the empty ones
+        #are removed, so an interrupted run always leaves reads to align
+        kept = set(group for group, index, records in reservoir)
+        outputs = dict((group, [gzip.open(path+".tmp", 'wb', compresslevel=1) for path in groups[group]]) for group in kept)
+        try:
+            for group, index, records in sorted(reservoir, key=lambda unit: (unit[0], unit[1])):
+                for output, record in zip(outputs[group], records):
+                    output.write(record)
+        finally:
+            for files in outputs.values():
+                for output in files:
+                    output.close()
+        for group in kept:
+            for path in groups[group]:
+                os.replace(path+".tmp", path)
+        for group, paths in groups.items():
+            if group not in kept:
+                for path in paths:
+                    os.remove(path)
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("fastqDirs", nargs='+',
+            help="bwa_dir/fastq_dir folders of the pools to downsample")
+    parser.add_argument("--fasta", dest="fasta", required=True,
+            help="references.fasta of the run, with its samtools faidx index next to it")
+    parser.add_argument("--targetDepth", dest="targetDepth", type=float, required=True,
+            help="Mean coverage to downsample to")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+            help="Seed of the random sample, so a rerun keeps the same reads")
+    args = parser.parse_args()
+    referenceKmers = FastqDownsampler.referenceKmers(args.fasta)
+    referenceLengths = SamCoverage.referenceLengths(args.fasta+".fai")
+    for fastqDir in args.fastqDirs:
+        reads, bases, depth, kept, names = FastqDownsampler(fastqDir, referenceKmers, referenceLengths, args.targetDepth, args.seed).run()
+        print("%s: %d reads, %d bases of %s, estimated depth %.1fx, kept %d reads" % (fastqDir, reads, bases, ", ".join(names), depth, kept))
+        sys.stdout.flush()
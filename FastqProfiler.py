@@ -0,0 +1,102 @@
+import os, re, sys, glob, gzip
+import concurrent.futures
+from argparse import ArgumentParser
+
+class FastqProfiler():
+    #What beta_slice_fq.pl needs to know about the fastq.gz files of a pool, from one read of the
+    #start of each file instead of its separate empty check, guess_qual_format and
+    #fastq_single_or_paired.pl runs, plus the read count pipeline.py sizes slices by
+    # - the first sampleReads reads give the length distribution, interleaved pairing (the first
+    #   two reads have the same name) and the Phred offset (like guess_qual_format: 33 unless more
+    #   reads look like Illumina 1.5+ than have a quality below ';')
+    # - the read count is extrapolated from the compressed bytes the sample took, unless the sample
+    #   is the whole file
+    # - files are profiled on parallel threads; zlib releases the GIL, so they decompress at once
+    sampleReads = 100000
+    mateSuffix = re.compile(r'/[12]$')
+    secondMate = re.compile(r'_R2(_\d+\.f(ast)?q\.gz)$')
+    columns = ["fastqDir", "path", "reads", "minLength", "meanLength", "maxLength", "paired", "phredOffset"]
+
+    def fastqs(fastqDir):
+        #The files beta_slice_fq.pl slices
+        return sorted(glob.glob(os.path.join(fastqDir, "*fastq.gz"))+glob.glob(os.path.join(fastqDir, "*.fq.gz")))
+
+    def profile(path):
+        names = []
+        lengths = []
+        sangerReads = illuminaReads = 0
+        with open(path, 'rb') as raw:
+            with gzip.GzipFile(fileobj=raw) as f:
+                while len(lengths) < FastqProfiler.sampleReads:
+                    record = [f.readline() for line in range(4)]
+                    if not record[3]:
+                        break
+                    if len(names) < 2:
+                        names.append(FastqProfiler.mateSuffix.sub('', record[0].split()[0].decode()))
+                    lengths.append(len(record[1].rstrip()))
+                    quality = record[3].rstrip()
+                    if quality and min(quality) <= ord(':') and quality[0] != ord('+') and quality[-1] != ord('+'):
+                        sangerReads += 1
+                    elif quality and min(quality) > ord('A') and any(ord('M') <= c <= ord('m') for c in quality):
+                        illuminaReads += 1
+                complete = not f.read(1)
+            compressedBytes = raw.tell()
+        reads = len(lengths)
+        if not complete and compressedBytes:
+            reads = int(reads*os.path.getsize(path)/float(compressedBytes))
+        return {"path": os.path.realpath(path),
+                "reads": reads,
+                "minLength": min(lengths) if lengths else 0,
+                "meanLength": round(sum(lengths)/float(len(lengths)), 1) if lengths else 0,
+                "maxLength": max(lengths) if lengths else 0,
+                "paired": "paired" if len(names) == 2 and names[0] == names[1] else "single",
+                "phredOffset": 64 if illuminaReads > sangerReads else 33}
+
+    def write(profiles, outputPath):
+        #Tab separated, one line per file
+        with open(outputPath+".tmp", 'w') as f:
+            f.write("#"+"\t".join(FastqProfiler.columns)+"\n")
+            for profile in profiles:
+                f.write("\t".join(str(profile[column]) for column in FastqProfiler.columns)+"\n")
+        os.replace(outputPath+".tmp", outputPath)
+
+    def read(profilePath):
+        #Profiles written by write()
+        with open(profilePath) as f:
+            return [dict(zip(FastqProfiler.columns, line.rstrip("\n").split("\t"))) for line in f if not line.startswith("#")]
+
+    def sliceUnits(profiles):
+        #{fastqDir: reads beta_slice_fq.pl counts against -num}: -num is reads per file, so the R2 file of
+        #an R1/R2 pair is sliced alongside its R1 file and interleaved pairs count once
+        paths = set(profile["path"] for profile in profiles)
+        units = {}
+        for profile in profiles:
+            if FastqProfiler.secondMate.search(profile["path"]) and FastqProfiler.secondMate.sub(r'_R1\1', profile["path"]) in paths:
+                continue
+            reads = int(profile["reads"])
+            units[profile["fastqDir"]] = units.get(profile["fastqDir"], 0)+(reads//2 if profile["paired"] == "paired" else reads)
+        return units
+
+    def sliceReads(profiles, workers, minReads, maxReads):
+        #-num for beta_slice_fq.pl that gives the largest pool about one slice per alignment worker
+        largest = max(list(FastqProfiler.sliceUnits(profiles).values())+[0])
+        return min(maxReads, max(minReads, -(-largest//workers)))
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("fastqDirs", nargs='+',
+            help="fastq_dir folders of the pools to slice")
+    parser.add_argument("--output", dest="output", required=True,
+            help="Profile to write, for beta_slice_fq.pl -profile")
+    parser.add_argument("--threads", dest="threads", type=int, default=os.cpu_count(),
+            help="Files profiled at once")
+    args = parser.parse_args()
+    jobs = [(fastqDir, path) for fastqDir in args.fastqDirs for path in FastqProfiler.fastqs(fastqDir)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.threads)) as executor:
+        profiles = list(executor.map(FastqProfiler.profile, [path for fastqDir, path in jobs]))
+    for (fastqDir, path), profile in zip(jobs, profiles):
+        profile["fastqDir"] = fastqDir
+        print("%s: ~%d reads of %d-%d bp, %s, Phred+%d" % (path, profile["reads"], profile["minLength"], profile["maxLength"],
+                                                         profile["paired"], profile["phredOffset"]))
+    sys.stdout.flush()
+    FastqProfiler.write(profiles, args.output)
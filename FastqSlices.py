@@ -0,0 +1,47 @@
+import os, re, gzip, itertools
+
+class FastqSlices():
+    #The slices beta_slice_fq.pl writes into a pool's bwa_dir/fastq_dir, for the stages that rewrite
+    #them before alignment (KmerPrefilter.py, FastqDownsampler.py)
+    #Mates are kept together: R1/R2 slices of a MiSeq sample (se-..._R1_001@n, se-..._R2_001@n) and
+    #pe-....1@n/pe-....2@n are read in lockstep as one unit
+    sliceName = re.compile(r'^(?P<name>.+)@(?P<start>\d+)\.fq\.gz$')
+
+    def mate(name):
+        #(key shared by both mates, mate number) of a slice name without its @n.fq.gz
+        for pattern in (r'^(se-.+_R)([12])(_\d+)$', r'^(pe-.+\.)([12])()$'):
+            match = re.match(pattern, name)
+            if match:
+                return match.group(1)+"?"+match.group(3), int(match.group(2))
+        return name, 1
+
+    def groups(fastqDir):
+        #Slices as {(key, start): [mate 1 path, mate 2 path]} (one path for unpaired reads)
+        groups = {}
+        for filename in sorted(os.listdir(fastqDir)):
+            match = FastqSlices.sliceName.match(filename)
+            if not match:
+                continue
+            key, mateNumber = FastqSlices.mate(match.group('name'))
+            groups.setdefault((key, int(match.group('start'))), {})[mateNumber] = os.path.join(fastqDir, filename)
+        return dict((group, [mates[number] for number in sorted(mates)]) for group, mates in groups.items())
+
+    def records(path):
+        #FASTQ records of a gzipped file as 4-line byte strings
+        with gzip.open(path, 'rb') as f:
+            while True:
+                record = b''.join(itertools.islice(f, 4))
+                if not record:
+                    return
+                yield record
+
+    def units(paths):
+        #(record of each mate) of one slice
+        mates = [FastqSlices.records(path) for path in paths]
+        for records in itertools.zip_longest(*mates):
+            if None in records:
+                raise IOError("Mates of "+" and ".join(paths)+" have different numbers of reads")
+            yield records
+
+    def sequence(record):
+        return record.split(b'\n')[1]
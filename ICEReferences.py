@@ -0,0 +1,160 @@
+import os, json, ssl, shutil, fcntl, threading
+import urllib.request, urllib.error, http.client
+import concurrent.futures
+from contextlib import contextmanager
+
+class ICEError(Exception):
+    pass
+
+class ICEClient():
+    #REST client for ICE (same calls as login.sh and get-ss.rb)
+    #ICE usually runs with a self-signed certificate, so like curl -k the certificate isn't verified
+    timeout = 60 #Seconds per request
+
+    def __init__(self, host, sessionID=None, email=None, password=None):
+        self.host = host.rstrip("/")
+        self.sessionID = sessionID
+        self.email = email
+        self.password = password
+        self.loginLock = threading.Lock() #One login for all threads
+        self.context = ssl.create_default_context()
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+
+    def login(self):
+        reply = self.readJSON("/rest/accesstoken", json.dumps({'email': self.email, 'password': self.password}).encode(), authenticate=False)
+        try:
+            self.sessionID = reply['sessionId']
+        except (KeyError, TypeError):
+            raise ICEError("ICE login failed: no session ID in the reply")
+
+    def open(self, path, data=None, authenticate=True):
+        #Returns the response of a GET (POST if data is given) to path; the caller reads and closes it
+        if authenticate and self.sessionID is None and self.email:
+            with self.loginLock:
+                if self.sessionID is None:
+                    self.login()
+        request = urllib.request.Request(self.host+path, data=data)
+        request.add_header("Accept", "application/json" if data is not None else "*/*")
+        if data is not None:
+            request.add_header("Content-Type", "application/json")
+        if authenticate and self.sessionID:
+            request.add_header("X-ICE-Authentication-SessionId", self.sessionID)
+        try:
+            return urllib.request.urlopen(request, timeout=ICEClient.timeout, context=self.context)
+        except (urllib.error.URLError, OSError) as ex:
+            raise ICEError("ICE request "+path+" failed: "+str(ex))
+
+    def readJSON(self, path, data=None, authenticate=True):
+        #Like open, but returns the parsed reply; a cut off or malformed reply (e.g. a proxy's HTML page) raises ICEError
+        response = self.open(path, data, authenticate)
+        try:
+            return json.loads(response.read().decode())
+        except (OSError, http.client.HTTPException, ValueError) as ex:
+            raise ICEError("ICE request "+path+" returned an unreadable reply: "+str(ex))
+        finally:
+            response.close()
+
+    def modificationStamp(self, entryID):
+        #Changes whenever the entry (and so its sequence) is edited
+        part = self.readJSON("/rest/parts/"+entryID)
+        if not isinstance(part, dict) or not (part.get('modificationTime') or part.get('creationTime')):
+            raise ICEError("ICE entry "+entryID+" has no modification time")
+        return str(part.get('modificationTime') or part.get('creationTime'))
+
+    def fasta(self, entryID):
+        return self.open("/rest/file/"+entryID+"/sequence/fasta")
+
+class ICEReferenceCache():
+    #FASTA files of ICE entries, stored as <cacheFolder>/<entry ID>/<modification stamp>.fasta
+    #Only the latest stamp of an entry is kept
+
+    def __init__(self, cacheFolder):
+        self.cacheFolder = cacheFolder
+        os.makedirs(cacheFolder, exist_ok=True)
+
+    def pathFor(self, entryID, stamp):
+        return os.path.join(self.cacheFolder, entryID, stamp+".fasta")
+
+    @contextmanager
+    def entryLock(self, entryID):
+        #Serializes downloads of one entry between concurrent pipeline runs
+        folder = os.path.join(self.cacheFolder, entryID)
+        os.makedirs(folder, exist_ok=True)
+        with open(folder+".lock", 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield folder
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def lookup(self, entryID, stamp):
+        path = self.pathFor(entryID, stamp)
+        return path if os.path.isfile(path) else None
+
+    def store(self, entryID, stamp, response):
+        #Streams response into the cache and removes older stamps of the entry; returns the path
+        path = self.pathFor(entryID, stamp)
+        try:
+            with open(path+".part", 'wb') as f:
+                shutil.copyfileobj(response, f, 64*1024)
+            #Chunked reads just stop when the connection drops, so check against Content-Length
+            if getattr(response, "length", None):
+                raise http.client.IncompleteRead(b"", response.length)
+        except BaseException:
+            os.remove(path+".part")
+            raise
+        os.replace(path+".part", path)
+        for name in os.listdir(os.path.dirname(path)):
+            if name != os.path.basename(path):
+                os.remove(os.path.join(os.path.dirname(path), name))
+        return path
+
+class ICEReferenceFetcher():
+    #Fetches the FASTA of several ICE entries with at most maxParallel requests at a time, from
+    #the cache when the entry hasn't changed since, and writes them into one references.fasta
+    #in the order they were asked for, each as soon as it and the ones before it are there
+
+    def __init__(self, client, cache, maxParallel=4):
+        self.client = client
+        self.cache = cache
+        self.maxParallel = maxParallel
+
+    def fetch(self, entryID):
+        #Returns the path of the entry's cached FASTA, downloading it if it changed
+        stamp = self.client.modificationStamp(entryID)
+        with self.cache.entryLock(entryID):
+            path = self.cache.lookup(entryID, stamp)
+            if path is not None:
+                print("Using cached FASTA of ICE entry "+entryID)
+                return path
+            print("Downloading FASTA of ICE entry "+entryID)
+            response = self.client.fasta(entryID)
+            try:
+                return self.cache.store(entryID, stamp, response)
+            except (OSError, http.client.HTTPException) as ex:
+                raise ICEError("Downloading FASTA of ICE entry "+entryID+" failed: "+str(ex))
+            finally:
+                response.close()
+
+    def writeReferences(self, entryIDs, outputPath):
+        #Raises ICEError if an entry couldn't be fetched; outputPath is then left unwritten
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(entryIDs), self.maxParallel))) as pool:
+            futures = [pool.submit(self.fetch, entryID) for entryID in entryIDs]
+            try:
+                with open(outputPath+".part", 'wb') as output:
+                    for future in futures:
+                        with open(future.result(), 'rb') as fasta:
+                            shutil.copyfileobj(fasta, output, 64*1024)
+                            #Next entry's header must start on a line of its own
+                            if fasta.tell():
+                                fasta.seek(-1, os.SEEK_END)
+                                if fasta.read(1) != b"\n":
+                                    output.write(b"\n")
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                if os.path.exists(outputPath+".part"):
+                    os.remove(outputPath+".part")
+                raise
+        os.replace(outputPath+".part", outputPath)
@@ -0,0 +1,137 @@
+import os, sys, gzip, itertools, tempfile
+import concurrent.futures
+from argparse import ArgumentParser
+import numpy
+from FastqSlices import FastqSlices
+from ReferenceCache import ReferenceCache
+
+class KmerPrefilter():
+    #Drops reads that can't align to the references (mostly E. coli host reads of plasmid preps)
+    #from a pool's slices before beta_run_alignments.pl, so BWA and Picard only see the rest
+    # - k-mers are packed 2 bits per base into uint64 (k <= 32) and made canonical (the smaller of
+    #   the k-mer and its reverse complement), so reads of both strands match
+    # - the references' k-mers are kept as a sorted numpy array, saved next to references.fasta
+    #   (named by its content hash, so a changed FASTA gets a new one) and memory mapped by every
+    #   worker process
+    # - reads are encoded batchSize units at a time, and every k-mer of a batch is looked up at once
+    # - a unit (a read, or both mates of a pair) is kept if one of its reads shares at least
+    #   minKmers k-mers with the references
+    batchSize = 10000
+    codes = numpy.full(256, 4, dtype=numpy.uint8) #ASCII -> 0-3 for ACGT, 4 for anything else
+    codes[numpy.frombuffer(b'ACGTacgt', dtype=numpy.uint8)] = [0, 1, 2, 3, 0, 1, 2, 3]
+
+    def canonicalKmers(sequences, k):
+        #(k-mers, index of the sequence each comes from) of every window of k A/C/G/T bases
+        lengths = numpy.array([len(sequence) for sequence in sequences], dtype=numpy.int64)
+        if not len(sequences) or lengths.sum() < k:
+            return numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.int64)
+        encoded = KmerPrefilter.codes[numpy.frombuffer(b''.join(sequences), dtype=numpy.uint8)]
+        positions = len(encoded)-k+1
+        bases = numpy.minimum(encoded, 3).astype(numpy.uint64)
+        forward = numpy.zeros(positions, dtype=numpy.uint64)
+        reverse = numpy.zeros(positions, dtype=numpy.uint64)
+        for offset in range(k):
+            window = bases[offset:offset+positions]
+            forward = (forward << numpy.uint64(2)) | window
+            reverse |= (numpy.uint64(3)-window) << numpy.uint64(2*offset)
+        #Windows with an N, or running into the next sequence, don't count
+        invalid = numpy.concatenate(([0], numpy.cumsum(encoded == 4)))
+        valid = invalid[k:k+positions] == invalid[:positions]
+        ends = numpy.cumsum(lengths)
+        owner = numpy.repeat(numpy.arange(len(sequences)), lengths)[:positions]
+        valid &= numpy.arange(positions)+k <= ends[owner]
+        return numpy.minimum(forward, reverse)[valid], owner[valid]
+
+    def fastaSequences(fastaPath):
+        sequences = []
+        with open(fastaPath, 'rb') as f:
+            for line in f:
+                if line.startswith(b'>'):
+                    sequences.append([])
+                elif sequences:
+                    sequences[-1].append(line.strip())
+        return [b''.join(lines) for lines in sequences]
+
+    def buildIndex(fastaPath, k):
+        #Path of the .npy index of fastaPath's k-mers, built if it doesn't exist yet
+        indexPath = fastaPath+".k"+str(k)+"."+ReferenceCache.key(fastaPath)[:16]+".npy"
+        if not os.path.exists(indexPath):
+            kmers, owner = KmerPrefilter.canonicalKmers(KmerPrefilter.fastaSequences(fastaPath), k)
+            #Pools prefiltered at once may all build it; each writes its own temporary file
+            fd, tmpPath = tempfile.mkstemp(suffix=".tmp.npy", dir=os.path.dirname(os.path.abspath(indexPath)))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    numpy.save(f, numpy.unique(kmers))
+                os.replace(tmpPath, indexPath)
+            except BaseException:
+                os.remove(tmpPath)
+                raise
+        return indexPath
+
+    def __init__(self, indexPath, k, minKmers):
+        self.index = numpy.load(indexPath, mmap_mode='r')
+        self.k = k
+        self.minKmers = minKmers
+
+    def matches(self, sequences):
+        #Number of k-mers of each sequence found in the references
+        kmers, owner = KmerPrefilter.canonicalKmers(sequences, self.k)
+        if not len(self.index) or not len(kmers):
+            return numpy.zeros(len(sequences), dtype=numpy.int64)
+        slots = numpy.minimum(numpy.searchsorted(self.index, kmers), len(self.index)-1)
+        found = self.index[slots] == kmers
+        return numpy.bincount(owner[found], minlength=len(sequences))
+
+    def filterSlice(self, paths):
+        #Rewrites one slice (both mates) with the units to keep; returns (reads, reads kept)
+        outputs = [gzip.open(path+".tmp", 'wb', compresslevel=1) for path in paths]
+        reads = kept = 0
+        try:
+            units = FastqSlices.units(paths)
+            while True:
+                batch = list(itertools.islice(units, KmerPrefilter.batchSize))
+                if not batch:
+                    break
+                keep = numpy.zeros(len(batch), dtype=bool)
+                for mate in range(len(paths)):
+                    keep |= self.matches([FastqSlices.sequence(records[mate]) for records in batch]) >= self.minKmers
+                for records, keepUnit in zip(batch, keep):
+                    if keepUnit:
+                        for output, record in zip(outputs, records):
+                            output.write(record)
+                reads += len(batch)*len(paths)
+                kept += int(keep.sum())*len(paths)
+        finally:
+            for output in outputs:
+                output.close()
+        for path in paths:
+            os.replace(path+".tmp", path)
+        return reads, kept
+
+def filterSlice(indexPath, k, minKmers, paths):
+    #Entry point of the worker processes
+    return KmerPrefilter(indexPath, k, minKmers).filterSlice(paths)
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("fastqDirs", nargs='+',
+            help="bwa_dir/fastq_dir folders of the pools to filter")
+    parser.add_argument("--fasta", dest="fasta", required=True,
+            help="references.fasta of the run")
+    parser.add_argument("-k", dest="k", type=int, default=21,
+            help="k-mer length (at most 32)")
+    parser.add_argument("--minKmers", dest="minKmers", type=int, default=3,
+            help="k-mers a read must share with the references to be kept")
+    parser.add_argument("--processes", dest="processes", type=int, default=os.cpu_count(),
+            help="Slices filtered at once")
+    args = parser.parse_args()
+    indexPath = KmerPrefilter.buildIndex(args.fasta, args.k)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, args.processes)) as pool:
+        for fastqDir in args.fastqDirs:
+            groups = FastqSlices.groups(fastqDir)
+            results = [future.result() for future in
+                       [pool.submit(filterSlice, indexPath, args.k, args.minKmers, groups[group]) for group in sorted(groups)]]
+            reads = sum(result[0] for result in results)
+            kept = sum(result[1] for result in results)
+            print("%s: %d reads, kept %d, removed %.1f%%" % (fastqDir, reads, kept, 100.0*(reads-kept)/reads if reads else 0.0))
+            sys.stdout.flush()
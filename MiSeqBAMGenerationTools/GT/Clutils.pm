@@ -228,10 +228,16 @@ sub run_array_local {
       sleep 2;
     }
     # $log->info("executing ./$run_file_base.$task");
-    push @threads, threads->create(\&run_cmd_or_die, "./$run_file_base.$task");
+    # a die inside a thread only ends that thread, so it returns 1 when its task succeeded
+    push @threads, [ $task, threads->create( sub { run_cmd_or_die( $_[0] ); return( 1 ) }, "./$run_file_base.$task" ) ];
   }
+  my @failed = ();
   for my $thread( @threads ) {
-    $thread->join();
+    my ( $task, $thr ) = @$thread;
+    push @failed, $task unless ( $thr->join() );
+  }
+  if ( @failed ) {
+    log_and_die( "ERROR: tasks " . join( ',', @failed ) . " of $run_file_base failed" );
   }
   return( 1 );  # didn't die so returns true.
 }
@@ -18,6 +18,7 @@ my ( $help, $align_dir, $sge_project, $ref_file, $aln_args, $sge_args, $samXe_ar
 $DEBUG         = 0;
 $align_dir     = 'bwa_dir';
 $bwa_algorithm = 'mem';
+my $parallel   = 1;    # slices of a pool aligned at once
 
 $do_analysis_task_stuff = 0;
 
@@ -47,6 +48,7 @@ GetOptions(
 	'at'                       => \$do_analysis_task_stuff,
 	'weird_fq_name'            => \$no_db_for_rg,
 	'reseqbindir=s'            	=> \$reseq_bin_dir,
+	'parallel=i'               => \$parallel,
 	'DEBUG'                    => \$DEBUG,
 	'help'                     => \$help,
 );
@@ -72,6 +74,7 @@ e.g. $bin -algo backtrack -modules -c libs.inf  \# backtrack (aln + sampe/samse)
  -ref            FILE.fa  if no dir/base/config.yml, reference file to align against
                           must be already be indexed by bwa
  -v                       verbose, print more and ask run_bwa to print more
+ -parallel       INT      slices of a pool aligned at once by run_bwa ( 1 )
 EOH
 }
 
@@ -286,7 +289,7 @@ for my $dir ( grep { -d } uniq @dir_list ) {
 	my $sge_args_opt = defined $sge_args ? "-sge-args \'$sge_args\'" : '';
 	my @hold_jids    = ();
 
-	my $run_bwa_path_to_tools = "-picard_path ".$picard_path." -samtools_path ".$samtools_path." -bwa_path ".$bwa_path;
+	my $run_bwa_path_to_tools = "-picard_path ".$picard_path." -samtools_path ".$samtools_path." -bwa_path ".$bwa_path." -parallel ".$parallel;
 
 	if (@seRGs) {
 		my $out = $mixed ? "$pinfo.single-end" : $pinfo;
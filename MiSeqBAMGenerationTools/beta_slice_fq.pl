@@ -11,11 +11,12 @@ umask 2;
 
 #Location of fastq_slice, guess_qual_format, and fastq_single_or_paired command-line commands
 
-my ( $base_dir, $fastq_dir, $fqsource_dir, $sge_project_opt, $config_file, $mainlib_dir, $reseq_bin_dir);
+my ( $base_dir, $fastq_dir, $fqsource_dir, $sge_project_opt, $config_file, $mainlib_dir, $reseq_bin_dir, $profile_file);
 
 $base_dir     = 'bwa_dir';
 $fastq_dir    = 'fastq_dir';    # in base_dir
 $fqsource_dir = 'fastq_dir';    # in dir
+my $num       = 8000000;        # reads per slice
 
 my $help;
 
@@ -26,6 +27,8 @@ GetOptions(
 	'config=s'          => \$config_file,
 	'mainlibdir=s'		=> \$mainlib_dir, #Absolute path to main Library directory
 	'reseqbindir=s'		=> \$reseq_bin_dir,
+	'num=i'             => \$num,
+	'profile=s'         => \$profile_file, #FastqProfiler.py output
 	'help'              => \$help,
 );
 
@@ -44,6 +47,8 @@ if ( $help || !defined $base_dir || ! @dir_list ) {
 	print STDERR " -P       STRING      sge accounting project name for qsub\n";
 	print STDERR " -config  FILE        config file ( libr.info format )\n";
 	print STDERR " -mainlibdir FILE     absolute path to main Library directory\n";
+	print STDERR " -num     INT         reads per slice ( $num )\n";
+	print STDERR " -profile FILE        FastqProfiler.py output, replaces the empty, quality format and pairing checks\n";
 	print STDERR "\n";
 
 	exit;
@@ -58,6 +63,20 @@ my $script = "run_slice_${$}";
 #print "dir_list is @dir_list\n";
 
 @dir_list     = grep { -d $_ } @dir_list;
+
+# read count, pairing and phred offset of each fastq, by real path
+my %profile = ();
+if ( $profile_file ) {
+	open( my $pfh, $profile_file ) or die "can't open $profile_file $!";
+	while (<$pfh>) {
+		next if ( /^#/ );
+		chomp;
+		my ( $fq_dir, $path, $reads, $min_length, $mean_length, $max_length, $paired, $phred_offset ) = split /\t/;
+		$profile{ $path } = { reads => $reads, paired => $paired, phred_offset => $phred_offset };
+	}
+	close($pfh);
+}
+
 my %dreads    = ();
 my %bad_links = ();
 
@@ -120,45 +139,61 @@ for my $dir ( sort keys %dreads ) {
 			$type = 'single';
 		}
 
+		my $profiled = $profile{ Cwd::abs_path($read) };
+
 		# check for empty fastq
-		zopen( my $fh, $read );
 		my $has_a_read = 0;
-		while (<$fh>) {
-			$has_a_read++;
-			last if ( $has_a_read >= 3 );
+		if ( $profiled ) {
+			$has_a_read = $profiled->{reads};
+		}
+		else {
+			zopen( my $fh, $read );
+			while (<$fh>) {
+				$has_a_read++;
+				last if ( $has_a_read >= 3 );
+			}
+			close($fh);
 		}
-		close($fh);
 		if ( !$has_a_read ) {
 			warn "$dir has empty fastq $read, skipping";
 			next;
 		}
-		my $guess = `$reseq_bin_dir/guess_qual_format $read`;
-		chomp $guess;
+		my $guess;
+		if ( $profiled ) {
+			$guess = $profiled->{phred_offset} == 33 ? 'sanger' : 'solexa';
+		}
+		else {
+			$guess = `$reseq_bin_dir/guess_qual_format $read`;
+			chomp $guess;
+		}
 		my $illoption = $guess eq 'sanger' ? '' : ' -ill2std ';
 		my $cmd;
 		if ( defined $type && $type eq 'paired' ) {
 			print STDERR "type is paired\n";
 			my $prefix = "$mainlib_dir/$dir/$base_dir/$fastq_dir/$bname";
-			$cmd = "perl $reseq_bin_dir/fastq_slice.pl -verbose -gzip -num 8000000 $illoption -suffix fq -file $read -prefix $prefix";
+			$cmd = "perl $reseq_bin_dir/fastq_slice.pl -verbose -gzip -num $num $illoption -suffix fq -file $read -prefix $prefix";
 		}
 		elsif ( defined $type && $type eq 'single' ) {
 			print STDERR "type is single end\n";
 			my $prefix = "$mainlib_dir/$dir/$base_dir/$fastq_dir/$bname";
-			$cmd = "perl $reseq_bin_dir/fastq_slice.pl -verbose -gzip -num 8000000 $illoption -suffix fq -file $read -prefix $prefix";
+			$cmd = "perl $reseq_bin_dir/fastq_slice.pl -verbose -gzip -num $num $illoption -suffix fq -file $read -prefix $prefix";
 		}
 		else {  # DEFAULT CASE, above could probably be removed as it's remnant from the maq->bwa switchover
+			if ( !defined $type && $profiled ) {
+				$type = $profiled->{paired};
+			}
 			if ( !defined $type ) {
 				($type) = split /\s+/, run_bt_or_die( "perl $reseq_bin_dir/fastq_single_or_paired.pl $read" );
 			}
 			if ( $type eq 'paired' ) {
 				my $prefix = "$mainlib_dir/$dir/$base_dir/$fastq_dir/pe-$bname";
 				# $prefix .= "perl $barcode" if ( $barcode );
-				$cmd = "perl $reseq_bin_dir/fastq_slice.pl -verbose -split -gzip -num 8000000 $illoption -suffix fq -file $read -prefix $prefix";
+				$cmd = "perl $reseq_bin_dir/fastq_slice.pl -verbose -split -gzip -num $num $illoption -suffix fq -file $read -prefix $prefix";
 			}
 			elsif ( $type eq 'single' ) {
 				my $prefix = "$mainlib_dir/$dir/$base_dir/$fastq_dir/se-$bname";
 				# $prefix .= "perl $barcode" if ( $barcode );
-				$cmd = "perl $reseq_bin_dir/fastq_slice.pl -verbose -gzip -num 8000000 $illoption -suffix fq -file $read -prefix $prefix";
+				$cmd = "perl $reseq_bin_dir/fastq_slice.pl -verbose -gzip -num $num $illoption -suffix fq -file $read -prefix $prefix";
 			}
 			else {
 				warn "WARNING: skipping read $read don't understand what type it is $!";
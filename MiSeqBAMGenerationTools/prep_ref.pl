@@ -183,7 +183,7 @@ if ( $do_dict  && ( $dict_name =~ s/.fa$// || $dict_name =~ s/.fasta$// ) ) {
 
 
 	$cmd = "java -jar $picard_path/picard.jar CreateSequenceDictionary R=$ref_file_out O=$dict_name > /dev/null";
-	system( $cmd ) && warn "ERROR: $cmd failed $!";
+	system( $cmd ) && die "ERROR: $cmd failed $!";
 }
 else {
 	print STDERR "skipping picard .dict creation ( requires ref to end in .fa or possibly .fasta )\n";
@@ -193,7 +193,7 @@ if ( $do_bwa_index ) {
 	print "\nindexing with bwa -path $bwa_path \n";
   $cmd = "$bwa_path/bwa index $ref_file_out";
 
-	system( $cmd ) 
+	system( $cmd ) && die "ERROR: $cmd failed $!";
 }
 if ( $bases_converted ) {
   my $bases = $bases_converted == 1 ? 'base' : 'bases';
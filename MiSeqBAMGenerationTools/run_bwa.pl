@@ -26,7 +26,7 @@ $|=1;
 my ( $ref_fasta, @read1, @read2, @read_group_string, $reuse_rg, $out_bam, $help, $mem_in_g, $threads, 
 	$picard_path, $bwa_path, $samtools_path, 
      $args_samse, $args_sampe, $args_aln, $args_mem, $args_sge, $sleep_time, $sge_project,
-	   $algorithm, $verbose );
+	   $algorithm, $verbose, $parallel );
 
 $mem_in_g       = 5;
 $threads        = 4;     # default to 4 as cluster is annoying to schedule 8 thread anything on
@@ -36,6 +36,7 @@ $args_aln       = '';
 $args_sge       = '';
 $sleep_time     = 10;
 $algorithm      = 'backtrack';
+$parallel       = 1;     # slices aligned at once ( mem )
 
 #Location of Picard, BWA, and samtools commands
 $picard_path = "";
@@ -64,6 +65,7 @@ GetOptions(
   'sampe-args'  => \$args_sampe,
   'mem-args'    => \$args_mem,
   'algorithm=s' => \$algorithm,
+  'parallel=i'  => \$parallel,
 
 ) or die;
 
@@ -86,6 +88,7 @@ sub usage {
   print " -sge-args      STRING   args for sge e.g. -sge-args \"-l high.c\" ***USE THEM QUOTES***\n";
   print " -P             STRING   sge project ( e.g. jgi.p )\n";
   print " -sleep         INT      ( for testing, seconds to sleep between file stats )\n";
+  print " -parallel      INT      slices aligned at once with -algorithm mem ( $parallel )\n";
   print "\n";
 	exit;
 }
@@ -182,9 +185,15 @@ sub mem {
 	
 	print STDERR "\nCMD: $cmd\n" if $verbose;
 
-	my $mem_jid = run_or_die($cmd);
-	chomp $mem_jid;
-	( $mem_jid ) = split /[.]/, $mem_jid;
+	my $mem_jid = '';
+	if ( $parallel > 1 ) {
+		run_array_local( "$mem_script.sh", $parallel );
+	}
+	else {
+		$mem_jid = run_or_die($cmd);
+		chomp $mem_jid;
+		( $mem_jid ) = split /[.]/, $mem_jid;
+	}
 
 	my $last_jid = merge_and_index( $out_bam, $mem_jid, @bams );	
 
@@ -376,6 +385,7 @@ sub setup_mem_reads {
 
 	$ob = "bam_dir/$ob";
 	if ( -e "$ob.DONE" ) { unlink "$ob.DONE" }
+	if ( -e "$ob.done.bam" ) { unlink "$ob.done.bam" }
 
 	my @mem_cmds = ();
 
@@ -393,6 +403,8 @@ sub setup_mem_reads {
 		push @mem_cmds, picard_sc_string( $MEM_P_VALUE, "$ob.bam", "$ob.sc.bam", $MAX_RECORDS );
     push @mem_cmds, picard_md_string( $MEM_P_VALUE, "$ob.sc.bam", "$ob.bam", $MAX_RECORDS ) . " && rm $ob.sc.bam";
   }
+	# finished slice for SliceCoverage.py, still there after merge_and_index removes $ob.bam
+	push @mem_cmds, "ln -f $ob.bam $ob.done.bam";
 
 	write_array_cmds( \@mem_cmds, $mem_i++, $mem_script );
 	$mem_i_ref++;
@@ -420,6 +432,7 @@ sub setup_aln_backtrack_reads {
   if ( -e "$name1.sai.log.DONE" ) { unlink "$name1.sai.log.DONE" }
   if ( $name2 && -e "$name2.sai.log.DONE" ) { unlink "$name1.sai.log.DONE" }
   if ( -e "$ob.DONE" ) { unlink "$ob.DONE" } 
+  if ( -e "$ob.done.bam" ) { unlink "$ob.done.bam" }
 
 	my @aln_cmds = ();
 	push @aln_cmds,  align_cmd( $r1, $name1, $ref_fasta, $threads, $args_aln );
@@ -454,6 +467,8 @@ sub setup_aln_backtrack_reads {
   else {
 		push @samXe_cmds, picard_md_string( $MEM_P_VALUE, "$ob.bam", "$ob.md.bam", $MAX_RECORDS ) . " AS=true && rm $ob.bam && mv $ob.md.bam $ob.bam";
   }
+	# finished slice for SliceCoverage.py, still there after merge_and_index removes $ob.bam
+	push @samXe_cmds, "ln -f $ob.bam $ob.done.bam";
 
   write_array_cmds( \@samXe_cmds, $samXe_i, $samXe_script );
 
@@ -0,0 +1,182 @@
+import os, json, time, fcntl
+from contextlib import contextmanager
+
+class MiSeqDataCache():
+    #Local cache of MiSeq fastq.gz files, stored as <cacheFolder>/<run folder>/<filename>
+    #An entry is valid only for the remote size and mtime it was downloaded with, so a
+    #re-demultiplexed run is fetched again. Least recently used entries are evicted once
+    #the cache grows past quotaBytes.
+    # - .part files of downloads in progress or interrupted count against the quota; one nobody is
+    #   downloading into and that hasn't changed for partLifetime seconds is removed
+    # - reflinked entries (see MiSeqServerData.ingestFromMount) share their data with the mounted
+    #   share, so they don't count against the quota and aren't evicted to make room
+    indexName = "cache_index.json"
+    lockName = "cache_index.lock"
+    partLifetime = 24*3600
+
+    def __init__(self, cacheFolder, quotaBytes):
+        self.cacheFolder = cacheFolder
+        self.quotaBytes = quotaBytes
+        self.indexPath = os.path.join(cacheFolder, MiSeqDataCache.indexName)
+        self.lockPath = os.path.join(cacheFolder, MiSeqDataCache.lockName)
+        os.makedirs(cacheFolder, exist_ok=True)
+
+    def key(run, filename):
+        return run+"/"+filename
+
+    def pathFor(self, run, filename):
+        return os.path.join(self.cacheFolder, run, filename)
+
+    @contextmanager
+    def locked(self):
+        #Holds the index lock and yields the index; changes are written back atomically
+        with open(self.lockPath, 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                index = self.readIndex()
+                before = json.dumps(index, sort_keys=True)
+                yield index
+                if json.dumps(index, sort_keys=True) != before:
+                    self.writeIndex(index)
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def readIndex(self):
+        try:
+            with open(self.indexPath) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def writeIndex(self, index):
+        tmpPath = self.indexPath+".tmp"
+        with open(tmpPath, 'w') as f:
+            json.dump(index, f, sort_keys=True, indent=1)
+        os.replace(tmpPath, self.indexPath)
+
+    @contextmanager
+    def fileLock(self, run, filename):
+        #Serializes downloads of one file between concurrent pipeline runs
+        path = self.pathFor(run, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path+".lock", 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield path
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    @contextmanager
+    def tryFileLock(self, path):
+        #Takes the file lock of path without waiting; yields False if another process holds it
+        try:
+            lockFile = open(path+".lock", 'a')
+        except FileNotFoundError:
+            yield True #Run folder is already gone
+            return
+        with lockFile:
+            try:
+                fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def lookup(self, run, filename, size, mtime):
+        #Returns the local path if a valid copy is cached (and marks it as recently used), else None
+        with self.locked() as index:
+            entry = index.get(MiSeqDataCache.key(run, filename))
+            if entry is None:
+                return None
+            path = self.pathFor(run, filename)
+            if entry['size'] != size or entry['mtime'] != mtime or not os.path.exists(path) or os.path.getsize(path) != size:
+                del index[MiSeqDataCache.key(run, filename)]
+                return None
+            entry['lastUsed'] = time.time()
+            return path
+
+    def add(self, run, filename, size, mtime, md5, reflinked=False):
+        #Records a freshly downloaded (or reflinked) file and evicts older entries to stay under quota
+        with self.locked() as index:
+            index[MiSeqDataCache.key(run, filename)] = {'size': size, 'mtime': mtime, 'md5': md5, 'lastUsed': time.time(),
+                                                        'reflinked': reflinked}
+            self.evict(index, 0, run)
+
+    def discard(self, run, filename, unusedSince):
+        #Removes a file nobody has looked up since unusedSince (e.g. an unused speculative download)
+        #Returns True if it was removed
+        with self.locked() as index:
+            entry = index.get(MiSeqDataCache.key(run, filename))
+            if entry is None or entry['lastUsed'] > unusedSince:
+                return False
+            path = self.pathFor(run, filename)
+            for stale in (path, path+".md5"):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            del index[MiSeqDataCache.key(run, filename)]
+            return True
+
+    def reserve(self, run, neededBytes):
+        #Makes room for a download of neededBytes from run before it starts
+        with self.locked() as index:
+            self.evict(index, neededBytes, run)
+
+    def partFiles(self):
+        #(run, path) of every .part file in the cache
+        for run in os.listdir(self.cacheFolder):
+            runFolder = os.path.join(self.cacheFolder, run)
+            if os.path.isdir(runFolder):
+                for filename in os.listdir(runFolder):
+                    if filename.endswith(".part"):
+                        yield run, os.path.join(runFolder, filename)
+
+    def partBytes(self, keepRun):
+        #Bytes of .part files other than keepRun's, after removing stale ones
+        #keepRun's are left out since the download they belong to is already in neededBytes
+        used = 0
+        for run, partPath in list(self.partFiles()):
+            if run == keepRun:
+                continue
+            try:
+                size = os.path.getsize(partPath)
+                modified = os.path.getmtime(partPath)
+            except OSError:
+                continue #Finished or removed meanwhile
+            if time.time() - modified > MiSeqDataCache.partLifetime:
+                with self.tryFileLock(partPath[:-len(".part")]) as acquired:
+                    if acquired and os.path.exists(partPath):
+                        os.remove(partPath)
+                        print("Removed stale "+run+"/"+os.path.basename(partPath)+" from fastq cache")
+                        continue
+            used += size
+        return used
+
+    def evict(self, index, neededBytes, keepRun):
+        #Removes least recently used entries until neededBytes more fit in the quota
+        #Files of keepRun are never evicted, since the pipeline being served is about to use them
+        if not self.quotaBytes:
+            return
+        used = sum(entry['size'] for entry in index.values() if not entry.get('reflinked'))+self.partBytes(keepRun)
+        for key in sorted(index, key=lambda k: index[k]['lastUsed']):
+            if used + neededBytes <= self.quotaBytes:
+                break
+            if key.startswith(keepRun+"/") or index[key].get('reflinked'):
+                continue
+            run, filename = key.split("/", 1)
+            path = self.pathFor(run, filename)
+            with self.tryFileLock(path) as acquired:
+                if not acquired:
+                    continue #Another pipeline is downloading or linking this file right now
+                for stale in (path, path+".md5"):
+                    if os.path.exists(stale):
+                        os.remove(stale)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass #Run folder still holds other files
+            used -= index[key]['size']
+            del index[key]
+            print("Evicted "+key+" from fastq cache")
@@ -0,0 +1,237 @@
+import os, io, csv, json, time, fcntl, bisect
+
+class SubstringIndex():
+    #In-memory index for case-insensitive autocomplete queries: prefix matches come from a
+    #binary search of the sorted names, other substring matches from the posting sets of the
+    #query's n-grams, so a keystroke never scans every name
+
+    gramLength = 3
+
+    def __init__(self, names):
+        self.names = sorted(set(names))
+        self.lowered = sorted((name.lower(), name) for name in self.names)
+        self.grams = {}
+        for name in self.names:
+            lowered = name.lower()
+            for n in range(1, SubstringIndex.gramLength+1):
+                for i in range(len(lowered)-n+1):
+                    self.grams.setdefault(lowered[i:i+n], set()).add(name)
+
+    def prefixed(self, query):
+        start = bisect.bisect_left(self.lowered, (query,))
+        matches = []
+        for lowered, name in self.lowered[start:]:
+            if not lowered.startswith(query):
+                break
+            matches.append(name)
+        return matches
+
+    def search(self, query):
+        #Names containing query, prefix matches first, each group sorted
+        query = query.lower()
+        if not query:
+            return list(self.names)
+        n = min(len(query), SubstringIndex.gramLength)
+        postings = []
+        for i in range(len(query)-n+1):
+            posting = self.grams.get(query[i:i+n])
+            if not posting:
+                return []
+            postings.append(posting)
+        postings.sort(key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        prefixed = self.prefixed(query)
+        others = set(name for name in candidates if query in name.lower()) - set(prefixed)
+        return prefixed + sorted(others)
+
+class MiSeqRunIndex():
+    #Local index of the runs in //smb.jbei.org/miseq/MiSeqOutput, shared by the website and pipeline.py
+    #For every run folder it keeps the folder mtime, whether the run is complete, the sample IDs of
+    #SampleSheet.csv's [Data] section and the name, size and mtime of every BaseCalls fastq.gz.
+    #A refresh lists MiSeqOutput once and only looks inside runs that changed or are still running.
+    sharedFolder = "miseq"
+    runsFolder = "/MiSeqOutput"
+    completionMarker = "CompletedJobInfo.xml" #Written by MiSeq Reporter once the fastq.gz files are done
+    settleAfter = 7*24*3600 #Seconds after which an unfinished (e.g. aborted) run is no longer rescanned
+    indexName = "run_index.json"
+    lockName = "run_index.lock"
+
+    def __init__(self, indexFolder):
+        self.indexPath = os.path.join(indexFolder, MiSeqRunIndex.indexName)
+        self.lockPath = os.path.join(indexFolder, MiSeqRunIndex.lockName)
+        os.makedirs(indexFolder, exist_ok=True)
+        self.index = {'refreshed': 0, 'runs': {}}
+        self.indexMtime = None
+        self.runNames = None #SubstringIndex of run folders, rebuilt when the index file changes
+        self.sampleNames = {} #Run folder -> (sampleSheetMtime, SubstringIndex of its sample IDs)
+
+    def load(self):
+        #Re-reads the index file only when another process has replaced it
+        try:
+            mtime = os.path.getmtime(self.indexPath)
+        except OSError:
+            return self.index
+        if mtime != self.indexMtime:
+            with open(self.indexPath) as f:
+                self.index = json.load(f)
+            self.indexMtime = mtime
+            self.runNames = None
+        return self.index
+
+    def save(self):
+        tmpPath = self.indexPath+".tmp"
+        with open(tmpPath, 'w') as f:
+            json.dump(self.index, f, sort_keys=True)
+        os.replace(tmpPath, self.indexPath)
+        self.indexMtime = os.path.getmtime(self.indexPath)
+        self.runNames = None
+
+    def isStale(self, maxAge):
+        return time.time() - self.load()['refreshed'] > maxAge
+
+    def refresh(self, conn, maxAge=0):
+        #Brings the index up to date unless it was refreshed in the last maxAge seconds
+        #The lock makes concurrent callers wait for one refresh instead of all hitting SMB
+        if not self.isStale(maxAge):
+            return False
+        with open(self.lockPath, 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                if not self.isStale(maxAge):
+                    return False
+                runs = self.index['runs']
+                listed = set()
+                for f in conn.listPath(MiSeqRunIndex.sharedFolder, MiSeqRunIndex.runsFolder):
+                    #Ignore .DS_Store, . and ..
+                    if f.filename.startswith(".") or not f.isDirectory:
+                        continue
+                    listed.add(f.filename)
+                    run = runs.get(f.filename)
+                    settled = run is not None and (run['complete'] or time.time() - f.last_write_time > MiSeqRunIndex.settleAfter)
+                    if run is None or run['mtime'] != f.last_write_time or not settled:
+                        runs[f.filename] = self.scanRun(conn, f.filename, f.last_write_time, run)
+                for folder in set(runs) - listed:
+                    del runs[folder]
+                self.index['refreshed'] = time.time()
+                self.save()
+                return True
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def refreshRun(self, conn, folder):
+        #Rescans a single run folder, e.g. right before pipeline.py downloads from it
+        with open(self.lockPath, 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                self.load()
+                attributes = conn.getAttributes(MiSeqRunIndex.sharedFolder, MiSeqRunIndex.runsFolder+"/"+folder)
+                self.index['runs'][folder] = self.scanRun(conn, folder, attributes.last_write_time, None)
+                self.save()
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+        return self.index['runs'][folder]
+
+    def refreshRunIfStale(self, conn, folder, ttl):
+        #Rechecks one run at most every ttl seconds: a complete run whose folder mtime is unchanged
+        #costs one getAttributes call, otherwise it is rescanned (see scanRun for what gets reused)
+        run = self.run(folder)
+        if run is not None and time.time() - run.get('checked', 0) <= ttl:
+            return run
+        with open(self.lockPath, 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                run = self.load()['runs'].get(folder)
+                if run is not None and time.time() - run.get('checked', 0) <= ttl:
+                    return run
+                attributes = conn.getAttributes(MiSeqRunIndex.sharedFolder, MiSeqRunIndex.runsFolder+"/"+folder)
+                if run is not None and run['complete'] and run['mtime'] == attributes.last_write_time:
+                    run['checked'] = time.time()
+                else:
+                    run = self.scanRun(conn, folder, attributes.last_write_time, run)
+                    self.index['runs'][folder] = run
+                self.save()
+                return run
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def scanRun(self, conn, folder, mtime, previous):
+        #Builds the entry for one run, reusing what is still valid in its previous entry
+        previous = previous or {}
+        runPath = MiSeqRunIndex.runsFolder+"/"+folder
+        entry = {'mtime': mtime, 'complete': False, 'checked': time.time(),
+                 'sampleSheetMtime': None, 'sampleIDs': [],
+                 'baseCallsMtime': None, 'fastqs': {}}
+        for f in conn.listPath(MiSeqRunIndex.sharedFolder, runPath):
+            if f.filename == MiSeqRunIndex.completionMarker:
+                entry['complete'] = True
+            elif f.filename == "SampleSheet.csv":
+                entry['sampleSheetMtime'] = f.last_write_time
+        if entry['sampleSheetMtime'] is not None:
+            if entry['sampleSheetMtime'] == previous.get('sampleSheetMtime'):
+                entry['sampleIDs'] = previous['sampleIDs']
+            else:
+                entry['sampleIDs'] = self.readSampleIDs(conn, runPath+"/SampleSheet.csv")
+        try:
+            baseCalls = conn.getAttributes(MiSeqRunIndex.sharedFolder, runPath+"/Data/Intensities/BaseCalls")
+        except Exception:
+            return entry #No BaseCalls yet
+        entry['baseCallsMtime'] = baseCalls.last_write_time
+        if baseCalls.last_write_time == previous.get('baseCallsMtime'):
+            entry['fastqs'] = previous['fastqs']
+        else:
+            for f in conn.listPath(MiSeqRunIndex.sharedFolder, runPath+"/Data/Intensities/BaseCalls", pattern="*.fastq.gz"):
+                entry['fastqs'][f.filename] = {'size': f.file_size, 'mtime': f.last_write_time}
+        return entry
+
+    def readSampleIDs(self, conn, path):
+        sampleSheet = io.BytesIO()
+        conn.retrieveFile(MiSeqRunIndex.sharedFolder, path, sampleSheet)
+        return MiSeqRunIndex.parseSampleIDs(sampleSheet.getvalue().decode('utf-8', 'replace'))
+
+    def parseSampleIDs(contents):
+        #Sample_ID is the first column of the [Data] section, which starts with a header line
+        lines = contents.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        sampleIDs = []
+        inData = False
+        header = None
+        for row in csv.reader(lines):
+            if row and row[0].startswith("["):
+                inData = row[0].startswith("[Data]")
+                continue
+            if not inData or not row or not row[0].strip():
+                continue
+            if header is None:
+                header = row
+                continue
+            sampleIDs.append(row[0].strip())
+        return sampleIDs
+
+    #
+    # Queries, answered from the local index without touching SMB
+    #
+
+    def runs(self, query=""):
+        runs = self.load()['runs']
+        if self.runNames is None:
+            self.runNames = SubstringIndex(runs)
+        return self.runNames.search(query)
+
+    def run(self, folder):
+        return self.load()['runs'].get(folder)
+
+    def sampleIDs(self, folder, query=""):
+        run = self.run(folder)
+        if run is None:
+            return []
+        cached = self.sampleNames.get(folder)
+        if cached is None or cached[0] != run['sampleSheetMtime']:
+            cached = (run['sampleSheetMtime'], SubstringIndex(run['sampleIDs']))
+            self.sampleNames[folder] = cached
+        return cached[1].search(query)
+
+    def fastqs(self, folder):
+        #Returns [(filename, size, mtime)] of the run's BaseCalls fastq.gz files
+        run = self.run(folder)
+        if run is None:
+            return []
+        return sorted((name, f['size'], f['mtime']) for name, f in run['fastqs'].items())
@@ -0,0 +1,87 @@
+import os, json, time, subprocess
+
+class PipelineCheckpoints():
+    #Markers in <main library>/.checkpoints/ recording which stages of pipeline.py (and which samples
+    #of per-sample stages) finished with complete outputs, so an interrupted run can be resumed
+    #A marker is written atomically only after its stage succeeded; stages are ordered, and
+    #invalidating one also invalidates every later stage since they consume its outputs
+    stages = ["download", "references", "prep_ref", "setup_dirs", "slice", "prefilter", "downsample", "align", "postprocess"]
+    folderName = ".checkpoints"
+    inputsName = "inputs.json"
+
+    def __init__(self, mainLibraryFolder):
+        self.folder = os.path.join(mainLibraryFolder, PipelineCheckpoints.folderName)
+        os.makedirs(self.folder, exist_ok=True)
+
+    def markerPath(self, stage, sample=None):
+        return os.path.join(self.folder, stage+("@"+sample if sample else "")+".done")
+
+    def writeAtomically(path, contents):
+        #Written to a temporary file, flushed to disk and renamed, so a marker is never seen half written
+        with open(path+".tmp", 'w') as f:
+            json.dump(contents, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path+".tmp", path)
+        directory = os.open(os.path.dirname(path), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def isDone(self, stage, sample=None):
+        return self.get(stage, sample) is not None
+
+    def get(self, stage, sample=None):
+        #Details stored with the marker, or None if the stage (for sample) hasn't completed
+        try:
+            with open(self.markerPath(stage, sample)) as f:
+                return json.load(f)['details']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def markDone(self, stage, sample=None, details=None):
+        PipelineCheckpoints.writeAtomically(self.markerPath(stage, sample),
+            {'stage': stage, 'sample': sample, 'finished': time.time(), 'details': details or {}})
+
+    def invalidate(self, stage):
+        #Removes the markers of stage, all of its samples, and of every later stage
+        later = PipelineCheckpoints.stages[PipelineCheckpoints.stages.index(stage):]
+        for name in os.listdir(self.folder):
+            if name.endswith(".done") and name[:-len(".done")].split("@")[0] in later:
+                os.remove(os.path.join(self.folder, name))
+
+    def firstIncomplete(self):
+        #First stage without a marker (per-sample stages only count as complete through their markers)
+        for stage in PipelineCheckpoints.stages:
+            if not self.isDone(stage):
+                return stage
+        return None
+
+    def checkInputs(self, inputs):
+        #Records the run's inputs; returns False (after invalidating everything past the per-sample
+        #downloads) if the previous run of this folder had different ones
+        path = os.path.join(self.folder, PipelineCheckpoints.inputsName)
+        try:
+            with open(path) as f:
+                previous = json.load(f)
+        except (IOError, ValueError):
+            previous = None
+        if previous == inputs:
+            return True
+        if previous is not None:
+            self.invalidate("references")
+            for name in os.listdir(self.folder):
+                if name == "download.done":
+                    os.remove(os.path.join(self.folder, name))
+        PipelineCheckpoints.writeAtomically(path, inputs)
+        return previous is None
+
+    def discard(folder):
+        #Moves folder aside and deletes it in the background, so a fresh run doesn't wait for rm -rf
+        #of a large alignment tree; returns the path it was moved to
+        trash = folder.rstrip("/")+".deleting."+str(int(time.time()*1000))
+        os.rename(folder, trash)
+        subprocess.Popen(["rm", "-rf", trash], stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True)
+        return trash
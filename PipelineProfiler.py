@@ -0,0 +1,113 @@
+import os, json, time, threading, resource
+from ProcessSupervisor import ProcessSupervisor
+
+class PipelineProfiler():
+    #Records where a pipeline.py run spends its time: the wall time of every stage and, for every
+    #external command, its wall time, exit code, user/system CPU time and peak memory (from wait4)
+    #write() saves a JSON summary and a Chrome trace-event file (open it in chrome://tracing or
+    #https://ui.perfetto.dev) showing stages and commands on a timeline
+    summaryName = "profile.json"
+    traceName = "profile.trace.json"
+
+    def __init__(self):
+        self.startTime = time.time()
+        self.stages = [] #{'name', 'sample', 'start', 'end'}
+        self.openStages = {} #(stage name, sample) -> its entry in stages, while it runs
+        self.commands = [] #{'command', 'stage', 'sample', 'start', 'end', 'returnCode', 'userTime', 'systemTime', 'maxRSS'}
+        self.threadIDs = {} #Thread ident -> trace track, so concurrent commands get their own rows
+        self.samples = [] #Samples with stages of their own (pipeline.py --streaming), each gets a row of stages
+        self.running = threading.local() #Stage begun by the current thread, so a sample's commands are attributed to it
+        self.lock = threading.Lock()
+
+    def begin(self, name, sample=None):
+        with self.lock:
+            stage = {'name': name, 'sample': sample, 'start': time.time(), 'end': None}
+            self.stages.append(stage)
+            self.openStages[(name, sample)] = stage
+            if sample is not None and sample not in self.samples:
+                self.samples.append(sample)
+        self.running.stage = stage
+
+    def end(self, name, sample=None):
+        with self.lock:
+            stage = self.openStages.pop((name, sample), None)
+            if stage is not None:
+                stage['end'] = time.time()
+        if getattr(self.running, 'stage', None) is stage:
+            self.running.stage = None
+
+    def currentStage(self):
+        #Stage begun by this thread, else the most recently started stage still running
+        stage = getattr(self.running, 'stage', None)
+        if stage is None:
+            with self.lock:
+                running = [stage for stage in self.stages if stage['end'] is None]
+            stage = running[-1] if running else None
+        return stage
+
+    def track(self):
+        ident = threading.get_ident()
+        with self.lock:
+            if ident not in self.threadIDs:
+                self.threadIDs[ident] = len(self.threadIDs)+1
+            return self.threadIDs[ident]
+
+    def record(self, command, start, end, returnCode, usage):
+        #Called by ProcessSupervisor for every command it reaped; usage is the rusage from wait4
+        stage = self.currentStage() or {'name': None, 'sample': None}
+        entry = {'command': command, 'stage': stage['name'], 'sample': stage['sample'], 'track': self.track(),
+                 'start': start, 'end': end, 'returnCode': returnCode,
+                 'userTime': usage.ru_utime, 'systemTime': usage.ru_stime,
+                 'maxRSS': usage.ru_maxrss} #kB on Linux
+        with self.lock:
+            self.commands.append(entry)
+
+    def summary(self):
+        now = time.time()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with self.lock:
+            stages = [{'name': stage['name'], 'sample': stage['sample'], 'start': stage['start'], 'end': stage['end'],
+                       'seconds': round((stage['end'] or now)-stage['start'], 3)} for stage in self.stages]
+            commands = []
+            for command in self.commands:
+                entry = dict(command)
+                del entry['track']
+                entry['seconds'] = round(command['end']-command['start'], 3)
+                commands.append(entry)
+        return {'start': self.startTime, 'seconds': round(now-self.startTime, 3),
+                'stages': stages, 'commands': commands,
+                #Every waited-for child process of the run, including ones not started through run()
+                'children': {'userTime': children.ru_utime, 'systemTime': children.ru_stime, 'maxRSS': children.ru_maxrss}}
+
+    def trace(self):
+        #Chrome trace-event format: complete ("X") events in microseconds since the run started
+        def us(t):
+            return int((t-self.startTime)*1000000)
+        now = time.time()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 0, 'args': {'name': 'stages'}}]
+        with self.lock:
+            #Stage rows of samples use negative tids, sorting them between the run's stages and the commands
+            for index, sample in enumerate(self.samples):
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': -(index+1), 'args': {'name': 'stages '+sample}})
+            for stage in self.stages:
+                tid = -(self.samples.index(stage['sample'])+1) if stage['sample'] is not None else 0
+                events.append({'name': stage['name'], 'cat': 'stage', 'ph': 'X', 'pid': 1, 'tid': tid,
+                               'ts': us(stage['start']), 'dur': us(stage['end'] or now)-us(stage['start'])})
+            for track in sorted(self.threadIDs.values()):
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': track, 'args': {'name': 'commands '+str(track)}})
+            for command in self.commands:
+                events.append({'name': ProcessSupervisor.commandName(command['command']),
+                               'cat': 'command', 'ph': 'X', 'pid': 1, 'tid': command['track'],
+                               'ts': us(command['start']), 'dur': us(command['end'])-us(command['start']),
+                               'args': {'command': ' '.join(str(arg) for arg in command['command']), 'stage': command['stage'], 'sample': command['sample'],
+                                        'returnCode': command['returnCode'], 'userTime': command['userTime'],
+                                        'systemTime': command['systemTime'], 'maxRSS': command['maxRSS']}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, folder):
+        #Writes profile.json and profile.trace.json into folder
+        for name, contents in ((PipelineProfiler.summaryName, self.summary()), (PipelineProfiler.traceName, self.trace())):
+            path = os.path.join(folder, name)
+            with open(path+".tmp", 'w') as f:
+                json.dump(contents, f, indent=1, sort_keys=True)
+            os.replace(path+".tmp", path)
@@ -0,0 +1,315 @@
+#! /usr/bin/env python3
+''' Postprocessing of a main library once its pools are aligned:
+    GATK DepthOfCoverage, UnifiedGenotyper and CallableLoci for every pool, make_calls_gatk.py for
+    the call summary, then summarize_analysis.py for the IGV sessions, Excel and HTML summary.
+
+    CallableLoci runs next to the coverage and UnifiedGenotyper, which only genotypes the
+    references covered at every base (the others can't pass anyway). Pools are processed in
+    parallel too. With --shards N, each GATK tool runs N times at once on sets of references
+    (from references.dict) of about the same total length, and the outputs are merged back in
+    reference order. ProcessSupervisor keeps at most --maxParallel commands running,
+    kills commands that run past --commandTimeout and writes the output of every command to
+    MAINLIBRARY_FOLDER/logs/postprocessing/.
+
+    Pools whose references all had too few reads aligned for anything but an Incomplete call
+    (BamPrescreen.py, from aligned_reads.bam.bai and the pool's flagstat) skip GATK.
+
+    pipeline.py --streaming postprocesses each pool as soon as it is aligned (--pools POOL
+    --noSummary) and summarizes all of them at the end (--summaryOnly).
+'''
+import argparse
+import os
+import sys
+import struct
+import shutil
+import heapq
+import itertools
+import concurrent.futures
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ProcessSupervisor import ProcessSupervisor
+from BamPrescreen import BamPrescreen
+from SamCoverage import SamCoverage
+
+parser = argparse.ArgumentParser()
+parser.add_argument('seqval_folder', help='Path to Seq Validation folder')
+parser.add_argument('mainlibrary_folder', help='Path to mainLibrary folder')
+parser.add_argument('ref_fasta', help='Path to references.fasta file')
+parser.add_argument('gatk_dir', help='Path to GATK')
+parser.add_argument('python_dir', help='Path to Python Post Processing Scripts')
+parser.add_argument('--maxParallel', type=int, default=2, help='External commands run at once')
+parser.add_argument('--gatkThreads', type=int, default=8, help='Threads (-nt) of each UnifiedGenotyper run, shared by its shards')
+parser.add_argument('--shards', type=int, default=1, help='Sets of references of about the same total length each GATK walker runs on at once')
+parser.add_argument('--commandTimeout', type=float, default=12, help='Hours after which a command is killed (0 for no limit)')
+parser.add_argument('--memoryLimit', type=float, default=0, help='Address space limit in GB per command (0 for no limit)')
+parser.add_argument('--maxReadLength', type=int, default=0, help='Longest read, for screening out references too few reads aligned to (0: only those without reads)')
+parser.add_argument('--samtools', default='samtools', help='Path to samtools')
+parser.add_argument('--pools', nargs='+', default=None, help='Pools to postprocess (default: every pool of the main library)')
+parser.add_argument('--noSummary', action='store_true', help='Skip summarize_analysis.py')
+parser.add_argument('--summaryOnly', action='store_true', help='Only run summarize_analysis.py, on pools postprocessed before')
+
+def pool_names(mainlibrary_folder):
+  ''' Pool folders of the main library, e.g. WT_1_libName '''
+  return sorted(name for name in os.listdir(mainlibrary_folder)
+                if '_' in name and os.path.isdir(os.path.join(mainlibrary_folder, name, 'bwa_dir')))
+
+def gatk(args, tool, *options):
+  return ['java', '-jar', os.path.join(args.gatk_dir, 'GenomeAnalysisTK.jar'), '-T', tool, '-R', args.ref_fasta] + list(options)
+
+def postprocess_pool(args, supervisor, pool):
+  ''' Runs GATK and make_calls_gatk.py for one pool, returns False if a step failed '''
+  bwa_dir = os.path.join(pool, 'bwa_dir')
+  for suffix in ('.bam', '.bam.bai'):
+    if os.path.isfile(os.path.join(bwa_dir, pool+suffix)):
+      os.rename(os.path.join(bwa_dir, pool+suffix), os.path.join(bwa_dir, 'aligned_reads'+suffix))
+  bam = os.path.join(bwa_dir, 'aligned_reads.bam')
+
+  # pipeline.py counts depth.txt from the slice BAMs during alignment (SliceCoverage.py)
+  depth = os.path.join(bwa_dir, 'depth.txt')
+  counted = os.path.isfile(depth)
+
+  # References too few reads aligned to for anything but an Incomplete call; without any others,
+  # the calls only need the coverage and GATK is skipped
+  prescreen = BamPrescreen(SamCoverage.referenceLengths(args.ref_fasta+'.fai'), args.maxReadLength)
+  try:
+    incomplete = prescreen.incomplete(bam+'.bai', os.path.join(bwa_dir, pool+'.bam.flagstat'))
+  except (IOError, struct.error) as e:
+    print('Prescreen of %s failed (%s), running GATK for every reference' % (pool, e))
+    incomplete = {}
+  with open(os.path.join(bwa_dir, 'prescreen.txt'), 'w') as f:
+    for name, length in prescreen.referenceLengths:
+      if name in incomplete:
+        f.write('%s\t%d\tIncomplete\n' % (name, incomplete[name]))
+  if incomplete:
+    print('%s: %d of %d references Incomplete from the reads aligned to them' % (pool, len(incomplete), len(prescreen.referenceLengths)))
+    sys.stdout.flush()
+  if len(incomplete) == len(prescreen.referenceLengths):
+    print('Skipping GATK for %s' % pool)
+    if not counted:
+      try:
+        prescreen.depth(bam, args.samtools, depth)
+      except IOError as e:
+        print('Coverage of %s failed: %s' % (pool, e))
+        return False
+    return make_calls(args, supervisor, pool, ['--depthfile', depth])
+
+  # CallableLoci only feeds the IGV session, so it runs next to the coverage and genotyping. Each
+  # walker runs on --shards sets of references at once, merged back in reference order
+  references = reference_dict(args.ref_fasta)
+  shards = shard_references(references, args.shards)
+  shard_dir = os.path.join(bwa_dir, 'shards')
+  bed = os.path.join(bwa_dir, 'callable.bed')
+  loci_summary = os.path.join(pool, 'call_summary.txt')
+  def merge_callable_loci(outputs, output):
+    merge_shards(outputs, output, references, lambda line: False, bed_locus)
+    merge_loci_summaries([path+'.summary' for path in outputs], loci_summary)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+    print('Running GATK Callable Loci for %s...' % pool)
+    callable_loci = executor.submit(run_walker, supervisor, shard_dir, shards, len(references),
+      lambda intervals, output: gatk(args, 'CallableLoci', '-I', bam, '-summary', loci_summary if output == bed else output+'.summary',
+                                     '-o', output, *intervals),
+      bed, merge_callable_loci)
+    if counted:
+      coverage = ['--depthfile', depth]
+    else:
+      print('Running GATK Depth of Coverage for %s...' % pool)
+      covdepth = os.path.join(bwa_dir, 'covdepth')
+      if not run_walker(supervisor, shard_dir, shards, len(references),
+                        lambda intervals, output: gatk(args, 'DepthOfCoverage', '--includeRefNSites', '-I', bam, '-o', output, *intervals),
+                        covdepth, lambda outputs, output: merge_shards(outputs, output, references, lambda line: line.startswith('Locus\t'), covdepth_locus)):
+        return False
+      print('covdepth file generated for %s' % pool)
+      coverage = ['--covfile', covdepth]
+
+    # make_calls_gatk.py only looks at the variants of references covered at every base, so the
+    # others aren't genotyped
+    covered = covered_references(depth if counted else os.path.join(bwa_dir, 'covdepth'), counted, references)
+    vcf = os.path.join(bwa_dir, 'snps.gatk.vcf')
+    variants = []
+    if covered:
+      print('Running GATK Unified Genotyper for %s on %d of %d references...' % (pool, len(covered), len(references)))
+      covered_shards = shard_references([(name, length) for name, length in references if name in covered], args.shards)
+      if not run_walker(supervisor, shard_dir, covered_shards, len(references),
+                        lambda intervals, output: gatk(args, 'UnifiedGenotyper', '-I', bam, '-glm', 'BOTH', '--max_deletion_fraction', '0.55',
+                                                       '-o', output, '-nt', max(1, args.gatkThreads//len(covered_shards)), *intervals),
+                        vcf, lambda outputs, output: merge_shards(outputs, output, references, lambda line: line.startswith('#'), vcf_locus)):
+        return False
+      print('snps.gatk.vcf file generated for %s' % pool)
+      variants = ['--vcffile', vcf]
+    else:
+      print('No reference of %s is covered at every base, skipping GATK Unified Genotyper' % pool)
+      if os.path.isfile(vcf):
+        os.remove(vcf)
+    made = make_calls(args, supervisor, pool, variants + coverage)
+
+    loci = callable_loci.result()
+    if loci:
+      print('callable.bed file generated for %s' % pool)
+  if os.path.isdir(shard_dir):
+    shutil.rmtree(shard_dir)
+  return loci and made
+
+def reference_dict(ref_fasta):
+  ''' [(name, length)] of the references in references.dict order '''
+  references = []
+  with open(os.path.splitext(ref_fasta)[0]+'.dict') as f:
+    for line in f:
+      if line.startswith('@SQ'):
+        tags = dict(field.split(':', 1) for field in line.rstrip('\n').split('\t')[1:])
+        references.append((tags['SN'], int(tags['LN'])))
+  return references
+
+def shard_references(references, shards):
+  ''' Splits references into at most shards lists of about the same total length (longest
+      reference first, onto the shortest shard), each in reference order '''
+  totals = [0] * max(1, min(shards, len(references)))
+  members = [[] for total in totals]
+  for name, length in sorted(references, key=lambda reference: -reference[1]):
+    shard = totals.index(min(totals))
+    totals[shard] += length
+    members[shard].append(name)
+  order = dict((name, index) for index, (name, length) in enumerate(references))
+  return [sorted(names, key=order.get) for names in members if names]
+
+def run_walker(supervisor, shard_dir, shards, total, command, output, merge):
+  ''' Runs command(intervals, output) once per shard at once and merge(shard outputs, output)
+      afterwards; a single shard of every reference runs without -L straight into output.
+      Returns False if a run failed '''
+  if len(shards) == 1 and len(shards[0]) == total:
+    results = [supervisor.run(command([], output))]
+  else:
+    os.makedirs(shard_dir, exist_ok=True)
+    prefix = os.path.join(shard_dir, os.path.basename(output))
+    for index, names in enumerate(shards):
+      with open('%s.%d.list' % (prefix, index), 'w') as f:
+        f.write(''.join(name+'\n' for name in names))
+    outputs = ['%s.%d%s' % (prefix, index, '.vcf' if output.endswith('.vcf') else '') for index in range(len(shards))]
+    results = supervisor.runAll([command(['-L', '%s.%d.list' % (prefix, index)], outputs[index]) for index in range(len(shards))])
+    if all(result.ok() for result in results):
+      merge(outputs, output)
+  for result in results:
+    report(result)
+  return all(result.ok() for result in results)
+
+def merge_shards(paths, output, references, is_header, locus):
+  ''' Merges shard outputs that are each in reference order (k-way merge on reference index and
+      position). Each reference is in one shard, so the records are those of one run over all of
+      them; the header is the first shard's, plus the lines only other shards have (e.g. their
+      ##GATKCommandLine with their -L) above its last line (the #CHROM or Locus column names) '''
+  order = dict((name, index) for index, (name, length) in enumerate(references))
+  files = [open(path) for path in paths]
+  try:
+    headers = []
+    firsts = []
+    for index, lines in enumerate(files):
+      shard_headers = []
+      for line in lines:
+        if not is_header(line):
+          firsts.append([line])
+          break
+        shard_headers.append(line)
+      else:
+        firsts.append([])
+      if index == 0:
+        headers = shard_headers
+      else:
+        added = [line for line in shard_headers if line not in headers]
+        headers[max(0, len(headers)-1):max(0, len(headers)-1)] = added
+    def records(index, lines):
+      for number, line in enumerate(lines):
+        name, position = locus(line)
+        yield order[name], position, index, number, line
+    with open(output+'.tmp', 'w') as f:
+      f.writelines(headers)
+      for record in heapq.merge(*[records(index, itertools.chain(firsts[index], lines)) for index, lines in enumerate(files)]):
+        f.write(record[-1])
+  finally:
+    for f in files:
+      f.close()
+  os.replace(output+'.tmp', output)
+
+def covdepth_locus(line):
+  name, position = line.split('\t', 1)[0].rsplit(':', 1)
+  return name, int(position)
+
+def vcf_locus(line):
+  fields = line.split('\t', 2)
+  return fields[0], int(fields[1])
+
+def bed_locus(line):
+  fields = line.split('\t', 2)
+  return fields[0], int(fields[1])
+
+def merge_loci_summaries(paths, output):
+  ''' Adds up the base counts of CallableLoci -summary tables (lines ending in a count) '''
+  with open(paths[0]) as f:
+    lines = f.readlines()
+  counts = [None] * len(lines)
+  for path in paths:
+    with open(path) as f:
+      for index, line in enumerate(f):
+        fields = line.rstrip('\n').rsplit(None, 1)
+        if index < len(lines) and len(fields) == 2 and fields[1].isdigit():
+          counts[index] = (counts[index] or 0) + int(fields[1])
+  with open(output, 'w') as f:
+    for line, count in zip(lines, counts):
+      f.write(line if count is None else line.rstrip('\n')[:-len(line.rstrip('\n').rsplit(None, 1)[1])]+str(count)+'\n')
+
+def covered_references(path, samtools_format, reference_lengths):
+  ''' References with a depth of at least 5 (make_calls_gatk.py's min_cov) at every base, from
+      samtools depth style depth.txt or GATK DepthOfCoverage output '''
+  covered_bases = dict((name, 0) for name, length in reference_lengths)
+  with open(path) as f:
+    if not samtools_format:
+      next(f, None) # header
+    for line in f:
+      fields = line.split('\t', 3)
+      name, depth = (fields[0], fields[2]) if samtools_format else (fields[0].rsplit(':', 1)[0], fields[1])
+      if int(depth) >= 5 and name in covered_bases:
+        covered_bases[name] += 1
+  return [name for name, length in reference_lengths if covered_bases[name] == length]
+
+def make_calls(args, supervisor, pool, options):
+  ''' Runs make_calls_gatk.py into bwa_dir/call_summary.txt, returns False if it failed '''
+  print('Running make_calls_gatk.py script for %s...' % pool)
+  result = supervisor.run(['python', os.path.join(args.python_dir, 'make_calls_gatk.py'), '--reffile', args.ref_fasta] + options,
+                          stdout=os.path.join(pool, 'bwa_dir', 'call_summary.txt'))
+  report(result)
+  if result.ok():
+    print('call_summary.txt file generated for %s' % pool)
+  return result.ok()
+
+def report(result):
+  if not result.ok():
+    print('%s, see %s' % (ProcessSupervisor.describe(result), result.logPath))
+    for line in result.stderrTail:
+      print('  '+line.rstrip('\n'))
+  sys.stdout.flush()
+
+if __name__=='__main__':
+  args = parser.parse_args()
+  if not os.path.isfile(args.ref_fasta):
+    print('%s does not exist.' % args.ref_fasta)
+    sys.exit(1)
+  os.chdir(args.mainlibrary_folder)
+  supervisor = ProcessSupervisor(os.path.join(args.mainlibrary_folder, 'logs', 'postprocessing'), args.maxParallel,
+                                 args.commandTimeout*3600 or None, int(args.memoryLimit*1024**3) or None)
+
+  pools = [] if args.summaryOnly else (args.pools or pool_names(args.mainlibrary_folder))
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(pools), args.maxParallel))) as executor:
+    succeeded = list(executor.map(lambda pool: postprocess_pool(args, supervisor, pool), pools))
+  if args.noSummary:
+    sys.exit(0 if all(succeeded) else 1)
+
+  ## generate HTML
+   # Dependencies:
+   #        lxml
+   #        openpyxl
+   #        scipy
+   #        numpy
+  print('Running summarize_analysis.py...')
+  result = supervisor.run(['python', os.path.join(args.python_dir, 'summarize_analysis.py'), '--fspath', args.seqval_folder],
+                          stdin=os.path.join(args.mainlibrary_folder, 'config.xml'), onOutput=sys.stdout.write)
+  report(result)
+  if not result.ok() or not all(succeeded):
+    sys.exit(1)
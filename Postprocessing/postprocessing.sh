@@ -9,71 +9,15 @@ usage() {
             PYTHON_DIR=Path to Python Post Processing Scripts"
 }
 
-if [ "$#" -ne 2 ]; then
+if [ "$#" -lt 5 ]; then
     usage
-    exit
+    exit 1
 fi
 
-SEQUENCEVALIDATIONPIPELINE_FOLDER=$1
-
-MAINLIBRARY_FOLDER=$2
-REF_FASTA=$3
-
-GATK_DIR=$4
-PYTHON_DIR=$5
-
-if ! [ -f ${REF_FASTA} ]; then
-    echo "${REF_FASTA} does not exist."
-    exit
-fi
-
-for POOL_NAME in `ls -d *_*`;
-do
-    if [ -f ${POOL_NAME}/bwa_dir/${POOL_NAME}.bam ]; then
-        mv ${POOL_NAME}/bwa_dir/${POOL_NAME}.bam ${POOL_NAME}/bwa_dir/aligned_reads.bam
-    fi    
-
-    if [ -f ${POOL_NAME}/bwa_dir/${POOL_NAME}.bam.bai ]; then
-        mv ${POOL_NAME}/bwa_dir/${POOL_NAME}.bam.bai ${POOL_NAME}/bwa_dir/aligned_reads.bam.bai
-    fi
-
-    echo "Running GATK Depth of Coverage..."
-    # DEPTH OF COVERAGE
-    java -jar ${GATK_DIR}/GenomeAnalysisTK.jar -T DepthOfCoverage --includeRefNSites -R ${REF_FASTA} -I ${POOL_NAME}/bwa_dir/aligned_reads.bam -o ${POOL_NAME}/bwa_dir/covdepth > /dev/null 2>&1
-    echo "covdepth file generated"
-
-    echo ""
-
-    ## VCF
-    echo "Running GATK Unified Genotyper..."
-    java -jar ${GATK_DIR}/GenomeAnalysisTK.jar -T UnifiedGenotyper -R ${REF_FASTA} -I ${POOL_NAME}/bwa_dir/aligned_reads.bam -glm BOTH --max_deletion_fraction 0.55 -o ${POOL_NAME}/bwa_dir/snps.gatk.vcf -nt 8 > /dev/null 2>&1
-    echo "snps.gatk.vcf file generated"
-
-    echo ""
-
-    ## CALLABLE
-    echo "Running GATK Callable Loci..."
-    java -jar ${GATK_DIR}/GenomeAnalysisTK.jar -T CallableLoci -R ${REF_FASTA} -I ${POOL_NAME}/bwa_dir/aligned_reads.bam -summary ${POOL_NAME}/call_summary.txt -o ${POOL_NAME}/bwa_dir/callable.bed > /dev/null 2>&1
-    echo "callable.bed file generated"
-
-    echo ""
-
-    # CALL SUMMARY
-    echo "Running make_calls_gatk.py script..."
-    python ${PYTHON_DIR}/make_calls_gatk.py --reffile ${REF_FASTA} --vcffile ${POOL_NAME}/bwa_dir/snps.gatk.vcf --covfile ${POOL_NAME}/bwa_dir/covdepth > ${POOL_NAME}/bwa_dir/call_summary.txt
-    echo "call_summary.txt file generated"
-
-    echo ""
-done
-
-
-## generate HTML
- # Dependencies:
- #        lxml
- #        openpyxl 
- #        scipy 
- #        numpy
-python ${PYTHON_DIR}/summarize_analysis.py --fspath ${SEQUENCEVALIDATIONPIPELINE_FOLDER} < ${MAINLIBRARY_FOLDER}/config.xml
+# The per-pool GATK steps, call summaries and summarize_analysis.py are run by postprocessing.py,
+# which runs pools in parallel and applies timeouts; any further options are passed on to it
+# (see python3 postprocessing.py --help)
+exec python3 "$(dirname "$0")/postprocessing.py" "$@"
 
 ##
 ## WEB
@@ -5,6 +5,7 @@ import sys
 parser = argparse.ArgumentParser()
 parser.add_argument('--vcffile')
 parser.add_argument('--covfile')
+parser.add_argument('--depthfile', help='samtools depth style coverage (from pipeline.py --quick-look or SliceCoverage.py) instead of --covfile')
 parser.add_argument('--reffile')
 # parser.add_argument('--json', default="/dev/null")
 parser.add_argument('summary', nargs='?', type=argparse.FileType('w'), default=sys.stdout)
@@ -13,7 +14,7 @@ args = parser.parse_args()
 
 import json
 from Bio import SeqIO
-from postanalysis.covvars import parse_covdepth_gatk, find_variants
+from postanalysis.covvars import parse_covdepth_gatk, parse_covdepth_samtools, find_variants
 from postanalysis.variant import Variant
 from postanalysis.genedesign import inputGD, runGD
 
@@ -46,7 +47,10 @@ seqs = [(s.id,s) for s in SeqIO.parse(args.reffile,'fasta')]
 sdict = dict((ref,Reference(name=ref)) for ref,seq in seqs)
 
 ''' Analyze coverage '''
-covdata = parse_covdepth_gatk(args.covfile)
+if args.depthfile:
+  covdata = parse_covdepth_samtools(args.depthfile, dict((ref,len(seq)) for ref,seq in seqs))
+else:
+  covdata = parse_covdepth_gatk(args.covfile)
 for ref,seq in seqs:
   result = find_variants(covdata[ref],seq,ref,exclude_edges=True,exclude_overlaps=True)
   sdict[ref].pct_cov = result['pct_cov']
@@ -56,8 +60,8 @@ for ref,seq in seqs:
       v.caller = 'covvars'
       sdict[ref].dips.append(v)
 
-''' Analyze variants '''
-vlines = [l.strip('\n') for l in open(args.vcffile,'rU') if not l.startswith('#')]
+''' Analyze variants (none without a VCF, e.g. for a quick look) '''
+vlines = [l.strip('\n') for l in open(args.vcffile,'rU') if not l.startswith('#')] if args.vcffile else []
 for l in vlines:
   v = Variant.from_vcf(l)
   v.caller = 'gatk'
@@ -24,7 +24,7 @@ HTML_BODY = '''<body>
     <div class="span12">
       <div class="page-header">
         <h1> Analysis: %(aname)s </h1>
-      </div>
+      </div>%(banner)s
     </div>
   </div> <!-- end row -->
   
@@ -218,9 +218,14 @@ def make_analysis_table(analysis):
   protocols = sorted(set(chain.from_iterable(pd['jobs'].keys() for pd in table)))
   return JS_LINK % {'protocols_json':json.dumps(protocols), 'pools_json':json.dumps(table)}
 
-def make_index(a,baseurl,reflens,calltable,bestbets):
+PROVISIONAL_BANNER = '''
+      <div class="alert alert-block"><strong>Provisional results.</strong> %s</div>'''
+
+def make_index(a,baseurl,reflens,calltable,bestbets,provisional=None):
+  ''' provisional: explanation shown above results that the full analysis will replace '''
   htmlstr = HTML_HEAD
-  htmlstr += HTML_BODY % {'aname':a.attrib['name']}
+  htmlstr += HTML_BODY % {'aname':a.attrib['name'],
+                          'banner':PROVISIONAL_BANNER % provisional if provisional else ''}
   htmlstr += JS_INCLUDE % {'aname':a.attrib['name'],'baseurl':baseurl,'results_table':'<h3> Result table here</h3>'}
   htmlstr += make_analysis_table(a)
   htmlstr += JS_RESULT % {'outcomes_json':json.dumps(calltable),
@@ -6,6 +6,7 @@ from urlparse import urljoin
 parser = argparse.ArgumentParser()
 parser.add_argument('conffile', nargs='?', type=argparse.FileType('r'), default=sys.stdin)
 parser.add_argument('--fspath')
+parser.add_argument('--provisional', help='Mark index.html as provisional with this explanation (pipeline.py --quick-look)')
 
 args = parser.parse_args()
 
@@ -97,7 +98,7 @@ if __name__=='__main__':
     #--- Make the index.html file
     htmlfile = os.path.join(adir,'index.html')
     with open(htmlfile,'w') as outh:
-      print >>outh, make_index(analysis,'localhost',reflens,calltable,bestbets)
+      print >>outh, make_index(analysis,'localhost',reflens,calltable,bestbets,args.provisional)
 
   except (IOError,OSError) as e:
     if e.args[1] == 'Read-only file system':
@@ -0,0 +1,207 @@
+import os, time, shutil, signal, threading, subprocess, resource, collections
+import concurrent.futures
+
+class CommandResult():
+    #Outcome of one supervised command
+
+    def __init__(self, command, name):
+        self.command = command
+        self.name = name
+        self.returnCode = None #Negative if killed by a signal
+        self.timedOut = False
+        self.start = None
+        self.end = None
+        self.logPath = None #File holding the command's stderr (and stdout when it isn't used otherwise)
+        self.stderrTail = collections.deque(maxlen=ProcessSupervisor.tailLines)
+
+    def ok(self):
+        return self.returnCode == 0
+
+    def seconds(self):
+        return self.end-self.start
+
+class ProcessSupervisor():
+    #Runs external tools (BWA, Picard, GATK, the Perl and Python scripts) for pipeline.py and the
+    #postprocessing orchestrator:
+    # - stdout and stderr are read by their own threads as the tool writes them, so a chatty tool
+    #   never blocks on a full pipe, and written to a buffered per-command log file
+    # - each command is reaped with wait4, and its CPU time and peak memory go to the profiler
+    # - a command running past its timeout is terminated together with everything it started
+    #   (it runs in its own process group), then killed if it doesn't exit within killGrace seconds
+    # - memoryLimit caps the address space of the command (RLIMIT_AS); java reserves far more
+    #   address space than it uses, so give GATK/Picard an -Xmx instead. The limit is set by the
+    #   prlimit tool, which then execs the command, since a preexec_fn can deadlock the child of a
+    #   process running other threads; without prlimit it is set on the child right after it starts
+    # - runAll() runs independent commands in parallel, never more than maxParallel at a time
+    #   across all callers; runNow() runs a command without waiting for a slot, for light helpers
+    #   that run next to the commands holding them (e.g. counting coverage during the alignment)
+    killGrace = 30 #Seconds between SIGTERM and SIGKILL for a command that timed out
+    tailLines = 20 #Lines of stderr kept in memory for error messages
+
+    def __init__(self, logFolder=None, maxParallel=1, defaultTimeout=None, defaultMemoryLimit=None, profiler=None):
+        self.logFolder = logFolder
+        self.maxParallel = maxParallel
+        self.defaultTimeout = defaultTimeout #Seconds, None for no limit
+        self.defaultMemoryLimit = defaultMemoryLimit #Bytes, None for no limit
+        self.profiler = profiler #PipelineProfiler, or None
+        self.slots = threading.BoundedSemaphore(maxParallel)
+        self.lock = threading.Lock()
+        self.sequence = 0
+        if logFolder:
+            os.makedirs(logFolder, exist_ok=True)
+            #Continue the numbering of an earlier run's logs (pipeline.py --resume) instead of overwriting them
+            self.sequence = len([name for name in os.listdir(logFolder) if name.endswith(".log")])
+
+    def commandName(command):
+        #Short name of a command for log files, e.g. prep_ref.pl or DepthOfCoverage
+        command = [str(arg) for arg in command]
+        if command[0] == 'java' and '-T' in command[:-1]:
+            return command[command.index('-T')+1]
+        if command[0] in ('perl', 'python', 'python3', 'java', 'sh') and '-c' not in command:
+            script = [arg for arg in command[1:] if not arg.startswith('-')]
+            if script:
+                return os.path.basename(script[0])
+        return os.path.basename(command[0])
+
+    def logPathFor(self, name):
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+        if not self.logFolder:
+            return None
+        return os.path.join(self.logFolder, "%03d_%s.log" % (sequence, name))
+
+    def limitMemory(command, memoryLimit):
+        #command run under prlimit --as, or None if there is no prlimit tool
+        prlimit = shutil.which("prlimit")
+        if prlimit is None:
+            return None
+        return [prlimit, "--as="+str(memoryLimit), "--"]+command
+
+    def pump(stream, handlers):
+        #Reads stream line by line until EOF, passing every line to each handler
+        try:
+            for line in stream:
+                line = line.decode(errors='replace')
+                for handler in handlers:
+                    handler(line)
+        finally:
+            stream.close()
+
+    def terminate(self, p, result):
+        #Timeout: SIGTERM to the command's process group, SIGKILL if it is still there after killGrace
+        result.timedOut = True
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except OSError:
+            return
+        deadline = time.time()+ProcessSupervisor.killGrace
+        while time.time() < deadline:
+            if p.returncode is not None:
+                return
+            time.sleep(0.5)
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def run(self, command, timeout=None, memoryLimit=None, onOutput=None, stdin=None, stdout=None, cwd=None, name=None):
+        #Runs command to completion and returns its CommandResult
+        #onOutput: called with every stdout line (e.g. to copy it into the pipeline log)
+        #stdin, stdout: paths to redirect from/to, for scripts used as filters
+        with self.slots:
+            return self.runNow(command, timeout, memoryLimit, onOutput, stdin, stdout, cwd, name)
+
+    def runNow(self, command, timeout=None, memoryLimit=None, onOutput=None, stdin=None, stdout=None, cwd=None, name=None):
+        command = [str(arg) for arg in command]
+        result = CommandResult(command, name or ProcessSupervisor.commandName(command))
+        timeout = timeout if timeout is not None else self.defaultTimeout
+        memoryLimit = memoryLimit if memoryLimit is not None else self.defaultMemoryLimit
+        result.logPath = self.logPathFor(result.name)
+        log = open(result.logPath, 'w', buffering=64*1024) if result.logPath else None
+        logLock = threading.Lock()
+
+        def toLog(line):
+            if log is not None:
+                with logLock:
+                    log.write(line)
+
+        stdinFile = open(stdin, 'rb') if stdin else None
+        stdoutFile = open(stdout, 'wb') if stdout else None
+        pumps = []
+        timer = None
+        try:
+            limited = ProcessSupervisor.limitMemory(command, memoryLimit) if memoryLimit else None
+            result.start = time.time()
+            p = subprocess.Popen(limited or command, cwd=cwd,
+                                 stdin=stdinFile if stdinFile else subprocess.DEVNULL,
+                                 stdout=stdoutFile if stdoutFile else subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 start_new_session=True)
+            if memoryLimit and limited is None:
+                try:
+                    resource.prlimit(p.pid, resource.RLIMIT_AS, (memoryLimit, memoryLimit))
+                except (OSError, ValueError):
+                    pass #Already exited
+            if stdoutFile is None:
+                pumps.append(threading.Thread(target=ProcessSupervisor.pump, args=(p.stdout, [onOutput or toLog])))
+            pumps.append(threading.Thread(target=ProcessSupervisor.pump, args=(p.stderr, [toLog, result.stderrTail.append])))
+            for pumpThread in pumps:
+                pumpThread.daemon = True
+                pumpThread.start()
+            if timeout:
+                timer = threading.Timer(timeout, self.terminate, args=(p, result))
+                timer.daemon = True
+                timer.start()
+            #wait4 instead of p.wait() so the CPU time and peak memory of this child alone are known
+            pid, status, usage = os.wait4(p.pid, 0)
+            p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            result.returnCode = p.returncode
+            result.end = time.time()
+            if timer is not None:
+                timer.cancel()
+            #Children left behind by the command may still hold the pipes open
+            for pumpThread in pumps:
+                pumpThread.join(ProcessSupervisor.killGrace)
+            if self.profiler is not None:
+                self.profiler.record(command, result.start, result.end, result.returnCode, usage)
+        finally:
+            if stdinFile is not None:
+                stdinFile.close()
+            if stdoutFile is not None:
+                stdoutFile.close()
+            if log is not None:
+                with logLock:
+                    log.close()
+                    log = None
+        return result
+
+    def runAll(self, commands, **options):
+        #Runs independent commands in parallel (bounded by maxParallel) and returns their results in order
+        #commands: list of commands, or of (command, {run() keyword arguments}) pairs
+        jobs = []
+        for command in commands:
+            if isinstance(command, tuple):
+                command, extra = command
+            else:
+                extra = {}
+            arguments = dict(options)
+            arguments.update(extra)
+            jobs.append((command, arguments))
+        if len(jobs) == 1:
+            return [self.run(jobs[0][0], **jobs[0][1])]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(jobs), self.maxParallel)) as pool:
+            futures = [pool.submit(self.run, command, **arguments) for command, arguments in jobs]
+            return [future.result() for future in futures]
+
+    def describe(result):
+        #One line on how a command ended, for logs
+        if result.timedOut:
+            status = "timed out after "+str(int(result.seconds()))+" seconds"
+        elif result.returnCode < 0:
+            status = "was killed by signal "+str(-result.returnCode)
+        elif result.returnCode != 0:
+            status = "exited with code "+str(result.returnCode)
+        else:
+            status = "finished in "+str(round(result.seconds(), 1))+" seconds"
+        return result.name+" "+status
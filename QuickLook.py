@@ -0,0 +1,73 @@
+import os, re, gzip, itertools, subprocess
+from argparse import ArgumentParser
+from SamCoverage import SamCoverage
+
+class QuickLook():
+    #Provisional coverage of a sample from its first reads (pipeline.py --quick-look): the first
+    #reads of each mate are aligned with bwa mem, and the depth of every reference is counted
+    #straight from its output into depth.txt (samtools depth format) for make_calls_gatk.py --depthfile
+
+    def __init__(self, folder, referenceFASTA, bwa, threads):
+        self.folder = folder
+        self.referenceFASTA = referenceFASTA
+        self.bwa = bwa
+        self.threads = threads
+
+    def mates(fastqs):
+        #fastq.gz files by mate, e.g. [[S1_L001_R1_001, S1_L002_R1_001], [S1_L001_R2_001, ...]]
+        mates = {}
+        for fastq in sorted(fastqs):
+            match = re.search(r'_R([12])_\d+\.f(ast)?q\.gz$', os.path.basename(fastq))
+            mates.setdefault(int(match.group(1)) if match else 1, []).append(fastq)
+        return [mates[number] for number in sorted(mates)]
+
+    def head(fastqs, outputPath, reads):
+        #First reads of fastqs (taken in order) into outputPath
+        with open(outputPath, 'wb') as output:
+            for fastq in fastqs:
+                with gzip.open(fastq, 'rb') as f:
+                    lines = list(itertools.islice(f, 4*reads))
+                output.writelines(lines)
+                reads -= len(lines)//4
+                if reads <= 0:
+                    return
+
+    def run(self, fastqs, reads):
+        #Writes depth.txt; returns the number of reads mapped (counting every mate)
+        os.makedirs(self.folder, exist_ok=True)
+        heads = []
+        for number, files in enumerate(QuickLook.mates(fastqs)[:2]):
+            heads.append(os.path.join(self.folder, "R"+str(number+1)+".fq"))
+            QuickLook.head(files, heads[-1], reads)
+        coverage = SamCoverage(SamCoverage.referenceLengths(self.referenceFASTA+".fai"))
+        mapped = 0
+        p = subprocess.Popen([self.bwa, "mem", "-t", str(self.threads), self.referenceFASTA]+heads,
+                             stdout=subprocess.PIPE, universal_newlines=True)
+        for line in p.stdout:
+            coverage.add(line)
+            if not line.startswith('@') and not int(line.split("\t", 2)[1]) & 0x904: #Primary alignment of a mapped read
+                mapped += 1
+        if p.wait() != 0:
+            raise IOError("bwa mem exited with code "+str(p.returncode))
+        coverage.write(os.path.join(self.folder, "depth.txt"))
+        for path in heads:
+            os.remove(path)
+        return mapped
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("folder",
+            help="Folder for the quick look of one sample, e.g. <pool>/quicklook")
+    parser.add_argument("referenceFASTA",
+            help="references.fasta with its bwa index and .fai")
+    parser.add_argument("fastqs", nargs='+',
+            help="fastq.gz files of the sample")
+    parser.add_argument("--reads", dest="reads", type=int, default=100000,
+            help="Reads of each mate to align")
+    parser.add_argument("--bwa", dest="bwa", default="bwa",
+            help="Path to bwa")
+    parser.add_argument("--threads", dest="threads", type=int, default=2,
+            help="bwa mem threads")
+    args = parser.parse_args()
+    mapped = QuickLook(args.folder, args.referenceFASTA, args.bwa, args.threads).run(args.fastqs, args.reads)
+    print("%s: %d reads mapped" % (args.folder, mapped))
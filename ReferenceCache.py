@@ -0,0 +1,142 @@
+import os, json, time, shutil, hashlib, fcntl
+from contextlib import contextmanager
+
+class ReferenceCache():
+    #Indexes of reference sets shared by all pipeline runs, stored as <cacheFolder>/<sha256>/
+    #The key is the hash of the normalized FASTA (after prep_ref.pl -bad_to_n), so an identical
+    #plasmid set gets its bwa index, .fai and .dict built once. Each run's ref/ gets hardlinks to
+    #the cached files (symlinks across filesystems). Least recently used sets are evicted once
+    #the cache grows past quotaBytes.
+    indexName = "reference_index.json"
+    lockName = "reference_index.lock"
+    fastaName = "references.fasta"
+    #Files a complete set has besides the FASTA: bwa index, samtools faidx and picard dictionary
+    indexNames = ["references.fasta.amb", "references.fasta.ann", "references.fasta.bwt", "references.fasta.pac",
+                  "references.fasta.sa", "references.fasta.fai", "references.dict"]
+
+    def __init__(self, cacheFolder, quotaBytes):
+        self.cacheFolder = cacheFolder
+        self.quotaBytes = quotaBytes
+        self.indexPath = os.path.join(cacheFolder, ReferenceCache.indexName)
+        self.lockPath = os.path.join(cacheFolder, ReferenceCache.lockName)
+        os.makedirs(cacheFolder, exist_ok=True)
+
+    def key(fastaPath):
+        #sha256 of the normalized FASTA
+        digest = hashlib.sha256()
+        with open(fastaPath, 'rb') as f:
+            for block in iter(lambda: f.read(1024*1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def pathFor(self, key):
+        return os.path.join(self.cacheFolder, key)
+
+    @contextmanager
+    def locked(self):
+        #Holds the index lock and yields the index; changes are written back atomically
+        with open(self.lockPath, 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                index = self.readIndex()
+                before = json.dumps(index, sort_keys=True)
+                yield index
+                if json.dumps(index, sort_keys=True) != before:
+                    self.writeIndex(index)
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def readIndex(self):
+        try:
+            with open(self.indexPath) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def writeIndex(self, index):
+        tmpPath = self.indexPath+".tmp"
+        with open(tmpPath, 'w') as f:
+            json.dump(index, f, sort_keys=True, indent=1)
+        os.replace(tmpPath, self.indexPath)
+
+    @contextmanager
+    def entryLock(self, key, blocking=True):
+        #Serializes building, linking and evicting one reference set between concurrent runs
+        #Yields False instead of waiting if blocking is False and another run holds it
+        with open(self.pathFor(key)+".lock", 'a') as lockFile:
+            try:
+                fcntl.flock(lockFile, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+    def provide(self, normalizedFASTA, refFolder, build):
+        #Puts references.fasta and its indexes for normalizedFASTA into refFolder
+        #build(fastaPath) creates the indexes next to a copy of the FASTA and returns False on failure
+        #Returns False if the set wasn't cached and building it failed
+        key = ReferenceCache.key(normalizedFASTA)
+        entry = self.pathFor(key)
+        with self.entryLock(key):
+            if os.path.isdir(entry):
+                print("Using cached indexes of reference set "+key)
+            else:
+                print("Building indexes of reference set "+key)
+                building = entry+".building"
+                if os.path.isdir(building):
+                    shutil.rmtree(building) #Left by a run killed while building
+                os.makedirs(building)
+                shutil.copyfile(normalizedFASTA, os.path.join(building, ReferenceCache.fastaName))
+                if not build(os.path.join(building, ReferenceCache.fastaName)):
+                    shutil.rmtree(building)
+                    return False
+                missing = [name for name in ReferenceCache.indexNames if not os.path.isfile(os.path.join(building, name))]
+                if missing:
+                    #Never cache a partial set, every later run would link it
+                    print("Building indexes of reference set "+key+" left out "+", ".join(missing))
+                    shutil.rmtree(building)
+                    return False
+                os.rename(building, entry)
+            ReferenceCache.link(entry, refFolder)
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+        with self.locked() as index:
+            index[key] = {'size': size, 'lastUsed': time.time()}
+            self.evict(index, key)
+        return True
+
+    def link(entry, refFolder):
+        #Hardlinks (or symlinks, across filesystems) the cached set into refFolder, replacing what is there
+        for name in os.listdir(entry):
+            if name.endswith(".bak"):
+                continue #prep_ref.pl's copy of its input
+            source = os.path.join(entry, name)
+            target = os.path.join(refFolder, name)
+            if os.path.lexists(target):
+                os.remove(target)
+            try:
+                os.link(source, target)
+            except OSError:
+                os.symlink(os.path.abspath(source), target)
+
+    def evict(self, index, keepKey):
+        #Removes least recently used sets until the cache fits in the quota
+        #A set another run is linking right now is skipped; runs that already hardlinked it keep their copy
+        if not self.quotaBytes:
+            return
+        used = sum(entry['size'] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['lastUsed']):
+            if used <= self.quotaBytes:
+                break
+            if key == keepKey:
+                continue
+            with self.entryLock(key, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                if os.path.isdir(self.pathFor(key)):
+                    shutil.rmtree(self.pathFor(key))
+            used -= index[key]['size']
+            del index[key]
+            print("Evicted reference set "+key+" from reference cache")
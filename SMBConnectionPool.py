@@ -0,0 +1,71 @@
+import threading, time
+from contextlib import contextmanager
+
+class SMBConnectionPool():
+    #Process-wide pool of authenticated SMBConnections, so callers don't pay for an NTLMv2
+    #handshake on every request. Connections idle for longer than checkAfter seconds are
+    #pinged with an SMB echo before reuse, and ones idle past maxIdle are closed.
+
+    def __init__(self, connect, maxSize=4, checkAfter=30, maxIdle=600, echoTimeout=5):
+        self.connect = connect #Callable returning a new, connected SMBConnection
+        self.maxSize = maxSize
+        self.checkAfter = checkAfter
+        self.maxIdle = maxIdle
+        self.echoTimeout = echoTimeout
+        self.idle = [] #(connection, time it was returned)
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(maxSize)
+
+    def close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def isHealthy(self, conn):
+        try:
+            conn.echo(b'seqval', timeout=self.echoTimeout)
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    conn, returned = self.idle.pop()
+                idleFor = time.time() - returned
+                if idleFor > self.maxIdle:
+                    SMBConnectionPool.close(conn)
+                elif idleFor <= self.checkAfter or self.isHealthy(conn):
+                    return conn
+                else:
+                    SMBConnectionPool.close(conn)
+            return self.connect()
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        try:
+            if broken:
+                SMBConnectionPool.close(conn)
+            else:
+                with self.lock:
+                    self.idle.append((conn, time.time()))
+        finally:
+            self.slots.release()
+
+    @contextmanager
+    def connection(self):
+        #with pool.connection() as conn: ... -- connections that raised are not reused
+        conn = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, broken=True)
+            raise
+        self.release(conn)
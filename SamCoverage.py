@@ -0,0 +1,90 @@
+import re
+import numpy
+
+class SamCoverage():
+    #Per-base read depth of every reference, accumulated from SAM records (bwa mem output or
+    #samtools view of a BAM) without sorting or indexing them first
+    # - like GATK DepthOfCoverage, unmapped, secondary, supplementary, QC failed and duplicate
+    #   reads don't count, and neither do deletions
+    # - each aligned block only adds a +1 and a -1 to a change array; the depth is its cumulative
+    #   sum, so adding a read costs the same whatever its length
+    skipFlags = 0x4 | 0x100 | 0x200 | 0x400 | 0x800
+    cigarOperation = re.compile(r'(\d+)([MIDNSHP=X])')
+    flushEvery = 1000000 #Blocks buffered per reference before they are added to its change array
+
+    def __init__(self, referenceLengths):
+        #referenceLengths: [(name, length)] in reference order
+        self.referenceLengths = list(referenceLengths)
+        self.changes = dict((name, numpy.zeros(length+1, dtype=numpy.int64)) for name, length in self.referenceLengths)
+        self.starts = dict((name, []) for name, length in self.referenceLengths)
+        self.ends = dict((name, []) for name, length in self.referenceLengths)
+
+    def referenceLengths(faiPath):
+        #[(name, length)] of the references, from samtools faidx output
+        with open(faiPath) as f:
+            return [(fields[0], int(fields[1])) for fields in (line.split("\t") for line in f if line.strip())]
+
+    def add(self, line):
+        #Adds one SAM line (header lines are ignored)
+        if line.startswith('@'):
+            return
+        fields = line.split("\t", 6)
+        if int(fields[1]) & SamCoverage.skipFlags or fields[2] not in self.starts:
+            return
+        position = int(fields[3])-1
+        starts = self.starts[fields[2]]
+        ends = self.ends[fields[2]]
+        for length, operation in SamCoverage.cigarOperation.findall(fields[5]):
+            if operation in 'M=X':
+                starts.append(position)
+                ends.append(position+int(length))
+            if operation in 'MDN=X':
+                position += int(length)
+        if len(starts) >= SamCoverage.flushEvery:
+            self.flush(fields[2])
+
+    def flush(self, name):
+        if not self.starts[name]:
+            return
+        length = len(self.changes[name])
+        #Blocks running past the end of a reference (circular plasmids) are cut off there
+        starts = numpy.minimum(numpy.array(self.starts[name], dtype=numpy.int64), length-1)
+        ends = numpy.minimum(numpy.array(self.ends[name], dtype=numpy.int64), length-1)
+        self.changes[name] += numpy.bincount(starts, minlength=length)
+        self.changes[name] -= numpy.bincount(ends, minlength=length)
+        self.starts[name] = []
+        self.ends[name] = []
+
+    def addCoverage(self, other):
+        #Adds the depth of other (e.g. of another slice of the same pool)
+        for name, length in self.referenceLengths:
+            other.flush(name)
+            self.changes[name] += other.changes[name]
+
+    def save(self, path):
+        #Change arrays of every reference as .npz, for load() (e.g. the coverage of one slice)
+        for name, length in self.referenceLengths:
+            self.flush(name)
+        numpy.savez(path, *[self.changes[name] for name, length in self.referenceLengths],
+                    names=numpy.array([name for name, length in self.referenceLengths]))
+
+    def load(path):
+        with numpy.load(path) as saved:
+            names = [str(name) for name in saved['names']]
+            coverage = SamCoverage([(name, len(saved['arr_'+str(index)])-1) for index, name in enumerate(names)])
+            for index, name in enumerate(names):
+                coverage.changes[name] += saved['arr_'+str(index)]
+        return coverage
+
+    def depth(self, name):
+        #Depth at positions 1..length of a reference, as an array indexed from 0
+        self.flush(name)
+        return numpy.cumsum(self.changes[name])[:-1]
+
+    def write(self, path):
+        #All positions in samtools depth format (reference, position, depth)
+        with open(path, 'w') as f:
+            for name, length in self.referenceLengths:
+                depth = self.depth(name)
+                for position in range(length):
+                    f.write("%s\t%d\t%d\n" % (name, position+1, depth[position]))
@@ -0,0 +1,73 @@
+import os, re, subprocess
+from argparse import ArgumentParser
+from SamCoverage import SamCoverage
+
+class SliceCoverage():
+    #Coverage of a pool counted from its slice BAMs while beta_run_alignments.pl is still aligning
+    #the others, so it is final as soon as the last slice is (postprocessing.py then uses depth.txt
+    #instead of running GATK DepthOfCoverage on the merged BAM)
+    # - run_bwa.pl hard links every finished slice to bam_dir/<slice>.done.bam, which keeps it
+    #   readable after MergeSamFiles removes the slice
+    # - each link is counted into bam_dir/<slice>.coverage.npz and removed
+    # - once every slice of fastq_dir has its .npz, they are added up into bwa_dir/depth.txt
+    sliceName = re.compile(r'^(se-.+|pe-.+\.1)@\d+\.fq\.gz$') #Slices run_bwa.pl aligns as read1
+
+    def __init__(self, bwaDir, samtools):
+        self.bwaDir = bwaDir
+        self.bamDir = os.path.join(bwaDir, "bam_dir")
+        self.samtools = samtools
+
+    def expectedSlices(self):
+        #Names of the slice BAMs run_bwa.pl writes, e.g. se-32-2_S8_L001_R1_001@1
+        return sorted(filename[:-len(".fq.gz")] for filename in os.listdir(os.path.join(self.bwaDir, "fastq_dir"))
+                      if SliceCoverage.sliceName.match(filename))
+
+    def countedSlices(self):
+        if not os.path.isdir(self.bamDir):
+            return []
+        return sorted(filename[:-len(".coverage.npz")] for filename in os.listdir(self.bamDir)
+                      if filename.endswith(".coverage.npz"))
+
+    def count(self, name, referenceLengths):
+        #Counts bam_dir/<name>.done.bam into bam_dir/<name>.coverage.npz
+        path = os.path.join(self.bamDir, name)
+        coverage = SamCoverage(referenceLengths)
+        p = subprocess.Popen([self.samtools, "view", path+".done.bam"], stdout=subprocess.PIPE, universal_newlines=True)
+        for line in p.stdout:
+            coverage.add(line)
+        if p.wait() != 0:
+            raise IOError("samtools view of "+path+".done.bam exited with code "+str(p.returncode))
+        coverage.save(path+".coverage.tmp.npz")
+        os.replace(path+".coverage.tmp.npz", path+".coverage.npz")
+        os.remove(path+".done.bam")
+
+    def update(self, referenceLengths):
+        #Counts the slices finished since the last call; returns True once depth.txt is written
+        if not os.path.isdir(self.bamDir):
+            return False
+        for filename in sorted(os.listdir(self.bamDir)):
+            if filename.endswith(".done.bam"):
+                self.count(filename[:-len(".done.bam")], referenceLengths)
+        expected = self.expectedSlices()
+        if not expected or self.countedSlices() != expected:
+            return False
+        total = SamCoverage(referenceLengths)
+        for name in expected:
+            total.addCoverage(SamCoverage.load(os.path.join(self.bamDir, name+".coverage.npz")))
+        total.write(os.path.join(self.bwaDir, "depth.txt.tmp"))
+        os.replace(os.path.join(self.bwaDir, "depth.txt.tmp"), os.path.join(self.bwaDir, "depth.txt"))
+        return True
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("bwaDirs", nargs='+',
+            help="bwa_dir folders of the pools being aligned")
+    parser.add_argument("--fai", dest="fai", required=True,
+            help="references.fasta.fai of the run")
+    parser.add_argument("--samtools", dest="samtools", default="samtools",
+            help="Path to samtools")
+    args = parser.parse_args()
+    referenceLengths = SamCoverage.referenceLengths(args.fai)
+    for bwaDir in args.bwaDirs:
+        if SliceCoverage(bwaDir, args.samtools).update(referenceLengths):
+            print("%s: depth.txt written" % bwaDir)
@@ -0,0 +1,71 @@
+#Checks that merged GATK shard outputs match one run over every reference: python3 "Test Scripts/gatkshards.py"
+import os, sys, shutil, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Postprocessing"))
+from postprocessing import shard_references, merge_shards, merge_loci_summaries, covdepth_locus, vcf_locus, bed_locus
+
+references = [("pBbA5c", 40), ("pBbE1k", 25), ("pSC101", 30), ("pUC19", 10)]
+contigs = ["##contig=<ID=%s,length=%d>\n" % reference for reference in references]
+
+def commandLine(intervals):
+    return "##GATKCommandLine=<ID=UnifiedGenotyper,CommandLineOptions=\"intervals=%s\">\n" % intervals
+
+#What one run over every reference writes, header then records
+vcfHeader = ["##fileformat=VCFv4.1\n"]+contigs+["#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"]
+vcfRecords = ["%s\t%d\t.\tA\tG\t50\t.\tDP=%d\n" % (name, position, position) for name, length in references for position in range(3, length, 7)]
+covdepthHeader = ["Locus\tTotal_Depth\tAverage_Depth_sample\tDepth_for_sample\n"]
+covdepthRecords = ["%s:%d\t%d\t%d.00\t%d\n" % (name, position, position, position, position) for name, length in references for position in range(1, length+1)]
+bedRecords = ["%s\t0\t%d\tCALLABLE\n" % (name, length-2) for name, length in references]+["%s\t%d\t%d\tLOW_COVERAGE\n" % (name, length-2, length) for name, length in references]
+bedRecords.sort(key=lambda line: ([name for name, length in references].index(line.split("\t")[0]), int(line.split("\t")[1])))
+
+def shardOf(line, locus, shards):
+    return [index for index, names in enumerate(shards) if locus(line)[0] in names][0]
+
+def writeShards(folder, name, shards, headers, records, locus):
+    paths = []
+    for index, names in enumerate(shards):
+        paths.append(os.path.join(folder, "%s.%d" % (name, index)))
+        with open(paths[-1], 'w') as f:
+            f.writelines(headers(index))
+            f.writelines(line for line in records if shardOf(line, locus, shards) == index)
+    return paths
+
+folder = tempfile.mkdtemp()
+try:
+    shards = shard_references(references, 3)
+    assert sorted(name for names in shards for name in names) == sorted(name for name, length in references)
+    assert all(names == sorted(names, key=[name for name, length in references].index) for names in shards)
+
+    #Records of the merged shards are those of the unsharded run, in reference order
+    output = os.path.join(folder, "covdepth")
+    merge_shards(writeShards(folder, "covdepth", shards, lambda index: covdepthHeader, covdepthRecords, covdepth_locus),
+                 output, references, lambda line: line.startswith("Locus\t"), covdepth_locus)
+    assert open(output).readlines() == covdepthHeader+covdepthRecords
+    output = os.path.join(folder, "callable.bed")
+    merge_shards(writeShards(folder, "callable.bed", shards, lambda index: [], bedRecords, bed_locus),
+                 output, references, lambda line: False, bed_locus)
+    assert open(output).readlines() == bedRecords
+    print("covdepth and BED: OK")
+
+    #The VCF keeps the command line of every shard, above the #CHROM line
+    output = os.path.join(folder, "snps.gatk.vcf")
+    merge_shards(writeShards(folder, "snps.gatk.vcf", shards, lambda index: vcfHeader[:-1]+[commandLine("shard.%d.list" % index)]+vcfHeader[-1:], vcfRecords, vcf_locus),
+                 output, references, lambda line: line.startswith("#"), vcf_locus)
+    lines = open(output).readlines()
+    assert lines[len(vcfHeader)+len(shards):] == vcfRecords
+    header = lines[:len(vcfHeader)+len(shards)]
+    assert header[-1] == vcfHeader[-1] and set(header) == set(vcfHeader+[commandLine("shard.%d.list" % index) for index in range(len(shards))]), header
+    print("VCF: OK")
+
+    #CallableLoci -summary counts add up
+    paths = []
+    for index, names in enumerate(shards):
+        paths.append(os.path.join(folder, "summary.%d" % index))
+        with open(paths[-1], 'w') as f:
+            f.write("state nBases\nREF_N 0\nCALLABLE %d\nLOW_COVERAGE %d\n" % (sum(length-2 for name, length in references if name in names), 2*len(names)))
+    merge_loci_summaries(paths, os.path.join(folder, "summary"))
+    assert open(os.path.join(folder, "summary")).read() == "state nBases\nREF_N 0\nCALLABLE %d\nLOW_COVERAGE %d\n" % (
+        sum(length-2 for name, length in references), 2*len(references))
+    print("CallableLoci summary: OK")
+finally:
+    shutil.rmtree(folder)
@@ -0,0 +1,115 @@
+#Checks ICEReferenceFetcher against a local HTTP stand-in for ICE: python3 "Test Scripts/icereferences.py"
+import os, sys, json, time, shutil, tempfile, threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ICEReferences import ICEClient, ICEReferenceCache, ICEReferenceFetcher, ICEError
+
+#Entry ID -> [modification time, FASTA]
+entries = {
+    "101": [1000, ">pBbA5c\nACGTACGTAC\nGTACGT\n"],
+    "102": [1000, ">pBbE1k\nTTTTGGGGCCCCAAAA"], #No trailing newline
+    "103": [1000, ">pSC101\nNNACGT\n"],
+    "105": [1000, None],
+}
+requests = []
+
+class ICEStandIn(BaseHTTPRequestHandler):
+    def do_GET(self):
+        requests.append(self.path)
+        if self.headers.get("X-ICE-Authentication-SessionId") != "session":
+            self.send_error(401)
+            return
+        parts = self.path.strip("/").split("/")
+        if self.path == "/rest/parts/104": #Proxy error page instead of JSON
+            body = b"<html><body>502 Bad Gateway</body></html>"
+        elif self.path == "/rest/file/105/sequence/fasta": #Connection drops mid-download
+            self.send_response(200)
+            self.send_header("Content-Length", "1000")
+            self.end_headers()
+            self.wfile.write(b">pTrunc\nACGT")
+            return
+        elif parts[:2] == ["rest", "parts"] and parts[2] in entries:
+            body = json.dumps({'id': parts[2], 'modificationTime': entries[parts[2]][0]}).encode()
+        elif parts[:2] == ["rest", "file"] and parts[2] in entries and parts[3:] == ["sequence", "fasta"]:
+            time.sleep(0.2 if parts[2] == "101" else 0) #First entry finishes last
+            body = entries[parts[2]][1].encode()
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        requests.append(self.path)
+        login = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        body = json.dumps({'sessionId': "session"} if login['password'] == "Administrator" else {'error': "denied"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+server = HTTPServer(("127.0.0.1", 0), ICEStandIn)
+serverThread = threading.Thread(target=server.serve_forever)
+serverThread.daemon = True
+serverThread.start()
+folder = tempfile.mkdtemp()
+try:
+    client = ICEClient("http://127.0.0.1:"+str(server.server_port), email="Administrator", password="Administrator")
+    fetcher = ICEReferenceFetcher(client, ICEReferenceCache(os.path.join(folder, "cache")), 3)
+    output = os.path.join(folder, "references.fasta")
+
+    #Entries are written in the order asked for, each starting on its own line
+    fetcher.writeReferences(["101", "102", "103"], output)
+    expected = entries["101"][1]+entries["102"][1]+"\n"+entries["103"][1]
+    assert open(output).read() == expected, open(output).read()
+    assert requests.count("/rest/accesstoken") == 1
+    print("Fetched in order: OK")
+
+    #Unchanged entries come from the cache
+    del requests[:]
+    fetcher.writeReferences(["103", "101"], output)
+    assert open(output).read() == entries["103"][1]+entries["101"][1]
+    assert not [path for path in requests if "/sequence/" in path], requests
+    print("Cached entries reused: OK")
+
+    #An edited entry is fetched again and replaces its older copy
+    entries["102"] = [2000, ">pBbE1k\nAAAA\n"]
+    del requests[:]
+    fetcher.writeReferences(["102"], output)
+    assert open(output).read() == entries["102"][1]
+    assert requests == ["/rest/parts/102", "/rest/file/102/sequence/fasta"], requests
+    assert os.listdir(os.path.join(folder, "cache", "102")) == ["2000.fasta"]
+    print("Edited entry fetched again: OK")
+
+    #A missing entry fails the whole file, leaving no partial references.fasta
+    os.remove(output)
+    try:
+        fetcher.writeReferences(["101", "999"], output)
+        assert False, "Expected ICEError"
+    except ICEError as ex:
+        print("Missing entry: OK ("+str(ex)+")")
+    assert not os.path.exists(output) and not os.path.exists(output+".part")
+
+    #Malformed or cut off replies fail as ICEError too, leaving nothing half written in the cache
+    for entryID in ["104", "105"]:
+        try:
+            fetcher.writeReferences([entryID], output)
+            assert False, "Expected ICEError"
+        except ICEError as ex:
+            print("Malformed reply for "+entryID+": OK ("+str(ex)+")")
+        assert not os.path.exists(output)
+    assert os.listdir(os.path.join(folder, "cache", "105")) == []
+    try:
+        ICEClient(client.host, email="Administrator", password="wrong").modificationStamp("101")
+        assert False, "Expected ICEError"
+    except ICEError as ex:
+        print("Login without session ID: OK ("+str(ex)+")")
+finally:
+    server.shutdown()
+    shutil.rmtree(folder)
@@ -0,0 +1,79 @@
+#Checks that the slice size pipeline.py picks gives a paired pool one slice per alignment worker: python3 "Test Scripts/slicesize.py"
+import os, sys, gzip, shutil, tempfile, subprocess
+
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+from FastqProfiler import FastqProfiler
+
+workers = 4
+pairs = 1000
+
+def writeFastq(path, records):
+    with gzip.open(path, 'wt') as f:
+        for name, mate in records:
+            f.write("@"+name+"/"+str(mate)+"\nACGTACGTAC\n+\nIIIIIIIIII\n")
+
+#fastq_slice.pl needs Modern::Perl; without it slices are counted by its rule, a new slice every -num reads
+#(pairs with -split) of each file
+slicer = os.path.join(repository, "MiSeqBAMGenerationTools", "fastq_slice.pl")
+runSlicer = subprocess.call(["perl", "-MModern::Perl", "-e", "1"], stderr=subprocess.DEVNULL) == 0
+
+def slices(fastqDir, sliceReads, fastqs, split):
+    #Slices of the pool as fastq_slice.pl (run by beta_slice_fq.pl) writes them, counted as mate 1 slices
+    if not runSlicer:
+        counted = 0
+        for fastq in fastqs:
+            if "_R2_" not in fastq:
+                with gzip.open(fastq, 'rt') as f:
+                    reads = sum(1 for line in f)//4//(2 if split else 1)
+                counted += -(-reads//sliceReads)
+        return counted
+    sliceDir = os.path.join(fastqDir, "slices")
+    os.makedirs(sliceDir)
+    for fastq in fastqs:
+        prefix = os.path.join(sliceDir, os.path.basename(fastq).replace(".fastq.gz", ""))
+        subprocess.check_call(["perl", slicer, "-num", str(sliceReads), "-suffix", "fq", "-file", fastq, "-prefix", prefix]+(["-split"] if split else []),
+                              stdout=subprocess.DEVNULL)
+    return len([name for name in os.listdir(sliceDir) if "_R2_" not in name and ".2@" not in name])
+
+def profiles(fastqDir):
+    found = []
+    for path in FastqProfiler.fastqs(fastqDir):
+        profile = FastqProfiler.profile(path)
+        profile["fastqDir"] = fastqDir
+        found.append(profile)
+    return found
+
+if not runSlicer:
+    print("fastq_slice.pl can't run (no Modern::Perl), counting slices from the reads")
+folder = tempfile.mkdtemp()
+try:
+    #R1/R2 files of a MiSeq sample: -num counts the reads of each file
+    pool = os.path.join(folder, "pool1_libName", "fastq_dir")
+    os.makedirs(pool)
+    fastqs = [os.path.join(pool, "pool1_S1_L001_R"+str(mate)+"_001.fastq.gz") for mate in (1, 2)]
+    for mate, fastq in zip((1, 2), fastqs):
+        writeFastq(fastq, [("read"+str(pair), mate) for pair in range(pairs)])
+    sliceReads = FastqProfiler.sliceReads(profiles(pool), workers, 1, 8000000)
+    assert sliceReads == pairs//workers, sliceReads
+    assert slices(pool, sliceReads, fastqs, False) == workers
+    print("R1/R2 pool: OK ("+str(sliceReads)+" reads per slice)")
+
+    #Interleaved pairs in one file: -num counts pairs
+    pool = os.path.join(folder, "pool2_libName", "fastq_dir")
+    os.makedirs(pool)
+    fastq = os.path.join(pool, "pool2.fastq.gz")
+    writeFastq(fastq, [("read"+str(pair), mate) for pair in range(pairs) for mate in (1, 2)])
+    sliceReads = FastqProfiler.sliceReads(profiles(pool), workers, 1, 8000000)
+    assert sliceReads == pairs//workers, sliceReads
+    assert slices(pool, sliceReads, [fastq], True) == workers
+    print("Interleaved pool: OK ("+str(sliceReads)+" pairs per slice)")
+
+    #The largest pool sets the size, within the given bounds
+    writeFastq(os.path.join(folder, "pool1_libName", "fastq_dir", "pool1_S1_L001_R1_001.fastq.gz"), [("read"+str(pair), 1) for pair in range(2*pairs)])
+    both = profiles(os.path.join(folder, "pool1_libName", "fastq_dir"))+profiles(pool)
+    assert FastqProfiler.sliceReads(both, workers, 1, 8000000) == 2*pairs//workers
+    assert FastqProfiler.sliceReads(both, workers, 600, 8000000) == 600
+    print("Largest pool: OK")
+finally:
+    shutil.rmtree(folder)
@@ -0,0 +1,76 @@
+#Checks the bam and bai svelt.py extracts from indexed pool bams (needs pysam): python3 "Test Scripts/sveltbam.py"
+import os, sys, random, shutil, tempfile, subprocess
+import pysam
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import svelt
+
+#Pool -> [(reference, length, reads)]; clone pX is in both pools
+pools = {
+    "pool1": [("pA", 3000, 50), ("pX", 40000, 300), ("pB", 2000, 20)],
+    "pool2": [("pC", 2500, 10), ("pX", 40000, 200)],
+}
+constructs = [{'clone': "pX", 'pool': "pool1"}, {'clone': "pB", 'pool': "pool1"},
+              {'clone': "pX", 'pool': "pool2"}, {'clone': "pC", 'pool': "pool2"}]
+expected = [("pX", 500), ("pB", 20), ("pC", 10)]
+
+def samtools(*arguments):
+    #samtools if it is installed, else the samtools pysam comes with
+    if shutil.which("samtools"):
+        return subprocess.check_output(["samtools"]+list(arguments)).decode()
+    return getattr(pysam, arguments[0])(*arguments[1:])
+
+def writePoolBam(path, references, generator):
+    header = {'HD': {'VN': "1.4", 'SO': "unsorted"}, 'SQ': [{'SN': name, 'LN': length} for name, length, reads in references],
+              'PG': [{'ID': "bwa", 'PN': "bwa"}]}
+    with pysam.AlignmentFile(path+".unsorted.bam", "wb", header=header) as bam:
+        for tid, (name, length, reads) in enumerate(references):
+            for number in range(reads//2):
+                start = generator.randint(0, length-300)
+                for mate, position in enumerate((start, start+150)):
+                    read = pysam.AlignedSegment()
+                    read.query_name = "%s_%s_%d" % (os.path.basename(os.path.dirname(os.path.dirname(path))), name, number)
+                    read.query_sequence = "ACGT"*25
+                    read.query_qualities = pysam.qualitystring_to_array("I"*100)
+                    read.flag = 1 | 2 | (64 if mate == 0 else 128) | (32 if mate == 0 else 16)
+                    read.reference_id = read.next_reference_id = tid
+                    read.reference_start = position
+                    read.next_reference_start = start+150 if mate == 0 else start
+                    read.mapping_quality = 60
+                    read.cigarstring = "100M"
+                    bam.write(read)
+    pysam.sort("-o", path, path+".unsorted.bam")
+    os.remove(path+".unsorted.bam")
+    pysam.index(path)
+
+folder = tempfile.mkdtemp()
+current = os.getcwd()
+try:
+    generator = random.Random(1)
+    for pool, references in sorted(pools.items()):
+        os.makedirs(os.path.join(folder, pool, "roi"))
+        writePoolBam(os.path.join(folder, pool, "roi", "aligned_reads.bam"), references, generator)
+    os.chdir(folder)
+    svelt.create_bam("PB", folder, "svelt", constructs)
+
+    #One reference per clone, with the reads of every pool it was listed for
+    stats = [line.split("\t") for line in samtools("idxstats", "svelt.bam").splitlines()]
+    assert [(name, int(mapped)) for name, length, mapped, unmapped in stats if name != "*"] == expected, stats
+    assert int(samtools("view", "-c", "svelt.bam").strip()) == sum(reads for name, reads in expected)
+    for name, reads in expected:
+        assert int(samtools("view", "-c", "svelt.bam", name).strip()) == reads
+    print("Reads of each clone: OK")
+
+    #Sorted, with mates on the new references, and the bai finds the reads of any region
+    with pysam.AlignmentFile("svelt.bam") as bam:
+        reads = list(bam.fetch(until_eof=True))
+        assert [(read.reference_id, read.reference_start) for read in reads] == sorted((read.reference_id, read.reference_start) for read in reads)
+        assert all(read.next_reference_id == read.reference_id for read in reads)
+        assert set(read.query_name.split("_")[0] for read in reads if read.reference_name == "pX") == set(["pool1", "pool2"])
+        for name, start, end in [("pX", 0, 1000), ("pX", 16000, 17000), ("pX", 39000, 40000), ("pB", 500, 600)]:
+            overlapping = [read for read in reads if read.reference_name == name and read.reference_start < end and read.reference_end > start]
+            assert bam.count(name, start, end) == len(overlapping), (name, start, end)
+    print("Sorted and indexed: OK")
+finally:
+    os.chdir(current)
+    shutil.rmtree(folder)
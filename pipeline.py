@@ -1,6 +1,21 @@
-import sys, os, shutil, subprocess, time
+import sys, os, shutil, time, json, atexit, threading
+import concurrent.futures
 #For getting fastq.gz and references.fasta data
 from MiSeqServerData import MiSeqServerData, ICEServerData
+from MiSeqDataCache import MiSeqDataCache
+from MiSeqRunIndex import MiSeqRunIndex
+#For fetching reference sequences from ICE
+from ICEReferences import ICEClient, ICEReferenceCache, ICEReferenceFetcher, ICEError
+#For reusing reference indexes between runs
+from ReferenceCache import ReferenceCache
+#For timing stages and external commands
+from PipelineProfiler import PipelineProfiler
+#For running external tools with timeouts and output logging
+from ProcessSupervisor import ProcessSupervisor
+#For resuming interrupted runs
+from PipelineCheckpoints import PipelineCheckpoints
+#For sizing slices from the reads of each pool
+from FastqProfiler import FastqProfiler
 #For command line arguments parser
 from argparse import ArgumentParser
 #For email function
@@ -16,6 +31,8 @@ from email.mime.text import MIMEText
 #Paths to folders and tools
 pathToPipeline = "/src" #Path where this script, pipeline.py, is actually being run from
 pathToMiSeqSequenceStorage = pathToPipeline+"/"+"SMBMiSeqData" #Where MiSeq fastq.gz sequences are stored locally
+pathToReferenceCache = pathToPipeline+"/"+"ReferenceCache" #Where indexes of reference sets are kept between runs
+pathToICEReferences = pathToPipeline+"/"+"ICEReferences" #Where FASTA files of ICE entries are kept between runs
 #Path to External Tools
 pathToTools = pathToPipeline+"/tools"
 #Picard, BWA, Samtools, GATK libraries
@@ -39,18 +56,78 @@ timeStamp = int(time.time())
 ''''''''''''''''''
 
 #Formatting
+logLock = threading.Lock() #Samples log from their own threads in --streaming mode
 def log(file, msg):
-  file.write(msg+"\n")
-  print(msg+"\n")
+  with logLock:
+    file.write(msg+"\n")
+    print(msg+"\n")
+#Structured progress events, one JSON object per line, streamed to the website by /job_events
+stageStartTimes = {}
+def event(stage, state, sample=None, **details):
+  now = time.time()
+  record = {"time": now, "stage": stage, "state": state}
+  if sample is not None:
+    record["sample"] = sample
+  with logLock:
+    if state == "started":
+      stageStartTimes[(stage, sample)] = now
+      profiler.begin(stage, sample)
+    elif (stage, sample) in stageStartTimes:
+      record["seconds"] = round(now-stageStartTimes[(stage, sample)], 3)
+      if state in ("finished", "failed"):
+        profiler.end(stage, sample)
+    record.update(details)
+    events.write(json.dumps(record, sort_keys=True)+"\n")
+    events.flush()
+pipelineFinished = False
+def finishRun():
+  if not pipelineFinished:
+    event("pipeline", "failed")
+  #Profile of the run, also for failed runs: profile.json and profile.trace.json in the main library
+  if os.path.isdir(pathToMainLibrary):
+    profiler.write(pathToMainLibrary)
 commands = [] #List of commands to set up directories and files
-def doCommands(commands, writeOutput, logFile):
+profiler = PipelineProfiler()
+def doCommands(commands, writeOutput, logFile, timeout=None, slotted=True):
+  #Runs commands one after the other through the supervisor (created once the main library exists),
+  #which waits for each, enforces --commandTimeout/--memoryLimit and keeps stderr in logs/
+  #timeout overrides --commandTimeout, 0 for none
+  #slotted=False starts them without waiting for one of the --maxParallel slots (see ProcessSupervisor.runNow)
+  #Returns False as soon as a command fails
   startTime = time.time()
   for c in commands:
-    p = subprocess.Popen(c, stdout=subprocess.PIPE)
-    if (writeOutput):
-        for line in p.stdout: log(logFile, line.decode())
+    run = supervisor.run if slotted else supervisor.runNow
+    result = run(c, timeout, onOutput=(lambda line: log(logFile, line.rstrip("\n"))) if writeOutput else None)
+    if not result.ok():
+      log(logFile, ProcessSupervisor.describe(result)+", see "+str(result.logPath))
+      for line in result.stderrTail:
+        log(logFile, "  "+line.rstrip("\n"))
+      return False
   endTime = time.time()
-  log(l, str(endTime-startTime)+" seconds")
+  log(logFile, str(endTime-startTime)+" seconds")
+  return True
+def runStage(stage, commands, timeout=None, sample=None):
+  #Runs the commands of a stage (for one sample in --streaming mode) unless a checkpoint shows it
+  #already completed (--resume); returns False if it failed, so that --resume can pick it up again
+  #commands can also be a function doing the stage's work and returning whether it succeeded
+  if checkpoints.isDone(stage, sample):
+    log(l, "Skipping "+stage+(" for "+sample if sample else "")+", already completed")
+    event(stage, "skipped", sample)
+    return True
+  event(stage, "started", sample)
+  if not (commands() if callable(commands) else doCommands(commands, True, l, timeout)):
+    event(stage, "failed", sample)
+    log(l, "Stage "+stage+(" for "+sample if sample else "")+" failed. Fix the problem and rerun with --resume to continue from here.")
+    return False
+  checkpoints.markDone(stage, sample)
+  event(stage, "finished", sample)
+  return True
+def cleanPools(subfolders, pools=None):
+  #Removes what an interrupted stage left in every pool (or the given ones), e.g. bwa_dir/fastq_dir slices, before it is rerun
+  for pool in (pools or os.listdir(pathToMainLibrary)):
+    for subfolder in subfolders:
+      if os.path.isdir(pathToMainLibrary+"/"+pool+"/"+subfolder):
+        rmdir(pathToMainLibrary+"/"+pool+"/"+subfolder)
 #File commands
 def mkdir(folder):
     os.makedirs(folder, exist_ok=True)
@@ -98,6 +175,60 @@ parser.add_argument("-l", "--logFile",
 parser.add_argument('-n', "--nerscVersion",
         dest='nerscVersion', default=False,
         action='store_true')
+parser.add_argument("--smbConnections",
+        dest="smbConnections", type=int, default=MiSeqServerData.rangeConcurrency,
+        help="Number of parallel SMB connections used to download a single large fastq.gz file (1 disables ranged downloads)")
+parser.add_argument("--smbRangeSize",
+        dest="smbRangeSize", type=int, default=MiSeqServerData.rangeSize//(1024*1024),
+        help="Size in MB of each byte range fetched by one SMB connection; files under 4 ranges use a single stream")
+parser.add_argument("--mountPoint",
+        dest="mountPoint", default=os.environ.get("MISEQ_MOUNT", ""),
+        help="Directory where //smb.jbei.org/miseq is mounted (see mount-smb.rb); fastq.gz files are used from there instead of copied over SMB")
+parser.add_argument("--cacheQuota",
+        dest="cacheQuota", type=int, default=200,
+        help="Disk quota in GB for fastq.gz files cached in SMBMiSeqData; least recently used files are evicted (0 for no limit)")
+parser.add_argument("--iceHost",
+        dest="iceHost", default=os.environ.get("ICE_HOST", ""),
+        help="ICE server the reference sequences (entry IDs) are fetched from, e.g. https://registry.jbei.org; credentials are read from ICE_SESSION_ID or ICE_EMAIL and ICE_PASSWORD")
+parser.add_argument("--iceConnections",
+        dest="iceConnections", type=int, default=4,
+        help="Number of ICE entries fetched at once")
+parser.add_argument("--referenceCacheQuota",
+        dest="referenceCacheQuota", type=int, default=20,
+        help="Disk quota in GB for reference indexes kept in ReferenceCache; least recently used reference sets are evicted (0 for no limit)")
+parser.add_argument("--quick-look",
+        dest="quickLook", type=int, nargs='?', const=100000, default=0,
+        help="Publish provisional calls from the first reads (default 100000) of each sample while the full analysis runs")
+parser.add_argument("--prefilterKmers",
+        dest="prefilterKmers", type=int, default=0,
+        help="Drop reads (with their mate) sharing fewer than this many 21-mers with the references before alignment, e.g. 3 (0 aligns every read)")
+parser.add_argument("--targetDepth",
+        dest="targetDepth", type=float, default=0,
+        help="Mean coverage the reads of each sample are downsampled to before alignment, e.g. 200 (0 aligns every read)")
+parser.add_argument("--cores",
+        dest="cores", type=int, default=os.cpu_count(),
+        help="Cores available for alignment; slices are sized so every core has one to align")
+parser.add_argument("--gatkShards",
+        dest="gatkShards", type=int, default=1,
+        help="Sets of references of about the same total length each GATK tool of a pool runs on at once (1 runs it once on every reference)")
+parser.add_argument("--maxParallel",
+        dest="maxParallel", type=int, default=2,
+        help="Number of independent external commands (e.g. postprocessing of different pools) run at once")
+parser.add_argument("--commandTimeout",
+        dest="commandTimeout", type=float, default=12,
+        help="Hours after which an external command is killed (0 for no limit)")
+parser.add_argument("--memoryLimit",
+        dest="memoryLimit", type=float, default=0,
+        help="Address space limit in GB for each external command (0 for no limit)")
+parser.add_argument("--streaming",
+        dest="streaming", default=False, action='store_true',
+        help="Take every sample through slicing, alignment and postprocessing as soon as its own fastq.gz files are downloaded")
+parser.add_argument("--resume",
+        dest="resume", default=False, action='store_true',
+        help="Keep the existing main library folder and continue from the first stage that did not complete")
+parser.add_argument("--force-stage",
+        nargs='+', dest="forceStages", default=[], choices=PipelineCheckpoints.stages,
+        help="Rerun these stages (and every later one) even if they completed; implies --resume")
 args = parser.parse_args()
 #Assign command line args to local variables
 mainLibrary = args.mainLibrary
@@ -106,6 +237,11 @@ referenceSequences = args.referenceSequences
 email = args.email
 logFile = args.logFile
 nerscVersion = args.nerscVersion
+MiSeqServerData.rangeConcurrency = max(1, args.smbConnections)
+MiSeqServerData.rangeSize = max(1, args.smbRangeSize)*1024*1024
+MiSeqServerData.parallelThreshold = 4*MiSeqServerData.rangeSize
+cacheQuota = args.cacheQuota
+MiSeqServerData.mountPoint = args.mountPoint
 
 #NERSC Version of tools
 if nerscVersion:
@@ -124,6 +260,10 @@ pathToLibrariesInfo = pathToMainLibrary+"/"+"libraries.info"
 
 #Create Log file.txt
 l = open(logFile, 'w')
+#Event log next to it, e.g. logOfPipeline_<ts>.events.jsonl
+events = open(os.path.splitext(logFile)[0]+".events.jsonl", 'w')
+event("pipeline", "started", mainLibrary=mainLibrary, subLibraries=subLibraries)
+atexit.register(finishRun)
 #Log command line arguments
 log(l, "Arguments passed:")
 log(l, "Main Library: "+mainLibrary)
@@ -131,6 +271,7 @@ log(l, "Sub Libraries: "+str(subLibraries))
 log(l, "Reference Sequences "+str(referenceSequences))
 log(l, "Email "+str(email))
 log(l, "Use NERSC version of tools: "+str(nerscVersion))
+log(l, "MiSeq share mount point: "+(args.mountPoint or "none, using SMB"))
 log(l, "")
 
 
@@ -140,71 +281,471 @@ log(l, "")
 #
 
 #Create Project Directory
-if (os.path.isdir(pathToMainLibrary)):
-  #Folder already exists for this project, delete it and start over
+resume = args.resume or bool(args.forceStages)
+if os.path.isdir(pathToMainLibrary) and not resume:
+  #Folder already exists for this project, delete it in the background and start over
   log(l, "Folder already exists for this library. Deleting...")
-  rmdir(pathToMainLibrary)
+  PipelineCheckpoints.discard(pathToMainLibrary)
 log(l, "Folder created for "+mainLibrary)
 mkdir(pathToMainLibrary)
 cd(pathToMainLibrary)
+#Stage checkpoints, see --resume
+checkpoints = PipelineCheckpoints(pathToMainLibrary)
+if not checkpoints.checkInputs({"mainLibrary": mainLibrary, "subLibraries": subLibraries, "referenceSequences": referenceSequences}):
+  log(l, "Samples or references differ from the previous run of this library, only its downloads are reused")
+for stage in args.forceStages:
+  checkpoints.invalidate(stage)
+if resume:
+  log(l, "Resuming from stage: "+str(checkpoints.firstIncomplete()))
+#stderr of every external command goes to logs/<n>_<command>.log
+supervisor = ProcessSupervisor(pathToMainLibrary+"/logs", args.maxParallel,
+    args.commandTimeout*3600 or None, int(args.memoryLimit*1024*1024*1024) or None, profiler)
 #Make reference directory, ref/
 mkdir("ref")
 
 
 ########################################################################################
 #
-#GET and WRITE Library metadata and FASTQ.GZ files
+#Stages, shared by the default run and --streaming
 #
 
-#Write files from SMB Server
-log(l, "Getting sublibraries' sequence data from SMB...")
-for index, subLibraryID in enumerate(subLibraries):
-  # We're not actually multithreading here
+fastqCache = MiSeqDataCache(pathToMiSeqSequenceStorage, cacheQuota*1024*1024*1024)
+runIndex = MiSeqRunIndex(pathToMiSeqSequenceStorage)
+referenceCache = ReferenceCache(pathToReferenceCache, args.referenceCacheQuota*1024*1024*1024)
+
+def completedDownload(subLibraryID):
+  #libraries.info lines of a sample whose download checkpoint lists files that still exist, else None
+  done = checkpoints.get("download", subLibraryID)
+  if done is not None and done["fastqs"] and all(os.path.exists(path) for path in done["fastqs"]):
+    log(l, "Skipping download of "+subLibraryID+", already completed")
+    return done["metadata"]
+  return None
+
+def refreshRunIndex(pending):
+  if pending and (not args.mountPoint or not os.path.isdir(args.mountPoint+"/MiSeqOutput/"+mainLibrary)):
+    #One listing of BaseCalls for all samples, which also updates the index the website reads
+    #If it fails the index may still list the run; samples it has no fastq.gz files for fail on their own
+    conn = None
+    try:
+      conn = MiSeqServerData.connect()
+      runIndex.refreshRun(conn, mainLibrary)
+    except Exception as ex:
+      log(l, "Could not refresh the run index for "+mainLibrary+": "+str(ex))
+    finally:
+      if conn is not None:
+        conn.close()
+
+def downloadSample(index, subLibraryID):
+  #Fetches one sample's fastq.gz files; returns its libraries.info lines, or None if that failed
   thread = MiSeqServerData(index,
       mainLibrary,
       subLibraryID,
-      pathToMiSeqSequenceStorage)
-  thread.run()
-  ##Write metadata to libraries.info
-  log(l, "Writing libraries.info file...")
+      pathToMiSeqSequenceStorage,
+      fastqCache,
+      runIndex)
+  try:
+    thread.run()
+  except SystemExit:
+    #MiSeqServerData exits on SMB errors, which only ends the thread in --streaming mode
+    log(l, "Download of "+subLibraryID+" failed")
+    return None
+  if not thread.metadata:
+    #Not in the run index, or a typo in the sample ID; --resume must look for it again
+    log(l, "No fastq.gz files found for "+subLibraryID+" in "+mainLibrary)
+    return None
+  checkpoints.markDone("download", subLibraryID, {"metadata": thread.metadata,
+      "fastqs": [line.split("\t")[2] for line in thread.metadata.splitlines()]})
+  return thread.metadata
+
+# This script is given ICE Entries' IDs
+# Then it queries ICE (see ICEReferences.py), and reads each entry's sequence, from ICEReferences/ if the entry is unchanged since
+# Then it writes the sequences in order to a file called "references.fasta" inside the ref/ folder of the mainLibrary, as stored in the variable - "pathToReferenceFASTA"
+# That's all it does, write a .fasta file to the path located in pathToReferenceFASTA
+
+def writeReferences():
+  if not args.iceHost:
+    #No ICE configured, read the local FASTA files
+    ICEServerThreads = []
+    for index, sequenceName in enumerate(referenceSequences):
+      # Create new threads
+      ICEServerThreads.append(ICEServerData(index, sequenceName+".fasta"))
+      #Start thread
+      ICEServerThreads[index].start()
+    # Wait for all threads to complete
+    for t in ICEServerThreads:
+        t.join()
+    #Write to reference.fasta
+    f = open(pathToReferenceFASTA, "w")
+    for t in ICEServerThreads:
+        f.write(t.sequence)
+    f.close()
+    return True
+  #ICE credentials - SECRET, from the environment (a session ID from login.sh, or the account to log in with)
+  client = ICEClient(args.iceHost, os.environ.get("ICE_SESSION_ID"), os.environ.get("ICE_EMAIL"), os.environ.get("ICE_PASSWORD"))
+  fetcher = ICEReferenceFetcher(client, ICEReferenceCache(pathToICEReferences), args.iceConnections)
+  try:
+    fetcher.writeReferences(referenceSequences, pathToReferenceFASTA)
+  except ICEError as ex:
+    log(l, str(ex))
+    return False
+  return True
+
+def fetchReferences():
+  #Get files from ICE
+  log(l, "Getting reference sequence data from ICE...")
+  return runStage("references", writeReferences)
+
+def prepRefCommand(fasta, *options):
+  return ["perl", pathToMiSeqBAMGenerationTools+"/prep_ref.pl"]+list(options)+[fasta, "-picard_path", pathToPicard, "-bwa_path", pathToBWA, "-samtools_path", pathToSamtools, "-bad_to_n"]
+
+def indexReferences():
+  #prep_ref only cleans up references.fasta here (-bad_to_n, line length); the bwa index, .fai and .dict
+  #of the cleaned up FASTA are linked from the reference cache, and built there by the first run using it
+  pathToNormalizedFASTA = pathToMainLibrary+"/ref/normalized.fasta"
+  if not doCommands([prepRefCommand(pathToReferenceFASTA, "-noindex", "-nodict", "-out", pathToNormalizedFASTA)], True, l):
+    return False
+  shutil.copyfile(pathToReferenceFASTA, pathToReferenceFASTA+".bak") #Keeps the FASTA from ICE as prep_ref would
+  if not referenceCache.provide(pathToNormalizedFASTA, pathToMainLibrary+"/ref",
+      lambda fasta: doCommands([prepRefCommand(fasta, "-index")], True, l)):
+    return False
+  os.remove(pathToNormalizedFASTA)
+  os.remove(pathToNormalizedFASTA+".fai")
+  return True
+
+def prepareReferences():
+  #Run prep_ref to generate .dict, .fasta.fai
+  if not fetchReferences():
+    return False
+  log(l, "Running prep_ref...")
+  return runStage("prep_ref", indexReferences)
+
+def writeLibrariesInfo(path, subLibraryIDs):
+  #Written fresh before every beta_prep_setup_dirs: -rna renames it to <path>.bak.N and rewrites the sample names
+  log(l, "Writing "+os.path.basename(path)+" file...")
+  f = open(path, "w")
+  for subLibraryID in subLibraryIDs:
+    f.write(metadata[subLibraryID])
+  f.close()
+
+def writeConfigXML(path="config.xml", job="bwa_dir"):
+  #Create config.xml (quicklook.xml reads the pools' quicklook/ folders instead of bwa_dir/)
+  log(l, "Creating "+path+" for postprocessing...")
+  f = open(path, "w")
+  f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?><SBAnalysis>')
+  f.write('<analysis name="'+pathToMainLibrary+'" reference="'+pathToReferenceFASTA+'" location="'+pathToPipeline+'">')
+  for index, subLibraryID in enumerate(subLibraries):
+    poolName = subLibraryID+'_libName'
+    f.write('<pool name="'+poolName+'" samples="'+poolName+'"><job name="'+job+'" protocol="bwa_dir"/></pool>')
+  f.write('</analysis></SBAnalysis>')
+  f.close()
+
+def prefilterCommand(subLibraryIDs):
+  #Removal of reads sharing no k-mers with the references (see KmerPrefilter.py)
+  return ["python3", "-u", pathToPipeline+"/KmerPrefilter.py"]+[pathToMainLibrary+"/"+subLibraryID+"_libName/bwa_dir/fastq_dir" for subLibraryID in subLibraryIDs]+[
+      "--fasta", pathToReferenceFASTA, "--minKmers", str(args.prefilterKmers)]
+
+minSliceReads = 500000 #Smaller slices spend more time starting Picard than aligning
+maxSliceReads = 8000000
+
+def alignmentWorkers():
+  #Slices of a pool aligned at once: bwa mem runs 4 threads each, and with --streaming up to
+  #--maxParallel pools align at the same time
+  return max(1, args.cores//(4*(args.maxParallel if args.streaming else 1)))
+
+def sliceSamples(pathToInfo, subLibraryIDs):
+  #beta_slice_fq.pl, with the slice size picked from FastqProfiler.py's read counts so the largest
+  #pool has about one slice per alignment worker
+  pathToProfile = pathToInfo+".profile"
+  fastqDirs = [pathToMainLibrary+"/"+subLibraryID+"_libName/fastq_dir" for subLibraryID in subLibraryIDs]
+  if not doCommands([["python3", "-u", pathToPipeline+"/FastqProfiler.py"]+fastqDirs+["--output", pathToProfile]], True, l):
+    return False
+  sliceReads = FastqProfiler.sliceReads(FastqProfiler.read(pathToProfile), alignmentWorkers(), minSliceReads, maxSliceReads)
+  log(l, "Slicing into "+str(sliceReads)+" reads per slice for "+str(alignmentWorkers())+" alignment workers")
+  return doCommands([["perl", pathToMiSeqBAMGenerationTools+"/beta_slice_fq.pl", "-config", pathToInfo, "-mainlibdir", pathToMainLibrary, "-reseqbindir", pathToMiSeqBAMGenerationTools,
+      "-num", str(sliceReads), "-profile", pathToProfile]], True, l)
+
+def downsampleCommand(subLibraryIDs):
+  #Downsampling of the slices to --targetDepth (see FastqDownsampler.py)
+  return ["python3", "-u", pathToPipeline+"/FastqDownsampler.py"]+[pathToMainLibrary+"/"+subLibraryID+"_libName/bwa_dir/fastq_dir" for subLibraryID in subLibraryIDs]+[
+      "--fasta", pathToReferenceFASTA, "--targetDepth", str(args.targetDepth)]
+
+def maxReadLength():
+  #Longest read FastqProfiler.py found in the samples sliced so far (0 if none were profiled)
+  pathsToProfiles = [pathToLibrariesInfo+".profile"]
+  if os.path.isdir(pathToMainLibrary+"/libraries_info"):
+    pathsToProfiles += [pathToMainLibrary+"/libraries_info/"+filename for filename in os.listdir(pathToMainLibrary+"/libraries_info") if filename.endswith(".profile")]
+  return max([int(profile["maxLength"]) for path in pathsToProfiles if os.path.isfile(path) for profile in FastqProfiler.read(path)] or [0])
+
+def postprocessCommand(*options):
+  #Postprocessing (see Postprocessing/postprocessing.py)
+  return ["python3", "-u", pathToPostProcessing+"/postprocessing.py", pathToPipeline, pathToMainLibrary, pathToReferenceFASTA, pathToGATK, pathToPostProcessingScripts,
+      "--maxParallel", str(args.maxParallel), "--commandTimeout", str(args.commandTimeout), "--memoryLimit", str(args.memoryLimit),
+      "--maxReadLength", str(maxReadLength()), "--samtools", pathToSamtools+"/samtools", "--shards", str(args.gatkShards)]+list(options)
+
+def reportCalls(subLibraryID, job="bwa_dir", stage="calls"):
+  #One event per pool with the call of each reference
+  pathToCallSummary = pathToMainLibrary+"/"+subLibraryID+"_libName"+"/"+job+"/call_summary.txt"
+  calls = {}
+  if os.path.isfile(pathToCallSummary):
+    with open(pathToCallSummary) as f:
+      for line in f.readlines()[1:]:
+        fields = line.rstrip("\n").split("\t") #Calls like "Low coverage" contain a space
+        if len(fields) == 6:
+          calls[fields[0]] = fields[5]
+  event(stage, "finished", subLibraryID, calls=calls)
+
+def countSliceCoverage(poolNames, alignmentFinished):
+  #Runs SliceCoverage.py over the pools being aligned until each has its depth.txt, with a last
+  #pass once beta_run_alignments.pl is done
+  while True:
+    finished = alignmentFinished.is_set()
+    bwaDirs = [pathToMainLibrary+"/"+poolName+"/bwa_dir" for poolName in poolNames
+               if not os.path.isfile(pathToMainLibrary+"/"+poolName+"/bwa_dir/depth.txt")]
+    if bwaDirs:
+      doCommands([["python3", "-u", pathToPipeline+"/SliceCoverage.py"]+bwaDirs+[
+          "--fai", pathToReferenceFASTA+".fai", "--samtools", pathToSamtools+"/samtools"]], True, l, slotted=False)
+    if finished or not bwaDirs:
+      return
+    alignmentFinished.wait(10)
+
+def align(pathToInfo, subLibraryIDs):
+  #beta_run_alignments.pl, with each pool's coverage counted from its slice BAMs as they are written;
+  #pools left without depth.txt (e.g. SliceCoverage.py failed) get GATK DepthOfCoverage in postprocessing
+  #Coverage left by an earlier alignment (--resume, --force-stage) would be taken for this one's
+  poolNames = [subLibraryID+"_libName" for subLibraryID in subLibraryIDs]
+  for poolName in poolNames:
+    if os.path.isfile(pathToMainLibrary+"/"+poolName+"/bwa_dir/depth.txt"):
+      os.remove(pathToMainLibrary+"/"+poolName+"/bwa_dir/depth.txt")
+    pathToBAMDir = pathToMainLibrary+"/"+poolName+"/bwa_dir/bam_dir"
+    for filename in (os.listdir(pathToBAMDir) if os.path.isdir(pathToBAMDir) else []):
+      if filename.endswith(".coverage.npz") or filename.endswith(".coverage.tmp.npz") or filename.endswith(".done.bam"):
+        os.remove(pathToBAMDir+"/"+filename)
+  alignmentFinished = threading.Event()
+  counter = threading.Thread(target=countSliceCoverage, args=(poolNames, alignmentFinished))
+  counter.start()
+  try:
+    return doCommands([["perl", pathToMiSeqBAMGenerationTools+"/beta_run_alignments.pl", "-c", pathToInfo, "-picard_path", pathToPicard, "-bwa_path", pathToBWA, "-samtools_path", pathToSamtools, "-reseqbindir", pathToMiSeqBAMGenerationTools,
+        "-parallel", str(alignmentWorkers())]], True, l)
+  finally:
+    alignmentFinished.set()
+    counter.join()
+    for poolName in poolNames:
+      pathToBAMDir = pathToMainLibrary+"/"+poolName+"/bwa_dir/bam_dir"
+      for filename in (os.listdir(pathToBAMDir) if os.path.isdir(pathToBAMDir) else []):
+        if filename.endswith(".done.bam"):
+          os.remove(pathToBAMDir+"/"+filename)
+
+def quickLookSample(subLibraryID):
+  #Aligns the first --quick-look reads of a sample and calls its references from their coverage alone
+  #Runs outside the supervisor's slots, which the full run's alignment holds; quickLook() runs at
+  #most --maxParallel of these at a time itself
+  pathToQuickLook = pathToMainLibrary+"/"+subLibraryID+"_libName/quicklook"
+  fastqs = [line.split("\t")[2] for line in metadata[subLibraryID].splitlines()]
+  return doCommands([["python3", "-u", pathToPipeline+"/QuickLook.py", pathToQuickLook, pathToReferenceFASTA]+fastqs+[
+          "--reads", str(args.quickLook), "--bwa", pathToBWA+"/bwa"],
+      ["python", pathToPostProcessingScripts+"/make_calls_gatk.py", "--reffile", pathToReferenceFASTA,
+          "--depthfile", pathToQuickLook+"/depth.txt", pathToQuickLook+"/call_summary.txt"]], True, l, slotted=False)
+
+def quickLook():
+  #Provisional call_summary.txt of every pool and index.html, replaced by the full run's postprocessing
+  #Samples whose download failed (--streaming) have no reads to look at and fail the quick look
+  event("quicklook", "started")
+  try:
+    downloaded = [subLibraryID for subLibraryID in subLibraries if subLibraryID in metadata]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.maxParallel)) as executor:
+      succeeded = list(executor.map(quickLookSample, downloaded))
+    for subLibraryID, sampleSucceeded in zip(downloaded, succeeded):
+      if sampleSucceeded:
+        reportCalls(subLibraryID, "quicklook", "quicklook")
+    writeConfigXML("quicklook.xml", "quicklook")
+    result = supervisor.runNow(["python", pathToPostProcessingScripts+"/summarize_analysis.py", "--fspath", pathToPipeline,
+        "--provisional", "Calls from the first "+str(args.quickLook)+" reads of each sample, from coverage alone. The full analysis is still running and will replace them."],
+        stdin=pathToMainLibrary+"/quicklook.xml")
+    published = len(downloaded) == len(subLibraries) and all(succeeded) and result.ok()
+  except Exception as ex:
+    log(l, "Quick look stopped: "+str(ex))
+    published = False
+  if published:
+    log(l, "Quick look published")
+    event("quicklook", "finished")
+  else:
+    log(l, "Quick look failed, waiting for the full analysis")
+    event("quicklook", "failed")
+
+def startQuickLook():
+  #Runs quickLook() next to the full run; returns its thread, or None if there's nothing to do
+  if not args.quickLook or checkpoints.isDone("postprocess"):
+    return None
+  thread = threading.Thread(target=quickLook)
+  thread.start()
+  return thread
+
+def waitForQuickLook(thread):
+  #The full run's summary must not be overwritten by a late quick look
+  if thread is not None:
+    thread.join()
+
+#libraries.info lines of every sample
+metadata = {}
+
+
+########################################################################################
+#
+#Streaming mode (--streaming)
+#
+# Samples are downloaded one after the other while the references are fetched and indexed. As soon
+# as a sample's fastq.gz files are there (and the index is built), that sample goes through
+# beta_prep_setup_dirs, beta_slice_fq, beta_run_alignments and postprocessing with its own
+# libraries_info/<sample>.info, at most --maxParallel samples at a time. The first pools' call
+# summaries are ready while later samples are still downloading; summarize_analysis.py runs
+# once every pool is done.
+#
+
+def processSample(subLibraryID, referencesReady):
+  #setup_dirs, slice, align and postprocess of one sample; returns False if a stage failed
+  poolName = subLibraryID+"_libName"
+  pathToSampleInfo = pathToMainLibrary+"/libraries_info/"+subLibraryID+".info"
+  referencesReady.wait()
+  if not checkpoints.isDone("prep_ref"):
+    return False
+  if not checkpoints.isDone("setup_dirs", subLibraryID):
+    writeLibrariesInfo(pathToSampleInfo, [subLibraryID])
+  if not runStage("setup_dirs", [["perl", pathToMiSeqBAMGenerationTools+"/beta_prep_setup_dirs.pl", "-ref_fasta", pathToReferenceFASTA, "-rna", "-config", pathToSampleInfo]], sample=subLibraryID):
+    return False
+  if not checkpoints.isDone("slice", subLibraryID):
+    cleanPools(["bwa_dir/fastq_dir", "bwa_dir/bam_dir"], [poolName])
+  if not runStage("slice", lambda: sliceSamples(pathToSampleInfo, [subLibraryID]), sample=subLibraryID):
+    return False
+  if args.prefilterKmers and not runStage("prefilter", [prefilterCommand([subLibraryID])], sample=subLibraryID):
+    return False
+  if args.targetDepth and not runStage("downsample", [downsampleCommand([subLibraryID])], sample=subLibraryID):
+    return False
+  if not runStage("align", lambda: align(pathToSampleInfo, [subLibraryID]), sample=subLibraryID):
+    return False
+  if not runStage("postprocess", [postprocessCommand("--pools", poolName, "--noSummary")], 0, subLibraryID):
+    return False
+  reportCalls(subLibraryID)
+  return True
+
+def streamSamples():
+  #Returns True if every sample made it through postprocessing
+  mkdir(pathToMainLibrary+"/libraries_info")
+  referencesReady = threading.Event()
+  def references():
+    try:
+      prepareReferences()
+    finally:
+      referencesReady.set()
+  referenceThread = threading.Thread(target=references)
+  referenceThread.start()
+
+  log(l, "Getting sublibraries' sequence data from SMB...")
+  event("download", "started")
+  for subLibraryID in subLibraries:
+    done = completedDownload(subLibraryID)
+    if done is not None:
+      metadata[subLibraryID] = done
+  refreshRunIndex([subLibraryID for subLibraryID in subLibraries if subLibraryID not in metadata])
+  samples = {}
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.maxParallel)) as executor:
+    for index, subLibraryID in enumerate(subLibraries):
+      if subLibraryID not in metadata:
+        sampleMetadata = downloadSample(index, subLibraryID)
+        if sampleMetadata is None:
+          continue
+        metadata[subLibraryID] = sampleMetadata
+      event("download", "progress", done=index+1, total=len(subLibraries), sample=subLibraryID)
+      samples[subLibraryID] = executor.submit(processSample, subLibraryID, referencesReady)
+    event("download", "finished")
+    referenceThread.join()
+    quickLookThread = startQuickLook()
+  succeeded = [subLibraryID for subLibraryID in subLibraries if subLibraryID in samples and samples[subLibraryID].result()]
+
+  #libraries.info of the whole run, as beta_prep_setup_dirs left the per-sample files
   f = open(pathToLibrariesInfo, "w")
-  f.write(thread.metadata)
+  for subLibraryID in succeeded:
+    with open(pathToMainLibrary+"/libraries_info/"+subLibraryID+".info") as sampleInfo:
+      f.write(sampleInfo.read())
   f.close()
+  writeConfigXML()
+  waitForQuickLook(quickLookThread)
+  log(l, "Running summarize_analysis...")
+  summarized = runStage("postprocess", [postprocessCommand("--summaryOnly")], 0) #Marker without a sample: the summary of all pools
+  return summarized and len(succeeded) == len(subLibraries)
+
+
+def finishPipeline(success):
+  ########################################################################################
+  #
+  #Upload to ICE
+  #
+
+  # NOTE: The file of interest, .igv.xml, is located at:
+  #  pathToIGV = pathToMainLibrary+"/results/"+".igv.xml"
+  # NOTE: In order to get the "call" of each SubLibrary, e.g. Incomplete, Errors, Dips, Success, do:
+  #  calls = [] #Maps each SubLibraryID -> call name
+  #  for subLibraryID in enumerate(subLibraries):
+  #		pathToCallSummary = pathToMainLibrary+"/"+subLibraryID+"_libName"+"/bwa_dir/call_summary.txt"
+  #		calls[subLibraryID] = f.open(pathToCallSummary, 'r').read()
+  # Ask Ernst for color coding of calls.
+
+  ########################################################################################
+  #
+  #Email alert
+  #
+
+  global pipelineFinished
+  if not success:
+    log(l, "Some samples failed, rerun with --resume to retry them")
+    sys.exit(1)
+  #Send Email notifying user that Pipeline is finished
+  log(l, "Email sent to "+email)
+  sendEmail(email, "MiSeq Validation Pipeline Finished!", "Your sequencing results for: "+mainLibrary+" and the sample IDs "+" ".join(subLibraries)+" is finished. Go to ICE to see them.")
+  pipelineFinished = True
+  event("pipeline", "finished")
+  sys.exit()
+
+if args.streaming:
+  finishPipeline(streamSamples())
 
 
 ########################################################################################
 #
-#GET and WRITE Reference sequences
+#GET and WRITE Library metadata and FASTQ.GZ files
 #
 
-# NEEDS TO BE REWRITTEN:
-# This script is given an ICE Entry's ID
-# Then it queries ICE, and reads that entry's sequence
-# Then it writes that sequence to a file called "references.fasta" inside the ref/ folder of the mainLibrary, as stored in the variable - "pathToReferenceFASTA"
-# That's all it does, write a .fasta file to the path located in pathToReferenceFASTA
+#Write files from SMB Server
+log(l, "Getting sublibraries' sequence data from SMB...")
+event("download", "started")
+#A sample whose download checkpoint lists files that still exist is not fetched again
+for subLibraryID in subLibraries:
+  done = completedDownload(subLibraryID)
+  if done is not None:
+    metadata[subLibraryID] = done
+refreshRunIndex([subLibraryID for subLibraryID in subLibraries if subLibraryID not in metadata])
+for index, subLibraryID in enumerate(subLibraries):
+  if subLibraryID not in metadata:
+    # We're not actually multithreading here
+    sampleMetadata = downloadSample(index, subLibraryID)
+    if sampleMetadata is None:
+      sys.exit(1)
+    metadata[subLibraryID] = sampleMetadata
+  event("download", "progress", done=index+1, total=len(subLibraries), sample=subLibraryID)
+checkpoints.markDone("download")
+event("download", "finished")
 
-#Get files from ICE
-log(l, "Getting reference sequence data from ICE...")
-ICEServerThreads = []
-for index, sequenceName in enumerate(referenceSequences):
-  # Create new threads
-  ICEServerThreads.append(ICEServerData(index, sequenceName+".fasta"))
-  #Start thread
-  ICEServerThreads[index].start()
-# Wait for all threads to complete
-for t in ICEServerThreads:
-    t.join()
-#Write to reference.fasta
-f = open(pathToReferenceFASTA, "w")
-for t in ICEServerThreads:
-    f.write(t.sequence)
-f.close()
 
+########################################################################################
+#
+#GET and WRITE Reference sequences
+#
 
 ''' Resulting directory structure:
-  MiSeqOutput/
-    seq1_r1_001.fastq.gz
-    seq1_r2_001.fastq.gz
+  SMBMiSeqData/
+    cache_index.json
+    mainLibrary/
+      seq1_r1_001.fastq.gz
+      seq1_r2_001.fastq.gz
   mainLibrary/
     libraries.info
     ref/
@@ -217,11 +758,9 @@ f.close()
 #Generate .bam files
 #
 
-#Run prep_ref to generate .dict, .fasta.fai
-log(l, "Running prep_ref...")
-commands.append(["perl", pathToMiSeqBAMGenerationTools+"/prep_ref.pl", "-index", pathToReferenceFASTA, "-picard_path", pathToPicard, "-bwa_path", pathToBWA, "-samtools_path", pathToSamtools, "-bad_to_n"])
-doCommands(commands, True, l)
-commands = []
+if not prepareReferences():
+  sys.exit(1)
+quickLookThread = startQuickLook()
 
 ''' Resulting directory structure:
     mainLibrary/
@@ -240,8 +779,11 @@ commands = []
 
 #Create directories for each sublibraries
 log(l, "Running beta_prep_setup_dirs...")
+if not checkpoints.isDone("setup_dirs"):
+  writeLibrariesInfo(pathToLibrariesInfo, subLibraries)
 commands.append(["perl", pathToMiSeqBAMGenerationTools+"/beta_prep_setup_dirs.pl", "-ref_fasta", pathToReferenceFASTA, "-rna", "-config", pathToLibrariesInfo])
-doCommands(commands, True, l)
+if not runStage("setup_dirs", commands):
+  sys.exit(1)
 commands = []
 
 ''' Resulting directory structure:
@@ -268,8 +810,26 @@ commands = []
 
 #Slice sequences
 log(l, "Running beta_slice_fq...")
-commands.append(["perl", pathToMiSeqBAMGenerationTools+"/beta_slice_fq.pl", "-config", pathToLibrariesInfo, "-mainlibdir", pathToMainLibrary, "-reseqbindir", pathToMiSeqBAMGenerationTools])
-doCommands(commands, True, l)
+if not checkpoints.isDone("slice"):
+  cleanPools(["bwa_dir/fastq_dir", "bwa_dir/bam_dir"])
+if not runStage("slice", lambda: sliceSamples(pathToLibrariesInfo, subLibraries)):
+  sys.exit(1)
+
+#Drop host genome reads
+if args.prefilterKmers:
+  log(l, "Filtering reads by k-mers of the references...")
+  commands.append(prefilterCommand(subLibraries))
+  if not runStage("prefilter", commands):
+    sys.exit(1)
+  commands = []
+
+#Downsample slices of pools far above the coverage calls need
+if args.targetDepth:
+  log(l, "Downsampling to "+str(args.targetDepth)+"x...")
+  commands.append(downsampleCommand(subLibraries))
+  if not runStage("downsample", commands):
+    sys.exit(1)
+  commands = []
 
 ''' Resulting directory structure:
     mainLibrary/
@@ -300,9 +860,8 @@ doCommands(commands, True, l)
 
 #Align sliced sequences to generate .bam, .bam.bai files
 log(l, "Running beta_run_alignments...")
-commands.append(["perl", pathToMiSeqBAMGenerationTools+"/beta_run_alignments.pl", "-c", pathToLibrariesInfo, "-picard_path", pathToPicard, "-bwa_path", pathToBWA, "-samtools_path", pathToSamtools, "-reseqbindir", pathToMiSeqBAMGenerationTools])
-doCommands(commands, True, l)
-commands = []
+if not runStage("align", lambda: align(pathToLibrariesInfo, subLibraries)):
+  sys.exit(1)
 
 
 ########################################################################################
@@ -310,52 +869,17 @@ commands = []
 #Post Processing
 #
 
-#Create config.xml
-log(l, "Creating config.xml for postprocessing.sh script...")
-f = open("config.xml", "w")
-f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?><SBAnalysis>')
-f.write('<analysis name="'+pathToMainLibrary+'" reference="'+pathToReferenceFASTA+'" location="'+pathToPipeline+'">')
-for index, subLibraryID in enumerate(subLibraries):
-  poolName = subLibraryID+'_libName'
-  f.write('<pool name="'+poolName+'" samples="'+poolName+'"><job name="bwa_dir" protocol="bwa_dir"/></pool>')
-f.write('</analysis></SBAnalysis>')
-f.close()
-#Postprocessing.sh
-log(l, "Running postprocessing.sh...")
-commands.append([pathToPostProcessing+"/postprocessing.sh", pathToPipeline, pathToMainLibrary, pathToReferenceFASTA, pathToGATK, pathToPostProcessingScripts])
-doCommands(commands, True, l)
+writeConfigXML()
+waitForQuickLook(quickLookThread)
+log(l, "Running postprocessing...")
+commands.append(postprocessCommand())
+if not runStage("postprocess", commands, 0): #postprocessing.py applies the timeout to each of its commands
+  sys.exit(1)
 commands = []
+for subLibraryID in subLibraries:
+  reportCalls(subLibraryID)
 
-
-########################################################################################
-#
-#Upload to ICE
-#
-
-# NOTE: The file of interest, .igv.xml, is located at:
-#  pathToIGV = pathToMainLibrary+"/results/"+".igv.xml"
-# NOTE: In order to get the "call" of each SubLibrary, e.g. Incomplete, Errors, Dips, Success, do:
-#  calls = [] #Maps each SubLibraryID -> call name
-#  for subLibraryID in enumerate(subLibraries):
-#		pathToCallSummary = pathToMainLibrary+"/"+subLibraryID+"_libName"+"/bwa_dir/call_summary.txt"
-#		calls[subLibraryID] = f.open(pathToCallSummary, 'r').read()
-# Ask Ernst for color coding of calls.
-
-
-########################################################################################
-#
-#Email alert
-#
-
-#Send Email notifying user that Pipeline is finished
-log(l, "Email sent to "+email)
-sendEmail(email, "MiSeq Validation Pipeline Finished!", "Your sequencing results for: "+mainLibrary+" and the sample IDs "+" ".join(subLibraries)+" is finished. Go to ICE to see them.")
-
-
-
-
-
-sys.exit()
+finishPipeline(True)
 
 
 ########################################################################################
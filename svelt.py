@@ -2,9 +2,11 @@ __author__ = 'simi'
 #!/usr/bin/env python
 import csv
 import glob
+import heapq
+import struct
+import zlib
 from shutil import copyfile
 import sys
-import os
 from Bio import SeqIO
 
 
@@ -18,9 +20,13 @@ def create_fasta(type, path, out_name, constructs):
     handle = open(old_fasta_path, "rU")
     sequences = SeqIO.to_dict(SeqIO.parse(handle, "fasta"))
     handle.close()
-    # loop through constructs
+    # loop through constructs, a clone listed for several pools is one reference
+    written = []
     for con in constructs:
         clone = con['clone']
+        if clone in written:
+            continue
+        written.append(clone)
         print("clone: "+clone)
         s = sequences[clone]
         seq = ''.join(s.seq)
@@ -32,37 +38,67 @@ def create_fasta(type, path, out_name, constructs):
 
 def create_bam(type, path, out_name, constructs):
     print("creating new bam and bai files...")
-    # create the shell script that will create the mini bam files,
-    # merge them and then create the bai file
-    count=0
-    merge_names =[]
-    # loop through constructs, and make mini bam files - one for each
+    # copy the reads of every construct into one bam, and write its bai as the reads go in
+    # each pool bam is opened once, and its bai is used to seek straight to the reads of each clone,
+    # so there are no mini bam files to merge and no separate samtools index run
+    # the new bam has only the constructs as references, in the same order as the new fasta
+    pools = {}
+    pool_order = []
     for con in constructs:
-        count+=1
         pool = con['pool']
+        if pool not in pools:
+            pool_order.append(pool)
+            bam = get_bam_path(type, path, pool)
+            print("opening bam for pool: "+pool)
+            reader = BgzfReader(bam)
+            text, references = read_bam_header(reader)
+            pools[pool] = {'bam': bam, 'reader': reader, 'text': text,
+                           'tids': dict((name, tid) for tid, (name, length) in enumerate(references)),
+                           'lengths': dict(references), 'spans': read_bai_spans(bam+".bai"),
+                           'new_tids': {}}
+    # old reference id -> new reference id of the constructs of each pool, for the mates
+    # a clone listed for several pools is one reference of the new bam with the reads of all of them,
+    # as samtools merge made it
+    references = []
+    extracts = []
+    for con in constructs:
+        pool = pools[con['pool']]
         clone = con['clone']
-        print("clone: "+clone+", pool: "+pool)
-        bam = get_bam_path(type, path, pool)
-        mini_bam = "in"+str(count)+".bam"
-        # add mini_bam name to the merge_names for the merge command
-        merge_names.append(mini_bam)
-        # create command string for creating the mini_bam
-        cmd = 'samtools view -h -b '+bam+' "'+clone+'" > '+mini_bam
-        # run the command
-        os.system(cmd)
-
-
-    if len(constructs) == 1:
-       merge_cmd = "mv in1.bam "+out_name+".bam"
-    else:
-        merge_cmd = "samtools merge "+out_name+".bam "+" ".join(merge_names)
-
-    print("merge command: "+merge_cmd)
-    os.system(merge_cmd)
-    # now create the bai - index
-    index_cmd = "samtools index "+out_name+".bam"
-    print("index command: "+index_cmd)
-    os.system(index_cmd)
+        if clone not in pool['tids']:
+            print("clone: "+clone+" is not a reference of "+pool['bam']+", its reads are skipped")
+            continue
+        names = [name for name, length in references]
+        if clone not in names:
+            references.append((clone, pool['lengths'][clone]))
+            extracts.append((clone, []))
+        tid = names.index(clone) if clone in names else len(references)-1
+        if pool['bam'] in [pools[pool_name]['bam'] for pool_name in extracts[tid][1]]:
+            print("clone: "+clone+" is listed twice for "+pool['bam']+", its reads are copied once")
+            continue
+        pool['new_tids'][pool['tids'][clone]] = tid
+        extracts[tid][1].append(con['pool'])
+
+    writer = BgzfWriter(out_name+".bam")
+    write_bam_header(writer, bam_header_text([pools[p]['text'] for p in pool_order], references), references)
+    index = [new_bai_reference() for reference in references]
+    # the reads of a reference are together in a sorted bam, and the constructs are copied in
+    # reference order, the reads of a clone from several pools merged by position, so the new bam
+    # is sorted too
+    for tid, (clone, pool_names) in enumerate(extracts):
+        counts = [0]*len(pool_names)
+        for pos, order, number, record in heapq.merge(*[read_reference_records(pools[pool_name], clone, order)
+                                                         for order, pool_name in enumerate(pool_names)]):
+            record = remap_bam_record(record, tid, pools[pool_names[order]]['new_tids'])
+            start = writer.tell()
+            writer.write(record)
+            add_to_bai(index[tid], record, start, writer.tell())
+            counts[order] += 1
+        for pool_name, count in zip(pool_names, counts):
+            print("clone: "+clone+", pool: "+pool_name+", "+str(count)+" reads")
+    writer.close()
+    for pool in pools.values():
+        pool['reader'].close()
+    write_bai(out_name+".bam.bai", index)
     print("Done creating new bam and bai files")
 
 
@@ -173,6 +209,303 @@ def read_bed(type, path, pool):
 
 
 
+##### bam functions ######
+# enough of BGZF, BAM and BAI to copy the reads of some references out of an indexed, sorted bam
+
+# like samtools, a BGZF block holds at most 0xff00 bytes of data, so it always compresses under 64KB
+BGZF_BLOCK_DATA = 0xff00
+BGZF_EOF = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+# the bin holding the read counts and offsets of a reference, not reads
+BAI_PSEUDO_BIN = 37450
+BAI_WINDOW_SHIFT = 14
+# cigar operations that move along the reference: M, D, N, = and X
+CIGAR_REFERENCE_OPS = (0, 2, 3, 7, 8)
+
+
+class BgzfReader(object):
+    # reads a bgzf file from virtual offsets: (block offset << 16) | offset in the block
+
+    def __init__(self, path):
+        self.path = path
+        self.handle = open(path, "rb")
+        self.load_block(0)
+
+    def load_block(self, block_offset):
+        self.handle.seek(block_offset)
+        header = self.handle.read(18)
+        self.block_offset = block_offset
+        self.position = 0
+        if len(header) < 18:
+            self.data = b''
+            self.next_block_offset = block_offset
+            return
+        if header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+            raise IOError(self.path+" is not a bgzf file")
+        block_size = struct.unpack_from('<H', header, 16)[0]+1
+        block = self.handle.read(block_size-18)
+        self.data = zlib.decompress(block[:-8], -15)
+        self.next_block_offset = block_offset+block_size
+
+    def seek(self, virtual_offset):
+        self.load_block(virtual_offset >> 16)
+        self.position = virtual_offset & 0xffff
+
+    def tell(self):
+        if self.position == len(self.data) and self.data:
+            # the end of a block is the start of the next one
+            return self.next_block_offset << 16
+        return (self.block_offset << 16) | self.position
+
+    def read(self, size):
+        chunks = []
+        while size > 0:
+            if self.position == len(self.data):
+                if self.next_block_offset == self.block_offset:
+                    break
+                self.load_block(self.next_block_offset)
+                # skip the empty eof block
+                continue
+            chunk = self.data[self.position:self.position+size]
+            self.position += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self.handle.close()
+
+
+class BgzfWriter(object):
+    # writes a bgzf file, and keeps the virtual offset of what's written for the bai
+
+    def __init__(self, path):
+        self.handle = open(path, "wb")
+        self.block_offset = 0
+        self.data = b''
+
+    def write(self, data):
+        self.data += data
+        while len(self.data) >= BGZF_BLOCK_DATA:
+            self.write_block(self.data[:BGZF_BLOCK_DATA])
+            self.data = self.data[BGZF_BLOCK_DATA:]
+
+    def tell(self):
+        return (self.block_offset << 16) | len(self.data)
+
+    def flush(self):
+        if self.data:
+            self.write_block(self.data)
+            self.data = b''
+
+    def write_block(self, data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data)+compressor.flush()
+        block = (struct.pack('<4BIBBHBBHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(compressed)+25)
+                 + compressed + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+        self.handle.write(block)
+        self.block_offset += len(block)
+
+    def close(self):
+        self.flush()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+
+
+def read_bam_header(reader):
+    # returns the header text and the [(name, length)] of the references
+    if reader.read(4) != b'BAM\x01':
+        raise IOError(reader.path+" is not a bam file")
+    text_length = struct.unpack('<i', reader.read(4))[0]
+    text = reader.read(text_length).rstrip(b'\x00')
+    references = []
+    for tid in range(struct.unpack('<i', reader.read(4))[0]):
+        name_length = struct.unpack('<i', reader.read(4))[0]
+        name = reader.read(name_length).rstrip(b'\x00').decode('ascii')
+        references.append((name, struct.unpack('<i', reader.read(4))[0]))
+    return text, references
+
+
+def bam_header_text(texts, references):
+    # one @HD line, an @SQ line for each new reference and every other line of the pool headers once
+    lengths = dict(references)
+    hd = b'@HD\tVN:1.4\tSO:coordinate'
+    sq = {}
+    lines = []
+    for text in texts:
+        for line in text.split(b'\n'):
+            if line.startswith(b'@HD'):
+                hd = b'\t'.join([field for field in line.split(b'\t') if not field.startswith(b'SO:')]+[b'SO:coordinate'])
+            elif line.startswith(b'@SQ'):
+                fields = dict(field.split(b':', 1) for field in line.split(b'\t')[1:] if b':' in field)
+                name = fields.get(b'SN', b'').decode('ascii')
+                if name in lengths and name not in sq:
+                    sq[name] = line
+            elif line and line not in lines:
+                lines.append(line)
+    sq_lines = [sq.get(name, ('@SQ\tSN:'+name+'\tLN:'+str(length)).encode('ascii')) for name, length in references]
+    return b'\n'.join([hd]+sq_lines+lines)+b'\n'
+
+
+def write_bam_header(writer, text, references):
+    header = [b'BAM\x01', struct.pack('<i', len(text)), text, struct.pack('<i', len(references))]
+    for name, length in references:
+        name = name.encode('ascii')+b'\x00'
+        header.append(struct.pack('<i', len(name))+name+struct.pack('<i', length))
+    writer.write(b''.join(header))
+    # the reads start in a new block
+    writer.flush()
+
+
+def read_bam_record(reader):
+    # returns one whole record, with its block_size, or None at the end of the file
+    size = reader.read(4)
+    if len(size) < 4:
+        return None
+    return size+reader.read(struct.unpack('<i', size)[0])
+
+
+def read_reference_records(pool, clone, order):
+    # yields (position, order, number, record) for the reads of clone in a pool bam opened by create_bam,
+    # so heapq.merge sorts the reads of several pools by position, and by pool and file order after that
+    old_tid = pool['tids'][clone]
+    span = pool['spans'][old_tid] if old_tid < len(pool['spans']) else None
+    if span is None:
+        return
+    reader = pool['reader']
+    reader.seek(span[0])
+    number = 0
+    while reader.tell() < span[1]:
+        record = read_bam_record(reader)
+        if record is None:
+            break
+        if struct.unpack_from('<i', record, 4)[0] != old_tid:
+            continue
+        yield struct.unpack_from('<i', record, 8)[0], order, number, record
+        number += 1
+
+
+def remap_bam_record(record, tid, new_tids):
+    # sets the reference of the record, and of its mate if the mate's reference was copied too
+    next_tid, next_pos = struct.unpack_from('<ii', record, 24)
+    if next_tid in new_tids:
+        next_tid = new_tids[next_tid]
+    elif next_tid >= 0:
+        next_tid, next_pos = -1, -1
+    return record[:4]+struct.pack('<i', tid)+record[8:24]+struct.pack('<ii', next_tid, next_pos)+record[32:]
+
+
+def read_bai_spans(bai_path):
+    # returns the (first, last) virtual offsets of the reads of each reference of the bai,
+    # or None for a reference without reads
+    with open(bai_path, "rb") as f:
+        data = f.read()
+    if data[:4] != b'BAI\x01':
+        raise IOError(bai_path+" is not a bam index")
+    offset = 8
+    spans = []
+    for tid in range(struct.unpack_from('<i', data, 4)[0]):
+        first = last = None
+        bins = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        for b in range(bins):
+            bin, chunks = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            for c in range(chunks):
+                begin, end = struct.unpack_from('<QQ', data, offset)
+                offset += 16
+                if bin != BAI_PSEUDO_BIN:
+                    first = begin if first is None else min(first, begin)
+                    last = end if last is None else max(last, end)
+        offset += 4+8*struct.unpack_from('<i', data, offset)[0]
+        spans.append(None if first is None else (first, last))
+    return spans
+
+
+def reg2bin(begin, end):
+    # the bin of the 0-based [begin, end) region, from the sam spec
+    end -= 1
+    if begin >> 14 == end >> 14:
+        return ((1 << 15)-1)//7+(begin >> 14)
+    if begin >> 17 == end >> 17:
+        return ((1 << 12)-1)//7+(begin >> 17)
+    if begin >> 20 == end >> 20:
+        return ((1 << 9)-1)//7+(begin >> 20)
+    if begin >> 23 == end >> 23:
+        return ((1 << 6)-1)//7+(begin >> 23)
+    if begin >> 26 == end >> 26:
+        return ((1 << 3)-1)//7+(begin >> 26)
+    return 0
+
+
+def new_bai_reference():
+    return {'bins': {}, 'bin_order': [], 'linear': [], 'begin': None, 'end': None, 'mapped': 0, 'unmapped': 0}
+
+
+def add_to_bai(reference, record, start, end):
+    # adds a record written from virtual offset start to end to the index of its reference
+    pos, name_length = struct.unpack_from('<iB', record, 8)
+    cigar_length, flag = struct.unpack_from('<HH', record, 16)
+    begin = max(pos, 0)
+    span = 0
+    if not flag & 4:
+        for op in struct.unpack_from('<'+str(cigar_length)+'I', record, 36+name_length):
+            if op & 0xf in CIGAR_REFERENCE_OPS:
+                span += op >> 4
+    stop = begin+max(span, 1)
+    bin = reg2bin(begin, stop)
+    if bin not in reference['bins']:
+        reference['bins'][bin] = []
+        reference['bin_order'].append(bin)
+    chunks = reference['bins'][bin]
+    if chunks and chunks[-1][1] >= start:
+        # the record follows the last chunk of its bin, so it extends that chunk
+        chunks[-1][1] = end
+    else:
+        chunks.append([start, end])
+    linear = reference['linear']
+    for window in range(begin >> BAI_WINDOW_SHIFT, ((stop-1) >> BAI_WINDOW_SHIFT)+1):
+        while len(linear) <= window:
+            linear.append(None)
+        if linear[window] is None:
+            linear[window] = start
+    if reference['begin'] is None:
+        reference['begin'] = start
+    reference['end'] = end
+    if flag & 4:
+        reference['unmapped'] += 1
+    else:
+        reference['mapped'] += 1
+
+
+def write_bai(bai_path, index):
+    data = [b'BAI\x01', struct.pack('<i', len(index))]
+    for reference in index:
+        bins = reference['bin_order']
+        data.append(struct.pack('<i', len(bins)+(1 if reference['begin'] is not None else 0)))
+        for bin in bins:
+            chunks = reference['bins'][bin]
+            data.append(struct.pack('<Ii', bin, len(chunks)))
+            for begin, end in chunks:
+                data.append(struct.pack('<QQ', begin, end))
+        if reference['begin'] is not None:
+            data.append(struct.pack('<IiQQQQ', BAI_PSEUDO_BIN, 2, reference['begin'], reference['end'],
+                                    reference['mapped'], reference['unmapped']))
+        # windows without reads get the offset of the window before them
+        linear = reference['linear']
+        last = reference['begin'] or 0
+        for window in range(len(linear)):
+            if linear[window] is None:
+                linear[window] = last
+            else:
+                last = linear[window]
+        data.append(struct.pack('<i', len(linear)))
+        data.extend(struct.pack('<Q', offset) for offset in linear)
+    # no unplaced unmapped reads are copied
+    data.append(struct.pack('<Q', 0))
+    with open(bai_path, "wb") as f:
+        f.write(b''.join(data))
+
+
 def get_constructs(filename):
     print("parsing csv file...")
     # parses csv and returns a dict, keys are the construct names, value is the pool
@@ -0,0 +1,211 @@
+import os, time, json, shlex, sqlite3, subprocess, threading
+
+#
+#Persistent queue of pipeline.py runs
+#
+# Submissions are stored in SQLite and run by a fixed number of workers, so simultaneous
+# submissions wait their turn instead of starting parallel BWA/GATK/Picard runs. A submission
+# identical to one that is still queued (same run, samples and references) is merged into it: its
+# email is added to the notification list and it keeps the higher priority. A running job already
+# has its notification list, so an identical submission is queued as a new job.
+#
+# Every job writes its exit code to <logFile>.returncode when it ends, so a job that outlives the
+# server process that started it can still be marked done or failed after a restart.
+#
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS jobs (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	dedupKey TEXT NOT NULL,
+	mainLibrary TEXT NOT NULL,
+	subLibraries TEXT NOT NULL,
+	referenceSequences TEXT NOT NULL,
+	emails TEXT NOT NULL,
+	priority INTEGER NOT NULL DEFAULT 0,
+	state TEXT NOT NULL,
+	logFile TEXT,
+	pid INTEGER,
+	returnCode INTEGER,
+	submitted REAL NOT NULL,
+	started REAL,
+	finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobsByState ON jobs (state, priority, submitted);
+'''
+
+def dedup_key(mainLibrary, subLibraries, referenceSequences):
+	return json.dumps([mainLibrary, sorted(set(subLibraries)), sorted(set(referenceSequences))])
+
+def return_code_path(logFile):
+	return logFile+'.returncode'
+
+def read_return_code(logFile):
+	#Exit code a job wrote when it ended, or None if it hasn't (or was killed before it could)
+	try:
+		with open(return_code_path(logFile)) as f:
+			return int(f.read().strip())
+	except (IOError, ValueError):
+		return None
+
+def pid_alive(pid):
+	try:
+		os.kill(pid, 0)
+	except OSError:
+		return False
+	return True
+
+class JobQueue():
+
+	def __init__(self, dbPath, maxRunning):
+		self.dbPath = dbPath
+		self.maxRunning = maxRunning
+		self.workers = []
+		db = self.connect()
+		try:
+			db.executescript(SCHEMA)
+		finally:
+			db.close()
+
+	def connect(self):
+		db = sqlite3.connect(self.dbPath, timeout=60, isolation_level=None)
+		db.row_factory = sqlite3.Row
+		return db
+
+	def enqueue(self, mainLibrary, subLibraries, referenceSequences, email, priority=0):
+		#Returns (job id, True if a new job was created or False if merged into an identical one)
+		key = dedup_key(mainLibrary, subLibraries, referenceSequences)
+		db = self.connect()
+		try:
+			db.execute('BEGIN IMMEDIATE')
+			existing = db.execute('SELECT * FROM jobs WHERE dedupKey=? AND state=? ORDER BY id LIMIT 1',
+				(key, QUEUED)).fetchone()
+			if existing is not None:
+				emails = existing['emails'].split(',')
+				if email not in emails:
+					emails.append(email)
+				db.execute('UPDATE jobs SET emails=?, priority=? WHERE id=?',
+					(','.join(emails), max(priority, existing['priority']), existing['id']))
+				db.execute('COMMIT')
+				return existing['id'], False
+			cursor = db.execute('INSERT INTO jobs (dedupKey, mainLibrary, subLibraries, referenceSequences, emails, priority, state, submitted) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+				(key, mainLibrary, ' '.join(subLibraries), ' '.join(referenceSequences), email, priority, QUEUED, time.time()))
+			db.execute('COMMIT')
+			return cursor.lastrowid, True
+		except BaseException:
+			db.execute('ROLLBACK')
+			raise
+		finally:
+			db.close()
+
+	def job(self, jobID):
+		db = self.connect()
+		try:
+			row = db.execute('SELECT * FROM jobs WHERE id=?', (jobID,)).fetchone()
+			if row is None:
+				return None
+			job = dict((k, row[k]) for k in row.keys())
+			if job['state'] == QUEUED:
+				job['position'] = db.execute('SELECT COUNT(*) FROM jobs WHERE state=? AND (priority>? OR (priority=? AND submitted<?))',
+					(QUEUED, job['priority'], job['priority'], job['submitted'])).fetchone()[0] + 1
+			return job
+		finally:
+			db.close()
+
+	def claim(self):
+		#Atomically moves the highest priority queued job to running, if fewer than maxRunning jobs run
+		#(the limit is global across every process sharing the database, e.g. gunicorn workers)
+		db = self.connect()
+		try:
+			db.execute('BEGIN IMMEDIATE')
+			running = db.execute('SELECT COUNT(*) FROM jobs WHERE state=?', (RUNNING,)).fetchone()[0]
+			row = None
+			if running < self.maxRunning:
+				row = db.execute('SELECT * FROM jobs WHERE state=? ORDER BY priority DESC, submitted LIMIT 1', (QUEUED,)).fetchone()
+			if row is not None:
+				db.execute('UPDATE jobs SET state=?, started=? WHERE id=?', (RUNNING, time.time(), row['id']))
+			db.execute('COMMIT')
+			return row
+		except BaseException:
+			db.execute('ROLLBACK')
+			raise
+		finally:
+			db.close()
+
+	def update(self, jobID, **fields):
+		db = self.connect()
+		try:
+			names = sorted(fields)
+			db.execute('UPDATE jobs SET '+', '.join(name+'=?' for name in names)+' WHERE id=?',
+				tuple(fields[name] for name in names)+(jobID,))
+		finally:
+			db.close()
+
+	def finish(self, jobID, returnCode):
+		self.update(jobID, state=(DONE if returnCode == 0 else FAILED), returnCode=returnCode, finished=time.time())
+
+	def recover(self):
+		#Settles jobs left running by a process that died (e.g. a server restart): jobs that ended are
+		#marked done or failed from their exit code, jobs still running are watched until they end and
+		#jobs that died without an exit code are requeued
+		db = self.connect()
+		try:
+			rows = db.execute('SELECT id, pid, logFile, started FROM jobs WHERE state=?', (RUNNING,)).fetchall()
+		finally:
+			db.close()
+		for row in rows:
+			if row['pid'] is None:
+				#A job without a pid may just be starting in another process
+				if time.time() - row['started'] > 60:
+					self.update(row['id'], state=QUEUED, pid=None, started=None)
+				continue
+			returnCode = read_return_code(row['logFile']) if row['logFile'] else None
+			if returnCode is not None:
+				self.finish(row['id'], returnCode)
+			elif pid_alive(row['pid']):
+				watcher = threading.Thread(target=self.watch, args=(row['id'], row['pid'], row['logFile']))
+				watcher.daemon = True
+				watcher.start()
+			else:
+				self.update(row['id'], state=QUEUED, pid=None, started=None)
+
+	def watch(self, jobID, pid, logFile, pollInterval=30):
+		#Waits for a job started by an earlier server process, which can't be waited on directly
+		while pid_alive(pid) and read_return_code(logFile) is None:
+			time.sleep(pollInterval)
+		returnCode = read_return_code(logFile)
+		if returnCode is None:
+			#Killed before it could write its exit code
+			self.update(jobID, state=QUEUED, pid=None, started=None)
+		else:
+			self.finish(jobID, returnCode)
+
+	def work(self, commandFor, pollInterval):
+		#Worker loop: claims a job, runs the command built by commandFor(job) and records how it ended
+		while True:
+			row = self.claim()
+			if row is None:
+				time.sleep(pollInterval)
+				continue
+			command, logFile = commandFor(row)
+			#The shell outlives this process if the server restarts, and leaves the exit code for recover()
+			wrapped = ['sh', '-c', '"$@"; code=$?; echo $code > '+shlex.quote(return_code_path(logFile))+'; exit $code', 'job']+command
+			try:
+				p = subprocess.Popen(wrapped, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+			except OSError as ex:
+				print("Could not start job "+str(row['id'])+": "+str(ex))
+				self.update(row['id'], state=FAILED, finished=time.time())
+				continue
+			self.update(row['id'], pid=p.pid, logFile=logFile)
+			self.finish(row['id'], p.wait())
+
+	def startWorkers(self, commandFor, count, pollInterval=5):
+		self.recover()
+		for i in range(count):
+			worker = threading.Thread(target=self.work, args=(commandFor, pollInterval))
+			worker.daemon = True
+			worker.start()
+			self.workers.append(worker)
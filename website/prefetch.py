@@ -0,0 +1,164 @@
+import os, time, threading
+
+from MiSeqServerData import MiSeqServerData
+from MiSeqDataCache import MiSeqDataCache
+
+#
+#Speculative download of a run's fastq.gz files into the local cache
+#
+# When a user picks a run in the form, its fastq.gz files are fetched in the background so that
+# pipeline.py finds them in SMBMiSeqData instead of spending its first minutes on SMB. All
+# prefetches share one bandwidth limit and one disk budget. A run is prefetched once no matter how
+# many users select it (and pipeline.py or another server process downloading the same file waits
+# on the cache's file lock instead of fetching it twice). If no job is submitted for the run within
+# unusedTimeout seconds of it last being selected, the prefetch is cancelled and the files it
+# downloaded are removed again, unless something else has used them since.
+#
+
+class PrefetchCancelled(Exception):
+	pass
+
+class RateLimiter():
+	#Token bucket shared by every prefetch: consume() sleeps to keep the average rate under bytesPerSecond
+
+	def __init__(self, bytesPerSecond):
+		self.bytesPerSecond = bytesPerSecond
+		self.allowance = 0.0
+		self.last = time.time()
+		self.lock = threading.Lock()
+
+	def consume(self, size):
+		if not self.bytesPerSecond:
+			return
+		with self.lock:
+			now = time.time()
+			#At most one second worth of burst
+			self.allowance = min(self.bytesPerSecond, self.allowance + (now - self.last) * self.bytesPerSecond)
+			self.last = now
+			self.allowance -= size
+			wait = -self.allowance / self.bytesPerSecond if self.allowance < 0 else 0
+		if wait:
+			time.sleep(wait)
+
+class RunPrefetch():
+
+	def __init__(self, prefetcher, mainLibraryFolder):
+		self.prefetcher = prefetcher
+		self.mainLibraryFolder = mainLibraryFolder
+		self.lastRequested = time.time()
+		self.used = False
+		self.cancelled = False
+		self.downloaded = {} #filename -> lastUsed of its cache entry right after we downloaded it
+		self.reservedBytes = 0
+
+	def expired(self):
+		return not self.used and time.time() - self.lastRequested > self.prefetcher.unusedTimeout
+
+	def throttle(self, size):
+		if self.cancelled or self.expired():
+			self.cancelled = True
+			raise PrefetchCancelled(self.mainLibraryFolder)
+		#Once a job waits for the files, finish them at full speed
+		if not self.used:
+			self.prefetcher.limiter.consume(size)
+
+	def wanted(self):
+		#(filename, size, mtime) of the run's fastq.gz files that aren't cached yet
+		#Undetermined reads are never validated, so they are skipped
+		index = self.prefetcher.cache.readIndex()
+		files = []
+		for filename, fileSize, mtime in self.prefetcher.runIndex.fastqs(self.mainLibraryFolder):
+			if filename.startswith("Undetermined"):
+				continue
+			entry = index.get(MiSeqDataCache.key(self.mainLibraryFolder, filename))
+			if entry is not None and entry['size'] == fileSize and entry['mtime'] == mtime:
+				continue
+			files.append((filename, fileSize, mtime))
+		return files
+
+	def run(self):
+		downloader = MiSeqServerData(0, self.mainLibraryFolder, "", self.prefetcher.cache.cacheFolder, self.prefetcher.cache, self.prefetcher.runIndex)
+		downloader.throttle = self.throttle
+		conn = None
+		filename = None
+		try:
+			for filename, fileSize, mtime in self.wanted():
+				if not self.prefetcher.budget(self, fileSize):
+					print("Prefetch budget reached, not prefetching "+filename)
+					continue
+				if conn is None:
+					conn = MiSeqServerData.connect()
+				conn, localPath = downloader.fetchFastq(conn, filename, fileSize, mtime)
+				entry = self.prefetcher.cache.readIndex().get(MiSeqDataCache.key(self.mainLibraryFolder, filename))
+				if entry is not None:
+					self.downloaded[filename] = entry['lastUsed']
+			#Keep the files around until they are used or the timeout passes
+			while not self.expired() and not self.used:
+				time.sleep(self.prefetcher.pollInterval)
+			filename = None
+		except PrefetchCancelled:
+			print("Prefetch of "+self.mainLibraryFolder+" cancelled, run was not submitted")
+			#Don't leave the interrupted download behind, it isn't counted against any quota
+			if filename is not None:
+				partPath = self.prefetcher.cache.pathFor(self.mainLibraryFolder, filename)+".part"
+				if os.path.exists(partPath):
+					os.remove(partPath)
+		except Exception as ex:
+			print("Prefetch of "+self.mainLibraryFolder+" failed: "+str(ex))
+		finally:
+			if conn is not None:
+				try:
+					conn.close()
+				except Exception:
+					pass
+			if not self.used:
+				for filename, lastUsed in self.downloaded.items():
+					self.prefetcher.cache.discard(self.mainLibraryFolder, filename, lastUsed)
+			self.prefetcher.finished(self)
+
+class Prefetcher():
+
+	def __init__(self, cache, runIndex, bytesPerSecond, budgetBytes, unusedTimeout, pollInterval=30):
+		self.cache = cache #MiSeqDataCache shared with pipeline.py
+		self.runIndex = runIndex
+		self.limiter = RateLimiter(bytesPerSecond)
+		self.budgetBytes = budgetBytes #Disk that all unused prefetches together may take
+		self.unusedTimeout = unusedTimeout
+		self.pollInterval = pollInterval
+		self.prefetches = {} #Run folder -> RunPrefetch
+		self.lock = threading.Lock()
+
+	def request(self, mainLibraryFolder):
+		#Starts prefetching the run, or keeps an existing prefetch of it alive
+		with self.lock:
+			prefetch = self.prefetches.get(mainLibraryFolder)
+			if prefetch is not None:
+				prefetch.lastRequested = time.time()
+				return prefetch
+			prefetch = RunPrefetch(self, mainLibraryFolder)
+			self.prefetches[mainLibraryFolder] = prefetch
+		thread = threading.Thread(target=prefetch.run)
+		thread.daemon = True
+		thread.start()
+		return prefetch
+
+	def claim(self, mainLibraryFolder):
+		#A job was submitted for the run: finish the prefetch and keep what it downloaded
+		with self.lock:
+			prefetch = self.prefetches.get(mainLibraryFolder)
+			if prefetch is not None:
+				prefetch.used = True
+
+	def budget(self, prefetch, fileSize):
+		#Reserves fileSize bytes of the disk budget for prefetch, False if that would exceed it
+		with self.lock:
+			reserved = sum(p.reservedBytes for p in self.prefetches.values() if not p.used)
+			if self.budgetBytes and reserved + fileSize > self.budgetBytes:
+				return False
+			prefetch.reservedBytes += fileSize
+			return True
+
+	def finished(self, prefetch):
+		with self.lock:
+			if self.prefetches.get(prefetch.mainLibraryFolder) is prefetch:
+				del self.prefetches[prefetch.mainLibraryFolder]
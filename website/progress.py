@@ -0,0 +1,147 @@
+import os, json, time, queue, threading
+
+#
+#Fan-out of pipeline.py progress events
+#
+# pipeline.py appends one JSON object per line to logOfPipeline_<ts>.events.jsonl. Each event log
+# is read by a single tailer thread no matter how many browsers are watching it; the tailer keeps
+# every event it has read, so a late viewer is first sent the history and then the live events.
+#
+
+FINAL_STAGE = 'pipeline'
+FINAL_STATES = ('finished', 'failed')
+
+def is_final(record):
+	return record.get('stage') == FINAL_STAGE and record.get('state') in FINAL_STATES
+
+class EventTailer():
+
+	def __init__(self, path, pollInterval):
+		self.path = path
+		self.pollInterval = pollInterval
+		self.history = []
+		self.subscribers = {} #Queue -> id of the last event it already has
+		self.lock = threading.Lock()
+		self.done = False
+
+	def subscribe(self, after=0):
+		#Returns a queue receiving (event id, record) for every event with an id above after
+		q = queue.Queue()
+		with self.lock:
+			for eventID, record in enumerate(self.history[after:], after+1):
+				q.put((eventID, record))
+			if self.done:
+				q.put(None)
+			else:
+				self.subscribers[q] = after
+		return q
+
+	def unsubscribe(self, q):
+		with self.lock:
+			self.subscribers.pop(q, None)
+
+	def publish(self, record):
+		with self.lock:
+			self.history.append(record)
+			for q, after in self.subscribers.items():
+				if len(self.history) > after:
+					q.put((len(self.history), record))
+
+	def finish(self):
+		with self.lock:
+			self.done = True
+			for q in self.subscribers:
+				q.put(None)
+			self.subscribers.clear()
+
+	def run(self, idleTimeout):
+		#Reads whole lines as they are appended; stops at the final pipeline event, or once
+		#nobody has been watching for idleTimeout seconds
+		f = None
+		partial = ''
+		idleSince = None
+		try:
+			while True:
+				if f is None and os.path.exists(self.path):
+					f = open(self.path)
+				chunk = f.read() if f is not None else ''
+				if chunk:
+					partial += chunk
+					lines = partial.split('\n')
+					partial = lines.pop()
+					for line in lines:
+						if not line.strip():
+							continue
+						try:
+							record = json.loads(line)
+						except ValueError:
+							continue
+						self.publish(record)
+						if is_final(record):
+							return
+					continue
+				with self.lock:
+					watched = bool(self.subscribers)
+				if watched:
+					idleSince = None
+				elif idleSince is None:
+					idleSince = time.time()
+				elif time.time() - idleSince > idleTimeout:
+					return
+				time.sleep(self.pollInterval)
+		finally:
+			if f is not None:
+				f.close()
+			self.finish()
+
+class EventBroadcaster():
+
+	def __init__(self, pollInterval=0.5, idleTimeout=60):
+		self.pollInterval = pollInterval
+		self.idleTimeout = idleTimeout
+		self.tailers = {}
+		self.lock = threading.Lock()
+
+	def subscribe(self, path, after=0):
+		#Returns (tailer, queue); starts a tailer for path unless one is running or has read it to the end
+		path = os.path.abspath(path)
+		with self.lock:
+			tailer = self.tailers.get(path)
+			if tailer is None or (tailer.done and not is_final(tailer.history[-1] if tailer.history else {})):
+				tailer = EventTailer(path, self.pollInterval)
+				self.tailers[path] = tailer
+				thread = threading.Thread(target=self.tail, args=(tailer,))
+				thread.daemon = True
+				thread.start()
+			return tailer, tailer.subscribe(after)
+
+	def tail(self, tailer):
+		try:
+			tailer.run(self.idleTimeout)
+		finally:
+			self.release(tailer)
+
+	def release(self, tailer):
+		#Forgets a tailer that has stopped and has nobody left to send to; a later viewer starts a new one
+		with self.lock:
+			with tailer.lock:
+				if tailer.done and not tailer.subscribers and self.tailers.get(tailer.path) is tailer:
+					del self.tailers[tailer.path]
+
+	def stream(self, path, after=0, keepAlive=15):
+		#Generator of Server-Sent Events for the event log at path, ending after the final event
+		tailer, q = self.subscribe(path, after)
+		try:
+			while True:
+				try:
+					item = q.get(timeout=keepAlive)
+				except queue.Empty:
+					yield ': keep-alive\n\n'
+					continue
+				if item is None:
+					return
+				eventID, record = item
+				yield 'id: '+str(eventID)+'\nevent: '+record.get('stage', 'message')+'\ndata: '+json.dumps(record, sort_keys=True)+'\n\n'
+		finally:
+			tailer.unsubscribe(q)
+			self.release(tailer)
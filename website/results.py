@@ -0,0 +1,156 @@
+import os, re, gzip, shutil, mimetypes, threading
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from flask import request, Response, abort
+
+#
+#Serving of pipeline results (BAM, .bai, VCF, BED, IGV sessions, index.html) to browsers and genome viewers
+#
+# IGV and JBrowse read BAMs and indexes with HTTP Range requests, so single byte ranges are answered
+# with 206 Partial Content. Every response carries an ETag and Last-Modified so unchanged files are
+# revalidated with a 304 instead of being sent again. File bodies go through the server's
+# wsgi.file_wrapper, which lets gunicorn sendfile() them without copying through Python. Text
+# results (html, json, xml) are gzipped once next to the original and that copy is served to
+# clients that accept it.
+#
+
+COMPRESSIBLE = ('.html', '.json', '.xml')
+BLOCK_SIZE = 64*1024
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+gzipLock = threading.Lock()
+
+class FileRange():
+	#File-like object for wsgi.file_wrapper covering [start, end) of an open file
+	#fileno() and tell() let servers that support it sendfile() the range directly
+
+	def __init__(self, fileObj, start, end):
+		self.fileObj = fileObj
+		self.fileObj.seek(start)
+		self.remaining = end - start
+
+	def fileno(self):
+		return self.fileObj.fileno()
+
+	def tell(self):
+		return self.fileObj.tell()
+
+	def read(self, size=-1):
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.fileObj.read(size)
+		self.remaining -= len(data)
+		return data
+
+	def close(self):
+		self.fileObj.close()
+
+def resolve(root, relPath):
+	#Absolute path of relPath inside root, or None if it escapes root or isn't a file
+	root = os.path.realpath(root)
+	path = os.path.realpath(os.path.join(root, relPath))
+	if not path.startswith(root+os.sep) or not os.path.isfile(path):
+		return None
+	return path
+
+def gzipped(path):
+	#Path of an up to date gzip copy of path, written the first time it is needed
+	gzPath = path+'.gz'
+	if os.path.exists(gzPath) and os.path.getmtime(gzPath) >= os.path.getmtime(path):
+		return gzPath
+	with gzipLock:
+		if os.path.exists(gzPath) and os.path.getmtime(gzPath) >= os.path.getmtime(path):
+			return gzPath
+		tmpPath = gzPath+'.tmp'
+		with open(path, 'rb') as src, gzip.open(tmpPath, 'wb') as dst:
+			shutil.copyfileobj(src, dst)
+		os.replace(tmpPath, gzPath)
+	return gzPath
+
+def byte_range(header, size):
+	#(start, end) for a single "bytes=" range, 'unsatisfiable', or None to send the whole file
+	#Multiple ranges are answered with the whole file, which the HTTP spec allows
+	match = RANGE.match(header.strip())
+	if match is None:
+		return None
+	first, last = match.groups()
+	if first == '' and last == '':
+		return None
+	if first == '':
+		#Suffix range: the last n bytes
+		start, end = max(0, size - int(last)), size
+	else:
+		start = int(first)
+		end = min(size, int(last)+1) if last != '' else size
+		if last != '' and int(last) < start:
+			return None
+	if start >= size or start >= end:
+		return 'unsatisfiable'
+	return start, end
+
+def not_modified(etag, mtime):
+	#True if the request's validators show the client already has this version
+	ifNoneMatch = request.headers.get('If-None-Match')
+	if ifNoneMatch is not None:
+		return ifNoneMatch.strip() == '*' or etag in [tag.strip() for tag in ifNoneMatch.split(',')]
+	ifModifiedSince = request.headers.get('If-Modified-Since')
+	if ifModifiedSince is not None:
+		parsed = parsedate_tz(ifModifiedSince)
+		return parsed is not None and int(mtime) <= mktime_tz(parsed)
+	return False
+
+def read_blocks(body):
+	try:
+		for block in iter(lambda: body.read(BLOCK_SIZE), b''):
+			yield block
+	finally:
+		body.close()
+
+def send_result(root, relPath):
+	path = resolve(root, relPath)
+	if path is None:
+		abort(404)
+	contentType = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+	if path.endswith('.vcf') or path.endswith('.bed'):
+		contentType = 'text/plain'
+	headers = {'Accept-Ranges': 'bytes'}
+	servedPath = path
+	if path.endswith(COMPRESSIBLE):
+		headers['Vary'] = 'Accept-Encoding'
+		if 'gzip' in request.headers.get('Accept-Encoding', ''):
+			servedPath = gzipped(path)
+			headers['Content-Encoding'] = 'gzip'
+
+	stat = os.stat(servedPath)
+	size = stat.st_size
+	etag = '"%x-%x%s"' % (int(stat.st_mtime*1000000), size, '-gz' if servedPath != path else '')
+	headers['ETag'] = etag
+	headers['Last-Modified'] = formatdate(stat.st_mtime, usegmt=True)
+	headers['Cache-Control'] = 'no-cache' #Always revalidate: a rerun of the pipeline replaces results in place
+
+	if not_modified(etag, stat.st_mtime):
+		return Response(status=304, headers=headers)
+
+	status = 200
+	start, end = 0, size
+	rangeHeader = request.headers.get('Range')
+	ifRange = request.headers.get('If-Range')
+	if rangeHeader is not None and (ifRange is None or ifRange.strip() in (etag, headers['Last-Modified'])):
+		requested = byte_range(rangeHeader, size)
+		if requested == 'unsatisfiable':
+			headers['Content-Range'] = 'bytes */'+str(size)
+			return Response(status=416, headers=headers)
+		if requested is not None:
+			start, end = requested
+			status = 206
+			headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end-1, size)
+	headers['Content-Length'] = str(end - start)
+
+	if request.method == 'HEAD':
+		return Response(status=status, headers=headers, content_type=contentType)
+	body = FileRange(open(servedPath, 'rb'), start, end)
+	fileWrapper = request.environ.get('wsgi.file_wrapper')
+	if fileWrapper is not None:
+		iterable = fileWrapper(body, BLOCK_SIZE)
+	else:
+		iterable = read_blocks(body)
+	return Response(iterable, status=status, headers=headers, content_type=contentType, direct_passthrough=True)
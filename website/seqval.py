@@ -1,12 +1,22 @@
-import sys, os, shutil, subprocess, shlex, time
+import sys, os, shutil, time, json
 from smb.SMBConnection import SMBConnection
 from smb.base import NotConnectedError, NotReadyError, SMBTimeout, SharedFile
-from flask import Flask, render_template, request, jsonify
-import tempfile
+from flask import Flask, render_template, request, jsonify, Response
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from MiSeqRunIndex import MiSeqRunIndex
+from MiSeqDataCache import MiSeqDataCache
+from SMBConnectionPool import SMBConnectionPool
+from jobqueue import JobQueue, QUEUED, RUNNING, DONE
+from progress import EventBroadcaster
+from prefetch import Prefetcher
+from results import send_result
 
 # Initialize the Flask application
 app = Flask(__name__)
 
+#Path to Pipeline.py
+pathToPipeline = 'path/To/pipeline'
+
 #SMB credentials - SECRET
 username = os.environ['SMB_USERNAME']
 password = os.environ['SMB_PASSWORD']
@@ -18,6 +28,68 @@ host = "smb.jbei.org"
 port = 139
 sharedFolder = "miseq"
 
+def make_smb_connection():
+	conn = SMBConnection(username, password, myRequestIdentifier, serverName, domain=domain, use_ntlm_v2 = True)
+	conn.connect(host, port)
+	return conn
+
+#Authenticated SMB connections reused across requests
+smbPool = SMBConnectionPool(make_smb_connection)
+
+#Local index of MiSeq runs, sample IDs and fastq.gz files, shared with pipeline.py
+pathToMiSeqSequenceStorage = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "SMBMiSeqData")
+runIndex = MiSeqRunIndex(pathToMiSeqSequenceStorage)
+runIndexMaxAge = 60 #Seconds before autocomplete requests trigger an incremental refresh of MiSeqOutput
+runMaxAge = 15 #Seconds before a selected run's sample sheet and BaseCalls are rechecked
+
+def refresh_run_index():
+	if not runIndex.isStale(runIndexMaxAge):
+		return
+	with smbPool.connection() as conn:
+		runIndex.refresh(conn, runIndexMaxAge)
+
+def refresh_run(mainLibraryFolder):
+	run = runIndex.run(mainLibraryFolder)
+	if run is not None and time.time() - run.get('checked', 0) <= runMaxAge:
+		return
+	with smbPool.connection() as conn:
+		runIndex.refreshRunIfStale(conn, mainLibraryFolder, runMaxAge)
+
+#Background download of a selected run's fastq.gz files into pipeline.py's cache
+cacheQuota = 200 #GB, same as pipeline.py's --cacheQuota
+prefetchBandwidth = 20 #MB/s shared by all prefetches, so they don't slow down running pipelines
+prefetchBudget = 50 #GB of disk that prefetched but not yet submitted runs may take
+prefetchTimeout = 30*60 #Seconds after the run was last selected before an unsubmitted prefetch is dropped
+prefetcher = Prefetcher(MiSeqDataCache(pathToMiSeqSequenceStorage, cacheQuota*1024*1024*1024), runIndex,
+	prefetchBandwidth*1024*1024, prefetchBudget*1024*1024*1024, prefetchTimeout)
+
+#Queue of pipeline.py runs, at most pipelineWorkers of them at a time
+pipelineWorkers = 2
+jobQueue = JobQueue(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'jobs.sqlite'), pipelineWorkers)
+
+def pipeline_command(job):
+	#Log file
+	logFile = pathToPipeline+'/website/logs/logOfPipeline_'+str(int(time.time()))+'_'+str(job['id'])+'.txt'
+	#Pipeline command
+	command = ['python3', pathToPipeline+'/pipeline.py',
+		'-m', job['mainLibrary'],
+		'-s']+job['subLibraries'].split()+[
+		'-r']+job['referenceSequences'].split()+[
+		'-e', job['emails'],
+		'-l', logFile]
+	return command, logFile
+
+#The debug reloader runs this file twice, in a watcher process and in the server it restarts; only the
+#server may claim jobs (under a WSGI server the module is imported once, not as __main__)
+if __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+	jobQueue.startWorkers(pipeline_command, pipelineWorkers)
+
+#One tailer per pipeline event log, shared by everyone watching that job
+eventBroadcaster = EventBroadcaster()
+
+def event_log(logFile):
+	return os.path.splitext(logFile)[0]+'.events.jsonl'
+
 class idtext():
 	id = 0
 	text = ""
@@ -38,20 +110,10 @@ class idtext():
 
 @app.route('/return_mainlibraries', methods=['GET', 'POST'])
 def return_mainlibraries():
-	mainLibraryNames = []
 	query = request.form['query']
 	try:
-		conn = SMBConnection(username, password, myRequestIdentifier, serverName, domain=domain, use_ntlm_v2 = True)
-		conn.connect(host, port)
-
-		mainLibraryFolders = conn.listPath(sharedFolder, '/MiSeqOutput')
-		for f in mainLibraryFolders:
-			#Ignore .DS_Store
-			folderName = f.filename
-			if folderName.startswith("."):
-				continue
-			if query.lower() in folderName.lower():
-				mainLibraryNames.append(idtext(folderName, folderName))
+		refresh_run_index()
+		mainLibraryNames = [idtext(folderName, folderName) for folderName in runIndex.runs(query)]
 	except Exception as ex:
 		return jsonify(result=str(ex))
 	return jsonify(result=[e.serialize() for e in mainLibraryNames])
@@ -63,33 +125,13 @@ def return_mainlibraries():
 
 @app.route('/return_sampleIDs', methods=['GET', 'POST'])
 def return_sampleIDs():
-	sampleIDs = []
 	query = request.form['query']
 	mainLibraryFolder = request.form['mainLibraryFolder']
 	try:
-		conn = SMBConnection(username, password, myRequestIdentifier, serverName, domain=domain, use_ntlm_v2 = True)
-		conn.connect(host, port)
-
-		sampleSheetCSV = tempfile.NamedTemporaryFile()
-		pathTo = 'MiSeqOutput/'+mainLibraryFolder+'/SampleSheet.csv'
-		sampleSheetCSV_attributes, sampleSheetCSV_size = conn.retrieveFile(sharedFolder, pathTo, sampleSheetCSV)
-
-		sampleSheetCSV.seek(0)
-
-		fileContents = sampleSheetCSV.read()
-		uniqueLines = fileContents.replace("\r\n", '\n').replace("\r", '\n').split("\n")
-
-		counter = 0
-		for line in uniqueLines:
-			#sampleIDs.append(idtext(line, line))
-			if (line.startswith("[Data]") or counter==1):
-				counter+=1
-				continue
-			#Two lines after [Data] line, first sampleIDs is encountered
-			if (counter==2):
-				sampleID = line[:line.find(",")]
-				if (query.lower() in sampleID.lower()) and not sampleID=="": #Not blank line
-					sampleIDs.append(idtext(sampleID, sampleID))
+		refresh_run(mainLibraryFolder)
+		sampleIDs = [idtext(sampleID, sampleID) for sampleID in runIndex.sampleIDs(mainLibraryFolder, query)]
+		if runIndex.run(mainLibraryFolder) is not None:
+			prefetcher.request(mainLibraryFolder)
 	except Exception as ex:
 		exc_type, exc_obj, exc_tb = sys.exc_info()
 		fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
@@ -138,26 +180,77 @@ def run_pipeline():
 		error = True
 		referenceSequencesError = True
 
+	try:
+		priority = int(request.form.get('priority', 0) or 0)
+	except ValueError:
+		return jsonify(result="Priority must be a whole number"), 400
+
 	if not error:
-		#Path to Pipeline.py
-		pathToPipeline = 'path/To/pipeline'
+		prefetcher.claim(mainLibraryFolder)
+		jobID, isNew = jobQueue.enqueue(mainLibraryFolder, subLibraryIDs.split(), referenceSequences.split(), email, priority)
+		job = jobQueue.job(jobID)
+
+		return render_template('index.html', submissionSuccess=True, email=email, mainLibraryFolder=mainLibraryFolder, subLibraryIDs=subLibraryIDs.split(" "), referenceSequences=referenceSequences, job=job, duplicate=not isNew)
+	else:
+		return render_template('index.html', submissionFailure=True, emailError=emailError, mainLibraryFolderError=mainLibraryFolderError, subLibraryIDsError=subLibraryIDsError, referenceSequencesError=referenceSequencesError)
 
-		#Log file
-		timeStamp = int(time.time())
-		logFile =pathToPipeline+'/website/logs/logOfPipeline_'+str(timeStamp)+'.txt'
 
-		#Pipeline command
-		command = 'python3'+" "+pathToPipeline+'/pipeline.py'+' -m '+mainLibraryFolder+' -s '+subLibraryIDs+' -r '+referenceSequences+' -e '+email+' -l '+logFile
-		commandString = shlex.split(command)
 
-		#Run pipeline.py
-		p = subprocess.Popen(commandString, stdout=subprocess.PIPE)
 
-		return render_template('index.html', submissionSuccess=True, email=email, mainLibraryFolder=mainLibraryFolder, subLibraryIDs=subLibraryIDs.split(" "), referenceSequences=referenceSequences, command=" ".join(commandString))
-	else:
-		return render_template('index.html', submissionFailure=True, emailError=emailError, mainLibraryFolderError=mainLibraryFolderError, subLibraryIDsError=subLibraryIDsError, referenceSequencesError=referenceSequencesError)
+#
+#Pipeline job status
+#
+
+@app.route('/job_status/<int:jobID>', methods=['GET'])
+def job_status(jobID):
+	job = jobQueue.job(jobID)
+	if job is None:
+		return jsonify(result="No such job"), 404
+	return jsonify(result=dict((k, job[k]) for k in ('id', 'state', 'position', 'mainLibrary', 'subLibraries', 'submitted', 'started', 'finished', 'returnCode') if k in job))
+
+
+#
+#Pipeline progress, as Server-Sent Events
+#
+
+@app.route('/job_events/<int:jobID>', methods=['GET'])
+def job_events(jobID):
+	job = jobQueue.job(jobID)
+	if job is None:
+		return jsonify(result="No such job"), 404
+	after = int(request.headers.get('Last-Event-ID', 0) or 0)
+
+	def stream(job):
+		#A queued job has no log yet: report its position until a worker starts it. A job that was just
+		#claimed is running for a moment before its log is recorded
+		while job['logFile'] is None:
+			if job['state'] == QUEUED:
+				yield 'event: queued\ndata: '+json.dumps({'position': job['position']})+'\n\n'
+				time.sleep(5)
+			elif job['state'] == RUNNING:
+				yield ': starting\n\n'
+				time.sleep(1)
+			else:
+				#Ended without a log (e.g. pipeline.py could not be started)
+				yield 'event: pipeline\ndata: '+json.dumps({'stage': 'pipeline', 'state': 'finished' if job['state'] == DONE else 'failed'})+'\n\n'
+				return
+			job = jobQueue.job(jobID)
+		for message in eventBroadcaster.stream(event_log(job['logFile']), after):
+			yield message
+
+	response = Response(stream(job), mimetype='text/event-stream')
+	response.headers['Cache-Control'] = 'no-cache'
+	response.headers['X-Accel-Buffering'] = 'no'
+	return response
+
 
+#
+#Pipeline results (BAM, .bai, VCF, BED, IGV sessions, index.html), with Range request support for genome viewers
+#
 
+@app.route('/results/<path:path>', methods=['GET', 'HEAD'])
+def results(path):
+	return send_result(pathToPipeline+'/MiSeqValidationResults', path)
 
 
 #